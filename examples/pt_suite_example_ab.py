@@ -12,11 +12,13 @@ import os
 import sys
 import logging
 import re
+import tempfile
 
 bindir, basename = os.path.split(sys.argv[0])
 sys.path.insert(0, os.path.join(bindir, ".."))
 
 from perftrackerlib.client import ptSuite, ptHost, ptVM, ptComponent, ptProduct, ptTest
+from perftrackerlib.helpers.histogram import ptHistogram
 from perftrackerlib import __version__
 
 reRPS = re.compile("Requests per second:\s+(\d+\.\d+).*")
@@ -29,7 +31,7 @@ EXIT_NO_URLS = -3
 
 
 class ABLauncher:
-    def __init__(self, suite, urls, concurrencies=None, iterations=3, requests=0, time=5):
+    def __init__(self, suite, urls, concurrencies=None, iterations=3, requests=0, time=5, target_ci=None):
         if concurrencies is None:
             concurrencies = []
         assert type(concurrencies) == list
@@ -45,13 +47,28 @@ class ABLauncher:
         self.iterations = int(iterations)
         self.requests = int(requests)
         self.time = int(time)
+        self.target_ci = target_ci  # stop iterations when the req/sec confidence interval is within +/- target_ci
 
-        self.fmt = "%11s %8s %8s %8s  %s"
+        self.fmt = "%11s %8s %8s %8s %8s %8s  %s"
 
     def print_ab_header(self):
-        print(self.fmt % ("Concurrency", "Req/sec", "Requests", "Errors", "Cmdline"))
-
-    def parse_ab_stdout(self, concurrency, cmdline, stdout, test):
+        print(self.fmt % ("Concurrency", "Req/sec", "Requests", "Errors", "p50 (ms)", "p99 (ms)", "Cmdline"))
+
+    @staticmethod
+    def parse_ab_gnuplot(path):
+        """
+        Parse 'ab -g' output: starttime, seconds, ctime, dtime, ttime, wait, returns the histogram of ttime (ms)
+        """
+        hist = ptHistogram(unit="ms")
+        with open(path) as f:
+            for line in f:
+                cols = line.split("\t")
+                if len(cols) < 5 or not cols[4].strip().isdigit():
+                    continue
+                hist.record(int(cols[4]))
+        return hist
+
+    def parse_ab_stdout(self, concurrency, cmdline, stdout, test, hist=None):
         score = 0
         loops = 0
         errors = 0
@@ -72,7 +89,10 @@ class ABLauncher:
                 errors = int(m.groups()[0])
                 test.errors += errors
                 continue
-        print(self.fmt % (str(concurrency), "%.1f" % score, str(loops), str(errors), cmdline))
+        p50, p99 = hist.percentiles([50, 99]) if hist else (None, None)
+        print(self.fmt % (str(concurrency), "%.1f" % score, str(loops), str(errors),
+                          "%.1f" % p50 if p50 is not None else "-", "%.1f" % p99 if p99 is not None else "-",
+                          cmdline))
 
     def _validate_urls(self):
         for url in self.urls:
@@ -102,12 +122,27 @@ class ABLauncher:
                               group="Throughput", metrics="req/sec",
                               errors=0, loops=0, cmdline=cmdline)
 
-                for i in range(0, self.iterations):
-                    status, stdout, stderr = test.execute()
+                # every request latency is saved by 'ab -g' and uploaded as the test percentiles
+                fd, gnuplot = tempfile.mkstemp(prefix="ab.", suffix=".tsv")
+                os.close(fd)
+
+                def iteration():
+                    status, stdout, stderr = test.execute("%s -g %s" % (test.cmdline, gnuplot))
                     if status:
                         print(stderr, file=sys.stderr)
                         sys.exit(EXIT_AB_ERROR)
-                    self.parse_ab_stdout(concurrency, test.cmdline, stdout, test)
+                    hist = self.parse_ab_gnuplot(gnuplot)
+                    test.add_histogram(hist)
+                    self.parse_ab_stdout(concurrency, test.cmdline, stdout, test, hist)
+
+                if self.target_ci:
+                    test.run(iteration, target_ci=self.target_ci, min_iterations=min(3, self.iterations),
+                             max_iterations=self.iterations)
+                else:
+                    for i in range(0, self.iterations):
+                        iteration()
+
+                os.unlink(gnuplot)
 
                 self.suite.addTest(test)
                 self.suite.upload()
@@ -120,7 +155,10 @@ def main():
                   help="comma separated list of concurrencies to use, default: %default")
     op.add_option("-n", "--requests", default=0, type=int,
                   help="limit every test by given number of requests (time limit is default, see -t)")
-    op.add_option("-i", "--iterations", default=3, type=int, help="number of iterations for every test")
+    op.add_option("-i", "--iterations", default=3, type=int,
+                  help="number of iterations for every test (max number if --target-ci is used)")
+    op.add_option("--target-ci", default=None, type=float,
+                  help="repeat every test until the req/sec 95%% confidence interval is within +/- given %%")
     op.add_option("-f", "--from-file", default="", help="get URLs from given file")
     op.add_option("-t", "--time", default=5, type=int,
                   help="limit every test by given time (sec), default %default")
@@ -146,7 +184,8 @@ def main():
     suite.handleOptions(opts)
 
     ab = ABLauncher(suite, urls, concurrencies=[int(c.strip()) for c in opts.concurrency.split(",")],
-                    requests=opts.requests, iterations=opts.iterations, time=opts.time)
+                    requests=opts.requests, iterations=opts.iterations, time=opts.time,
+                    target_ci=opts.target_ci / 100.0 if opts.target_ci else None)
     ab.init()
     ab.launch()
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from optparse import OptionParser
+import os
+import sys
+import json
+import logging
+
+bindir, basename = os.path.split(sys.argv[0])
+sys.path.insert(0, os.path.join(bindir, ".."))
+
+from perftrackerlib.client import ptSuite
+from perftrackerlib.helpers.decorators import ptBenchmark
+
+
+def main(suite):
+    @ptBenchmark(suite=suite, group="json", params=[10, 1000, 100000], category="%d items",
+                 setup=lambda n: list(range(n)))
+    def dumps(data):
+        """json.dumps() of a list of ints"""
+        json.dumps(data)
+
+    @ptBenchmark(suite=suite, group="json", params=[10, 1000, 100000], category="%d items",
+                 setup=lambda n: json.dumps(list(range(n))))
+    def loads(text):
+        """json.loads() of a list of ints"""
+        json.loads(text)
+
+    dumps()
+    loads()
+
+    suite.upload()
+
+
+if __name__ == "__main__":
+
+    op = OptionParser("PerfTracker micro-benchmark suite example")
+    op.add_option("-v", "--verbose", action="store_true", help="enable verbose mode")
+
+    suite = ptSuite(suite_ver="1.0.0", product_name="Python", product_ver=sys.version.split()[0],
+                    project_name="Default project")
+    suite.addOptions(op)
+
+    opts, args = op.parse_args()
+    suite.handleOptions(opts)
+
+    loglevel = logging.DEBUG if opts.verbose else logging.INFO
+    logging.basicConfig(level=loglevel, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
+
+    main(suite)
@@ -3,13 +3,19 @@
 from __future__ import print_function
 
 import sys
-from distutils.version import LooseVersion
+import re
 
 __version__ = "0.0.44"
 __name__ = "perftrackerlib"
 
+
+def _version_tuple(ver):
+    # distutils.version.LooseVersion is deprecated and takes ~0.3 sec to import via setuptools
+    return tuple(int(n) for n in re.findall(r"\d+", ver))
+
+
 def perftrackerlib_require_version(ver_required):
-    if LooseVersion(__version__) < LooseVersion(ver_required):
+    if _version_tuple(__version__) < _version_tuple(ver_required):
         print("Error: perftrackerlib version >= %s must be installed, found %s" %
               (ver_required, __version__))
         sys.exit(-2)
@@ -24,15 +24,19 @@ from multiprocessing.dummy import Pool as ThreadPool
 
 if sys.version_info[0] < 3:
     from Cookie import SimpleCookie
+    from Queue import Queue
 else:
     from http.cookies import SimpleCookie
+    from queue import Queue
 
 from .browser_base import BrowserBase, BrowserExc
 from .page import Page, PageRequest, PageRequestsGroup, PageWithActions
 from .utils import parse_url, extract_cookies
-from ..helpers.httppool import HTTPPool
+from ..helpers.httppool import HTTPPool, HTTP_POOL_MAX_STREAMS, HTTP_BODY_KEEP, HTTP_BODY_DISCARD
 from . import httputils
 
+BROWSER_PYTHON_MAX_BODY = 64 * 1024  # the response bytes kept for the validator of a non-document request
+
 
 class BrowserPythonNetlocData:
     def __init__(self, browser, netloc):
@@ -62,8 +66,13 @@ class BrowserPythonNetlocData:
     def _get_http_pool(self, scheme):
         if scheme not in self.httpool:
             loc = "%s://%s" % (scheme, self.netloc)
-            self.browser.log_debug("allocating connection pool to %s" % loc)
-            self.httpool[scheme] = HTTPPool("%s" % loc)
+            self.browser.log_debug("allocating %s connection pool to %s" % (self.browser.http_engine, loc))
+            if self.browser.http2:
+                # one multiplexed connection, the pool items are the streams
+                self.httpool[scheme] = HTTPPool("%s" % loc, engine=self.browser.http_engine, http2=True,
+                                                max_conns=self.browser.max_streams)
+            else:
+                self.httpool[scheme] = HTTPPool("%s" % loc, engine=self.browser.http_engine)
         return self.httpool[scheme]
 
     def __del__(self):
@@ -111,7 +120,7 @@ class BrowserPythonNetlocData:
 
         for key, paths in path_cookies.items():
             # sort by string length: ["/home/path", "/home", "/"]
-            for p in sorted(paths.keys(), lambda x: len(x), reverse=True):
+            for p in sorted(paths.keys(), key=len, reverse=True):
                 if path.startswith(p):
                     cookies[key] = paths[p]
                     break
@@ -146,48 +155,84 @@ class BrowserPythonNetlocData:
 
         return None
 
-    def _execute_page_request(self, pool, page, req, path_with_args):
-        assert(req.method == 'POST' or not req.params)  # only POST request may have params
-
-        with pool.borrow() as (conn, is_new):
-            # conn.set_debuglevel(1)
+    def _get_max_body(self, page, req):
+        """
+        The response body policy (see HTTPPool): the page document body is kept, the other requests keep
+        BrowserPython.max_body bytes for the validator or just count the body length. The policy is stored
+        in the request, so the redirect requests (duplicates) inherit it
+        """
+        if not hasattr(req, "_max_body"):
+            if self.browser.max_body is None or req.url == page.url or req.type == "Document":
+                req._max_body = HTTP_BODY_KEEP
+            elif req.validator is not None and self.browser.validation:
+                req._max_body = self.browser.max_body
+            else:
+                req._max_body = HTTP_BODY_DISCARD
+        return req._max_body
+
+    def _request(self, pool, conn, page, req, path_with_args):
+        if pool.engine == "httplib":
             conn.request(req.method, path_with_args, req.params, req.header)
-            self.header['Referer'] = req.url
-            response = conn.getresponse()
-            req.status = response.status
-            req.data = response.read()
-
-            self.browser.log_debug(" req %s HTTP response: %s, headers: %s" %
-                                   (req.id, req.status, response.getheaders()))
-
-            # handle new cookies
-            for cookie in extract_cookies(response):
-                if sys.version_info[0] < 3 and isinstance(cookie, unicode):
-                    cookie = cookie.encode('ascii', 'ignore')
-                self.cookies.load(cookie)
-
-            # handle redirection
-            new_req = self._get_redirected_request(req, response)
-            if new_req:
-                self.browser.log_debug(" req %s, redirect to %s" % (new_req.id, new_req.url))
-                page.add_request(new_req)
+        else:
+            conn.request(req.method, path_with_args, req.params, req.header, max_body=self._get_max_body(page, req))
+
+    def _handle_response(self, page, req, response):
+        """Store the response status and data, load the cookies, returns the redirect request (if any)"""
+        self.header['Referer'] = req.url
+        req.status = response.status
+        req.data = response.read()
+        req.length = getattr(response, "body_length", len(req.data))
+        max_body = self._get_max_body(page, req)
+        if max_body is not None and len(req.data) > max_body:
+            req.data = req.data[:max_body]  # httplib
+        req.connection_id = getattr(response, "connection_id", None)
+        if req.connection_id:
+            req.connection_reused = not response.new_connections
+
+        self.browser.log_debug(" req %s HTTP/%s response: %s, headers: %s" %
+                               (req.id, getattr(response, "http_version", None), req.status, response.getheaders()))
+
+        # handle new cookies
+        for cookie in extract_cookies(response):
+            if sys.version_info[0] < 3 and isinstance(cookie, unicode):
+                cookie = cookie.encode('ascii', 'ignore')
+            self.cookies.load(cookie)
+
+        return self._get_redirected_request(req, response)
+
+    def _complete_page_request(self, page, req, new_req):
+        # handle redirection after the connection is returned to the pool, so the redirect chains don't hold
+        # several connections of the (limited) pool at once
+        if new_req:
+            self.browser.log_debug(" req %s, redirect to %s" % (new_req.id, new_req.url))
+            page.add_request(new_req)
 
-                # FIXME:
-                # 1. _get_netloc_data is private method of the browser.
+            # FIXME:
+            # 1. _get_netloc_data is private method of the browser.
 
-                self.browser._get_netloc_data(new_req.url).execute_page_request(page, new_req)
-                req.status = new_req.status
-                req.data = new_req.data
+            self.browser._get_netloc_data(new_req.url).execute_page_request(page, new_req)
+            req.status = new_req.status
+            req.data = new_req.data
 
-            if req.valid_statuses and req.status not in req.valid_statuses:
-                raise BrowserExc(' req %s, %s %s status %d'
-                                 (req.id, req.method, req.url, req.status))
+        if req.valid_statuses and req.status not in req.valid_statuses:
+            raise BrowserExc(' req %s, %s %s status %d' %
+                             (req.id, req.method, req.url, req.status))
 
         if self.browser.validation:
             req.validate_response(req.data)
 
         req.complete()
-        return
+
+    def _execute_page_request(self, pool, page, req, path_with_args):
+        assert(req.method == 'POST' or not req.params)  # only POST request may have params
+
+        with pool.borrow() as (conn, is_new):
+            # conn.set_debuglevel(1)
+            self._request(pool, conn, page, req, path_with_args)
+            response = conn.getresponse()
+            new_req = self._handle_response(page, req, response)
+
+        self._complete_page_request(page, req, new_req)
 
     def execute_page_request(self, page, req):
 
@@ -231,6 +276,10 @@ class BrowserPythonNetlocData:
             self.execute_page_request(page, reqs[0])
             return
 
+        if self.browser.http_engine == "curlmulti":
+            self._execute_page_requests_async(page, reqs, parallel)
+            return
+
         def execute(arg):
             global data
             page, req = arg
@@ -251,16 +300,71 @@ class BrowserPythonNetlocData:
         pool.close()
         pool.join()
 
+    def _execute_page_requests_async(self, page, reqs, parallel):
+        """
+        The 'curlmulti' engine: up to 'parallel' requests are in flight on the HTTPCurlMultiLoop thread,
+        the responses are handled in this thread as they complete
+        """
+        completed = Queue()
+        pending = list(reqs)
+        in_flight = 0
+
+        while pending or in_flight:
+            while pending and in_flight < parallel:
+                req = pending.pop(0)
+                scheme, netloc, path_with_args = parse_url(req.url, args=True)
+                if scheme not in ("http", "https", "ftp"):
+                    self.execute_page_request(page, req)  # raises BrowserExc
+                assert req.method == 'POST' or not req.params  # only POST request may have params
+
+                req.start()
+                self._get_http_pool(scheme).request_async(
+                    req.method, path_with_args, req.params, req.header,
+                    lambda response, error, req=req: completed.put((req, response, error)),
+                    max_body=self._get_max_body(page, req))
+                in_flight += 1
+
+            req, response, error = completed.get()
+            in_flight -= 1
+
+            if error is not None:
+                req.status = str(type(error))
+                req.complete()
+                self.browser.log_error("HTTP Exception: %s %s: %s %s" % (req.method, req.url, type(error),
+                                                                         str(error)))
+                continue
+
+            new_req = self._handle_response(page, req, response)
+            self._complete_page_request(page, req, new_req)
+
 
 class BrowserPython(BrowserBase):
     engine = "pybrwsr"
 
     def __init__(self, headless=True, validation=True, cleanup=True, max_connections=8,
-                 js_redirects=False, log_path=None):
+                 js_redirects=False, log_path=None, http_engine="pycurl", http2=False,
+                 max_streams=HTTP_POOL_MAX_STREAMS, max_body=BROWSER_PYTHON_MAX_BODY):
+        """
+        max_connections - max number of the parallel requests of a page requests group
+        http_engine     - HTTPPool engine: 'pycurl' (a thread per parallel request), 'curlmulti' (all the
+                          requests are multiplexed on one event loop thread) or 'httplib'
+        http2           - HTTP/2 (https only) like the real browsers: one connection per origin with up to
+                          max_streams parallel requests, it requires the 'curlmulti' engine
+        max_body        - only the page document response is kept entirely, the other requests keep up to
+                          max_body bytes for the validator (and only count the length if there is no one),
+                          None - keep all the responses
+        """
         BrowserBase.__init__(self, cleanup=cleanup, log_path=log_path)
 
+        if http2 and http_engine == "httplib":
+            raise BrowserExc("HTTP/2 is not supported by the 'httplib' engine")
+
         self.validation = validation
-        self.max_connections = max_connections
+        self.max_connections = max_streams if http2 else max_connections
+        self.http_engine = "curlmulti" if http2 else http_engine
+        self.http2 = http2
+        self.max_streams = max_streams
+        self.max_body = max_body
         self.js_redirects = js_redirects  # try to parse page to detect JS and other ways of redirect
 
         self._netloc_data = {}
@@ -299,7 +403,7 @@ class BrowserPython(BrowserBase):
         return
 
     def browser_get_name(self):
-        return "Python HTTP/1.x browser"
+        return "Python HTTP/2 browser" if self.http2 else "Python HTTP/1.x browser"
 
     def browser_get_version(self):
         return "Python %s" % platform.python_version()
@@ -371,8 +475,97 @@ class BrowserPython(BrowserBase):
 ##############################################################################
 
 
+def _coverage():
+    import threading
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    big = 1024 * 1024
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body, headers=()):
+            self.send_response(status)
+            for h, v in headers:
+                self.send_header(h, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/":
+                self._reply(200, b"<html><body>document " + b"x" * big + b"</body></html>",
+                            [("Content-Type", "text/html"), ("Set-Cookie", "session=1; Path=/")])
+            elif self.path == "/redirect":
+                self._reply(302, b"", [("Location", "/big")])
+            elif self.path == "/big":
+                self._reply(200, b"b" * big)
+            elif self.path == "/small":
+                self._reply(200, b"hello " + b"s" * big + b" world")
+            else:
+                self._reply(404, b"not found")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._reply(200, b"posted " + body + b" " + self.headers.get("Cookie", "").encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+
+    for engine in ("pycurl", "curlmulti", "httplib"):
+        b = BrowserPython(http_engine=engine, max_body=1024)
+        assert b.http_get(url + "/").endswith("</body></html>")
+        assert b.browser_get_cookies_str(url + "/") == "session=1"
+        assert b.http_post(url + "/post", params="a=1") == "posted a=1 session=1"
+
+        page = Page(b, url + "/")
+        reqs = []
+        for path, validator in (("/", b"document"), ("/redirect", None), ("/big", None), ("/small", b"hello"),
+                                ("/missing", None)):
+            req = PageRequest(page)
+            req.method = "GET"
+            req.url = url + path
+            req.validator = validator
+            page.add_request(req)
+            reqs.append(req)
+        page.requests_groups.append(PageRequestsGroup(reqs[0]))
+        page.requests_groups.append(PageRequestsGroup(reqs[1]))
+        for req in reqs[2:]:
+            page.requests_groups[1].add_request(req)
+
+        p = b.navigate_to(page, cached=None)
+        doc, redirect, big_req, small, missing = p.requests[:5]
+        assert doc.length == len(doc.data) > big and doc.data.endswith(b"</body></html>"), engine
+        # the non-document bodies are discarded or cut to max_body for the validator, the length is counted
+        assert redirect.status == 200 and redirect.data == b"" and p.requests[-1].length == big, engine
+        assert big_req.data == b"" and big_req.length == big, engine
+        assert small.data.startswith(b"hello") and len(small.data) == 1024 and small.length == big + 12, engine
+        assert missing.status == 404
+        assert all(r.completed for r in p.requests)
+
+        b.browser_reset()
+        b.browser_stop()
+
+    b = BrowserPython(max_body=None)
+    assert len(b.http_get(url + "/big")) == big
+
+    server.shutdown()
+    server.server_close()
+
+
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    b = BrowserPython()
-    b.navigate_to("https://example.com/")
-    b.browser_stop()
+    _coverage()
@@ -37,29 +37,42 @@ import datetime
 import socket
 import platform
 import math
+import importlib
+from collections import OrderedDict
 from tempfile import gettempdir
 from optparse import OptionParser, OptionGroup
 from multiprocessing import Process, Queue, cpu_count
-from psutil import virtual_memory
 
 from perftrackerlib import __version__ as __version__
 from perftrackerlib.client import ptSuite, ptTest, ptVM, ptComponent
 from .browser_base import BrowserExc, DEFAULT_NAV_TIMEOUT, DEFAULT_AJAX_THRESHOLD
 from .browser_python import BrowserPython
-from .browser_chrome import BrowserChrome
-from .browser_firefox import BrowserFirefox
-from .html_report import ptBrowserHtmlReport
 from .page import PageStats, PageStatsSummary
 from .utils import gen_urls_from_index_file
 from .cp_engine import CPEngineBase
 from ..helpers.texttable import TextTable
-from ..helpers.ptshell import ptShell
-from selenium.webdriver.remote.remote_connection import LOGGER as selenium_logger
+from ..helpers.stats import rel_ci_halfwidth
+from ..helpers.lazy import lazy_import
+
+# selenium, PIL, psutil and citizenshell are slow to import, so load them only when they are really used
+psutil = lazy_import("psutil")
+html_report = lazy_import("perftrackerlib.browser.html_report")
+ptshell = lazy_import("perftrackerlib.helpers.ptshell")
 
 bindir, basename = os.path.split(sys.argv[0])
 basename = basename.split(".")[0]
 
-BROWSERS = (BrowserChrome, BrowserFirefox, BrowserPython)
+# browser engine -> (module, class), the first one is the default
+BROWSERS = OrderedDict([("chrome", (".browser_chrome", "BrowserChrome")),
+                        ("firefox", (".browser_firefox", "BrowserFirefox")),
+                        (BrowserPython.engine, (".browser_python", "BrowserPython"))])
+
+
+def get_browser_class(engine):
+    """Imports the browser module on demand, so selenium is not loaded for the python browser"""
+    module, cls = BROWSERS.get(engine, list(BROWSERS.values())[0])
+    return getattr(importlib.import_module(module, __package__), cls)
+
 
 OPT_DELAY_BETWEEN_CLICK_SEC = 1.0
 OPT_DEFAULT_AJAX_THRESHOLD = DEFAULT_AJAX_THRESHOLD
@@ -104,11 +117,7 @@ class CPBrowserRunner:
         self.pt_suite = pt_suite
         self._html_report = None
 
-        self.browser_class = BROWSERS[0]
-        for b in BROWSERS:
-            if b.engine == self.opts.browser:
-                self.browser_class = b
-                break
+        self.browser_class = get_browser_class(self.opts.browser)
 
         self.logdir = os.path.join(workdir, "browser.%d" % browser_id)
         self.crawler_logfile = os.path.join(self.logdir, logfile if logfile else "%s.log" % basename)
@@ -141,7 +150,7 @@ class CPBrowserRunner:
             self.opts.telemetry = os.path.join(self.workdir, "telemetry.log")
 
         if self.opts.html_report and self.browser_id == 0:
-            self._html_report = ptBrowserHtmlReport(self.opts.html_report, title=self.urls[0])
+            self._html_report = html_report.ptBrowserHtmlReport(self.opts.html_report, title=self.urls[0])
             self._html_report.gen_index_html()
 
     def fini(self):
@@ -199,10 +208,10 @@ class CPBrowserRunner:
         if not self.opts.pt_title and product_name and product_ver:
             browser_name = self.browser.browser_get_name()
             browser_name += self.browser.browser_get_version().split(".")[0]
-            ghz = ptShell().hw_info.cpu_freq_ghz
+            ghz = ptshell.ptShell().hw_info.cpu_freq_ghz
             self.pt_suite.job_title = "%s %s @ %s %1.fGHz" % (product_name, product_ver, browser_name, ghz)
 
-        ram = virtual_memory()
+        ram = psutil.virtual_memory()
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
@@ -237,10 +246,22 @@ class CPBrowserRunner:
                 self.pt_suite.addTest(test)
 
             test.add_score(page.__dict__[f])
+            if f == "dur":
+                test.record(max(page.dur, 0))
             test.duration_sec += int(math.ceil(page.dur))
 
         self._pt_upload()
 
+    def _ci_converged(self, page):
+        if not self.opts.target_ci:
+            return False
+        durs = [p.dur for p in self.browser.page_stats[page.get_key()].iterations]
+        rel_ci = rel_ci_halfwidth(durs)
+        if len(durs) < 3 or rel_ci is None or rel_ci * 100 > self.opts.target_ci:
+            return False
+        logging.info("%s: page load time CI +/- %.1f%% after %d iterations" % (page.url, rel_ci * 100, len(durs)))
+        return True
+
     def _run(self):
 
         self.browser.print_browser_info()
@@ -385,6 +406,8 @@ class CPBrowserRunner:
                             raise CPCrawlerException("Page navigation (%s) failed, aborting" % url)
 
                         self.browser.page_stats[page.get_key()].print_page_timeline(page, title=str(n + 1))
+                        if self._ci_converged(page):
+                            break
                     except BrowserExc as e:
                         logging.error(e)
                         # break
@@ -395,6 +418,12 @@ class CPBrowserRunner:
             br_ps.id = self.browser.browser_get_name()
             avg = br_ps.get_avg()
             self.browser.page_stats[page.get_key()].print_page_timeline(avg, title="Average", hr=True)
+            if avg:
+                print("  %7s | %s" % ("Total", ", ".join("p%d %d ms" % (p, v) for p, v in
+                                                         zip((50, 90, 99), br_ps.get_percentiles()))))
+                if avg.dropped_iterations:
+                    print("  %7s | %d warm-up/outlier iteration(s) are not counted, average of all: %d ms" %
+                          ("Raw", avg.dropped_iterations, avg.raw_dur))
             browser_page_stats.append(br_ps)
 
             if self.opts.python_browsers:
@@ -404,6 +433,7 @@ class CPBrowserRunner:
                 py_ps = PageStats("%d python simulator(s)" % (self.opts.python_browsers))
                 for s in simulators:
                     py_ps.iterations += s.page_stats[page.get_key()].iterations
+                py_ps.update()
 
                 simulators_page_stats.append(py_ps)
 
@@ -509,11 +539,14 @@ class CPCrawler:
         og.add_option("-t", "--telemetry", type="string",
                       help="log pages to given file (append only, concurrent-process-safe)")
         og.add_option("-w", "--wait", action="store_true", help="don\'t close the browser and wait till test is killed")
-        og.add_option("-l", "--loops", type="int", default=7, help="number of iterations, default %default")
+        og.add_option("-l", "--loops", type="int", default=7,
+                      help="number of iterations (max number if --target-ci is used), default %default")
+        og.add_option("--target-ci", type="float", default=None,
+                      help="stop iterations when the page load time 95%% confidence interval is within +/- given %%")
 
-        og.add_option("-b", "--browser", choices=[b.engine for b in BROWSERS], default=BROWSERS[0].engine,
+        og.add_option("-b", "--browser", choices=list(BROWSERS.keys()), default=list(BROWSERS.keys())[0],
                       help="browser to use: %s (default is '%%default')" %
-                      ",".join(['\'%s\'' % b.engine for b in BROWSERS]))
+                      ",".join(['\'%s\'' % engine for engine in BROWSERS]))
         og.add_option("-r", "--requests", action="store_true",
                       help="print information about individual network requests")
         og.add_option("-o", "--perf-atomic-format", action="store_true", help="perf-atomic output format")
@@ -611,7 +644,7 @@ class CPCrawler:
             level = logging.DEBUG if opts.verbose > 1 else logging.INFO if opts.verbose else logging.WARNING
             logging.basicConfig(level=level)
             if opts.verbose < 3:
-                selenium_logger.setLevel(logging.WARNING)
+                logging.getLogger("selenium.webdriver.remote.remote_connection").setLevel(logging.WARNING)
 
         logger = logging.getLogger()
         for handler in logger.root.handlers:
@@ -19,10 +19,10 @@ import re
 
 from .browser_base import BrowserBase, BrowserExc, BrowserExcTimeout
 from .browser_python import BrowserPython
-from selenium.common.exceptions import ElementNotVisibleException
-from selenium.common.exceptions import NoSuchElementException
-from selenium.common.exceptions import WebDriverException
-from selenium.common.exceptions import StaleElementReferenceException
+from ..helpers.lazy import lazy_import
+
+# selenium is only needed for the real browsers, see cp_crawler.BROWSERS
+selenium_exceptions = lazy_import("selenium.common.exceptions")
 
 
 reHTML = re.compile('<.*?>')
@@ -267,7 +267,7 @@ class CPEngineBase:
         self.browser.log_info("searching for frame: '%s'" % frame)
         try:
             el = self.browser.driver.find_element_by_xpath(frame)
-        except NoSuchElementException:
+        except selenium_exceptions.NoSuchElementException:
             if verbose:
                 self.browser.log_error("Can't find frame element: '%s', page source:\n%s" %
                                        (frame, self.browser.driver.page_source))
@@ -311,7 +311,7 @@ class CPEngineBase:
                 if not link_url:
                     try:
                         link_url = link_el.get_attribute('href')
-                    except StaleElementReferenceException:
+                    except selenium_exceptions.StaleElementReferenceException:
                         # previous click caused dom change, so re-load menu items (assuming their sequence is preserved)
                         menu_elements = self.browser.driver.find_elements_by_xpath(x.link_xpath)
                         if i >= len(menu_elements):
@@ -357,9 +357,9 @@ class CPEngineBase:
                 self.log_info("found %s" % msg)
                 try:
                     self.cp_do_menu_item_click(link_el, title=title)
-                except WebDriverException as e:
+                except selenium_exceptions.WebDriverException as e:
                     self.log_info(" ... skipping the '%s' menu item: %s" % (title, str(e)))
-                except ElementNotVisibleException:
+                except selenium_exceptions.ElementNotVisibleException:
                     self.log_info(" ... skipping the '%s' menu item since it is not visible" % title)
                     continue
                 except BrowserExc as e:
@@ -22,6 +22,8 @@ from collections import defaultdict
 
 from .utils import parse_url, get_common_url_prefix
 from ..helpers.texttable import TextTable
+from ..helpers.histogram import ptHistogram
+from ..helpers.stats import clean_mask
 
 
 class PageTimeline:
@@ -129,6 +131,7 @@ class PageRequest:
         self.length = 0
         self.dur = 0
         self.connection_reused = False
+        self.connection_id = None  # the connection (local ip:port) if the browser reports it
         self.status = None
         self.type = 'Other'
         self.keepalive = False
@@ -344,6 +347,12 @@ class Page:
     def get_error_reqs(self):
         return [r for r in self.requests if not r.is_ok()]
 
+    def get_connections_cnt(self):
+        """Number of the connections used by the uncached requests, None if the browser doesn't report them"""
+        conns = set(getattr(r, "connection_id", None) for r in self.get_uncached_reqs())
+        conns.discard(None)
+        return len(conns) if conns else None
+
     def get_repeated_reqs_cnt(self):
         urls = [r.url for r in self.get_uncached_reqs()]
         return len(urls) - len(set(urls))
@@ -607,8 +616,9 @@ class PageStatsSummary:
             PageStats.print_title(title)
 
         t = TextTable(left_aligned=[0], max_col_width=[72])
-        t.add_row(["Screen", "Iters", "   Requests per page   ", "RecvAvg", "Total", "MemUsg"])
-        t.add_row(["", "", "Ntwrk  Rptd  Frgn  Errs", "   (KB)", " (ms)", "  (KB)"])
+        t.add_row(["Screen", "Iters", "   Requests per page   ", "Conns", "RecvAvg", "Total", "  Total (ms)  ",
+                   "MemUsg"])
+        t.add_row(["", "", "Ntwrk  Rptd  Frgn  Errs", "", "   (KB)", " (ms)", " p50  p90  p99", "  (KB)"])
         t.add_row("-")
 
         prev_psid = ""
@@ -624,8 +634,10 @@ class PageStatsSummary:
                         "%4.0f" % ps.repeated_reqs if ps.repeated_reqs else "-",
                         "%4.0f" % ps.foreign_reqs if ps.foreign_reqs else "-",
                         "%.1f!" % (ps.errs_cnt) if ps.errs_cnt else "-"),
+                       "%.1f" % ps.connections if ps.connections is not None else "-",
                        "%.1f" % (ps.size_bytes / 1024.0),
                        "%.0f" % ps.dur_sec,
+                       "%4s %4s %4s" % tuple("%.0f" % p if p else "-" for p in ps.get_percentiles()),
                        "%.0f" % ps.ram_usage_kb])
 
         print("  " + "\n  ".join(t.get_lines()))
@@ -661,19 +673,25 @@ class PageStats:
         self.uncached_reqs = 0
         self.repeated_reqs = 0
         self.foreign_reqs = 0
+        self.connections = None
         self.dur_sec = 0
         self.ram_usage_kb = 0
+        self.dur_hist = ptHistogram(resolution=1, unit="ms")
 
         if not len(self.iterations):
             return
 
+        conns = []
         for i in self.iterations:
             self.size_bytes += i.length
             self.errs_cnt += len(i.get_error_reqs())
             self.uncached_reqs += len(i.get_uncached_reqs())
             self.repeated_reqs += i.get_repeated_reqs_cnt()
             self.foreign_reqs += len(i.get_foreign_reqs())
+            if i.get_connections_cnt() is not None:
+                conns.append(i.get_connections_cnt())
             self.dur_sec += i.dur
+            self.dur_hist.record(max(i.dur, 0))
             self.ram_usage_kb += i.ram_usage_kb
 
         n = float(len(self.iterations))
@@ -683,6 +701,8 @@ class PageStats:
         self.uncached_reqs /= n
         self.repeated_reqs /= n
         self.foreign_reqs /= n
+        if conns:
+            self.connections = sum(conns) / float(len(conns))
         self.dur_sec /= n
         self.ram_usage_kb /= n
 
@@ -752,14 +772,27 @@ class PageStats:
         print("%s" % (" " * len(PageTimeline.types[-1])), end=" ")
         print("| %9d | %10d" % (p.dur, p.ram_usage_kb))
 
-    def get_avg(self, iterations=None):
+    def get_avg(self, iterations=None, clean=True):
+        """
+        Average page, if clean is True the warm-up iterations and outliers (by total time) are not counted,
+        the average of all the iterations total time is kept in raw_dur then
+        """
         if not iterations:
             iterations = self.iterations
         if not iterations or len(iterations) < 2:
             return None
 
+        raw_dur = int(sum([p.dur for p in iterations]) / len(iterations))
+        dropped = 0
+        if clean:
+            mask = clean_mask([p.dur for p in iterations])
+            dropped = len(iterations) - sum(mask)
+            iterations = [p for p, keep in zip(iterations, mask) if keep]
+
         avg = Page(None, "", None)
         avg.iterations = len(iterations)
+        avg.dropped_iterations = dropped
+        avg.raw_dur = raw_dur
         for p in iterations:
             t = p.timeline
             for d in range(0, len(t.deltas)):
@@ -772,6 +805,10 @@ class PageStats:
         avg.ram_usage_kb = sum([p.ram_usage_kb for p in iterations]) / len(iterations)
         return avg
 
+    def get_percentiles(self, percentiles=(50, 90, 99)):
+        """Page total time (ms) percentiles"""
+        return self.dur_hist.percentiles(percentiles)
+
     def get_screen_title(self, common_prefix=""):
         if len(self.iterations):
             return self.iterations[0].get_full_name(common_prefix)
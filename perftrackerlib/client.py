@@ -8,30 +8,46 @@ __license__ = "MIT"
 import sys
 import os
 import optparse
-import requests
 import json
 import datetime
 import uuid
-import inspect
 import logging
 import pipes
-import subprocess
-import bz2
 import random
-import citizenshell
+import time
+import threading
+import atexit
 import ast
+import bisect
+import functools
+import contextlib
+import re
+import tempfile
+from array import array
 from math import sqrt
-from dateutil import parser
 
 from optparse import OptionParser, OptionGroup
 
+from perftrackerlib.helpers.lazy import lazy_import
 from perftrackerlib.helpers.tee import Tee
 from perftrackerlib.helpers.decorators import cached_property
-from perftrackerlib.helpers.ptshell import ptShell, ptShellFromFile
+from perftrackerlib.helpers.histogram import ptHistogram
+from perftrackerlib.helpers.stats import ci_halfwidth, rel_ci_halfwidth, _clean_mask, describe, get_numpy
+from perftrackerlib.helpers.sampler import ptResourceSampler, PT_SAMPLER_INTERVAL_SEC
 
 from dateutil.tz import tzlocal
 from collections import OrderedDict
 
+# the heavy modules are imported on the first use to keep the tools startup fast
+requests = lazy_import("requests")
+citizenshell = lazy_import("citizenshell")
+bz2 = lazy_import("bz2")
+tarfile = lazy_import("tarfile")
+cProfile = lazy_import("cProfile")
+pstats = lazy_import("pstats")
+parser = lazy_import("dateutil.parser")
+ptshell = lazy_import("perftrackerlib.helpers.ptshell")
+
 if sys.version_info >= (3, 0):
     import http.client as httplib
 else:
@@ -39,10 +55,26 @@ else:
 
 API_VER = '1.0'
 PT_SERVER_DEFAULT_URL = "http://127.0.0.1:9000"
+PT_SERVER_DEFAULT_POOL_SIZE = 4
+PT_SERVER_DEFAULT_RETRIES = 3
+PT_SERVER_DEFAULT_BACKOFF_SEC = 0.5
+PT_SERVER_DEFAULT_TIMEOUT_SEC = 120
+PT_ARTIFACT_CHUNK_SIZE = 1024 * 1024
+PT_ENV_SCAN_PARALLEL = 8
+PT_ENV_SCAN_TIMEOUT_SEC = 60
 
 TEST_STATUSES = ['NOTTESTED', 'SKIPPED', 'INPROGRESS', 'SUCCESS', 'FAILED']
 
 
+# pt_float() precision thresholds: 100, 10, 1, 0.1, ... in the ascending order
+_PT_FLOAT_THRESHOLDS = [100]
+while _PT_FLOAT_THRESHOLDS[0] >= 0.00000001:
+    _PT_FLOAT_THRESHOLDS.insert(0, _PT_FLOAT_THRESHOLDS[0] / 10.0)
+
+# use numpy in pt_floats() for the batches larger than this
+PT_FLOATS_NUMPY_MIN = 1024
+
+
 def pt_float(value):
     if value > 100 or value < -100:
         return int(round(value))
@@ -50,13 +82,32 @@ def pt_float(value):
         return 0
 
     val = abs(float(value))
-    thr = 100
-    prec = 0
-    while val < thr:
-        prec += 1
-        thr /= 10.0
-    fmt = "%." + str(prec) + "f"
-    return float(fmt % (val)) * (1 if value > 0 else -1)
+    val = round(val, len(_PT_FLOAT_THRESHOLDS) - bisect.bisect_right(_PT_FLOAT_THRESHOLDS, val))
+    return val if value > 0 else -val
+
+
+def pt_floats(values):
+    """
+    pt_float() for a batch of values, returns array('d'). The batches are vectorized if numpy is installed
+    """
+    np = get_numpy() if len(values) >= PT_FLOATS_NUMPY_MIN else None
+    if not np:
+        return array('d', [pt_float(v) for v in values])
+
+    v = np.asarray(values, dtype=np.float64)
+    a = np.abs(v)
+    scale = 10.0 ** (len(_PT_FLOAT_THRESHOLDS) - np.searchsorted(_PT_FLOAT_THRESHOLDS, a, side='right'))
+    scaled = a * scale
+    ret = np.round(scaled) / scale * np.sign(v)
+    ret = np.where(a > 100, np.round(v), ret)
+    ret = np.where((v < 0.00000001) & (v >= -100), 0.0, ret)
+
+    # the binary multiplication can be off on the .5 ties, round them exactly as pt_float() does
+    frac = scaled - np.floor(scaled)
+    for i in np.nonzero((np.abs(frac - 0.5) < 0.000001) & (a <= 100) & (v >= 0.00000001))[0]:
+        ret[i] = pt_float(float(v[i]))
+
+    return array('d', ret.tobytes()) if sys.version_info >= (3, 0) else array('d', ret.tolist())
 
 
 def get_timestamp_from_datetime(time):
@@ -70,29 +121,168 @@ class ptRuntimeException(Exception):
     pass
 
 
+try:
+    import orjson
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    try:
+        import ujson
+
+        def _json_dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+    except ImportError:
+        _json_dumps = None
+
+_TZLOCAL = tzlocal()
+_TZLOCAL_OFFSETS = {}
+
+
+def _isoformat_local(dt):
+    """Same as dt.replace(tzinfo=tzlocal()).isoformat(), but the UTC offset is computed once per hour"""
+    dt = dt.replace(tzinfo=None) if dt.tzinfo is not None else dt
+    hour = dt.toordinal() * 24 + dt.hour
+    offset = _TZLOCAL_OFFSETS.get(hour)
+    if offset is None:
+        iso = dt.isoformat()
+        offset = dt.replace(tzinfo=_TZLOCAL).isoformat()[len(iso):]
+        if len(_TZLOCAL_OFFSETS) > 1024:
+            _TZLOCAL_OFFSETS.clear()
+        _TZLOCAL_OFFSETS[hour] = offset
+    return dt.isoformat() + offset
+
+
+# dicts keep the insertion order since python 3.7 and are much faster than OrderedDict
+_JsonDict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+if sys.version_info >= (3, 0):
+    _JSON_PRIMITIVES = set([str, int, float, bool, type(None)])
+else:
+    _JSON_PRIMITIVES = set([unicode, int, long, float, bool, type(None)])  # noqa: F821
+
+
 class ptJsonEncoder(json.JSONEncoder):
+    """
+    Objects are serialized by their public non-empty __dict__ members. The serializer function is generated
+    once per class and set of members, special types are converted by the functions registered in _converters
+    """
+
+    _converters = OrderedDict([
+        (datetime.datetime, _isoformat_local),
+        (uuid.UUID, str),
+        (set, list),
+        (frozenset, list),
+        (array, array.tolist),
+        (ptHistogram, ptHistogram.toDict),
+    ])
+    if sys.version_info < (3, 0):
+        _converters[str] = lambda val: val.decode('utf-8', 'ignore')  # drop broken utf-8 sequences
+    _native_converters = set([array.tolist, ptHistogram.toDict])
+    _compiled = {}
+    _compile_lock = threading.Lock()
+    _dispatch = {}
+
     def default(self, obj):
-        j = OrderedDict()
-        if not inspect.isclass(type(obj)):
-            return json.dumps(obj)
-        if isinstance(obj, datetime.datetime):
-            return obj.replace(tzinfo=tzlocal()).isoformat()
-        if isinstance(obj, uuid.UUID):
-            return str(obj)
-
-        for key in obj.__dict__.keys():
-            if key.startswith("_"):
-                continue
-            val = obj.__dict__[key]
-            if val is None or not val:
+        return ptJsonEncoder.toNative(obj)
+
+    @staticmethod
+    def register(cls, converter, native=False):
+        """
+        Register converter(obj) returning json-serializable representation of the cls objects,
+        native=True means the converter returns json types only and the result is not walked through
+        """
+        ptJsonEncoder._converters[cls] = converter
+        if native:
+            ptJsonEncoder._native_converters.add(converter)
+        ptJsonEncoder._dispatch.clear()
+
+    @staticmethod
+    def _compile(cls, keys, skip):
+        code = ["def to_dict(d, JsonDict=JsonDict, prim=prim, native=native):",
+                "    j = JsonDict()"]
+        for key in keys:
+            if key.startswith("_") or key in skip:
                 continue
-            if type(val) == str:
-                try:
-                    val = val.decode(errors='ignore').encode('utf-8')
-                except AttributeError as e:
-                    pass
-            j[key] = val
-        return j
+            code += ["    v = d[%r]" % key,
+                     "    if v:",
+                     "        j[%r] = v if v.__class__ in prim else native(v)" % key]
+        code.append("    return j")
+
+        namespace = {'JsonDict': _JsonDict, 'prim': _JSON_PRIMITIVES, 'native': ptJsonEncoder.toNative}
+        exec("\n".join(code), namespace)
+        logging.debug("compiled json serializer for %s (%d members)" % (cls.__name__, len(keys)))
+        return namespace['to_dict']
+
+    @staticmethod
+    def toDict(obj, skip=()):
+        """Public non-empty members of the object (except skip) converted to json-serializable types"""
+        d = obj.__dict__
+        key = (obj.__class__, tuple(d), skip)
+        to_dict = ptJsonEncoder._compiled.get(key)
+        if to_dict is None:
+            with ptJsonEncoder._compile_lock:
+                to_dict = ptJsonEncoder._compile(obj.__class__, key[1], skip)
+                ptJsonEncoder._compiled[key] = to_dict
+        return to_dict(d)
+
+    @staticmethod
+    def _nativeList(obj):
+        return [v if v.__class__ in _JSON_PRIMITIVES else ptJsonEncoder.toNative(v) for v in obj]
+
+    @staticmethod
+    def _nativeDict(obj):
+        return _JsonDict((k, v if v.__class__ in _JSON_PRIMITIVES else ptJsonEncoder.toNative(v))
+                         for k, v in obj.items())
+
+    @staticmethod
+    def _getConverter(cls):
+        for c, converter in ptJsonEncoder._converters.items():
+            if issubclass(cls, c):
+                if converter in ptJsonEncoder._native_converters:
+                    return converter
+                return lambda obj: ptJsonEncoder.toNative(converter(obj))
+        if issubclass(cls, (list, tuple)):
+            return ptJsonEncoder._nativeList
+        if issubclass(cls, dict):
+            return ptJsonEncoder._nativeDict
+        for c in (int, float, str):
+            if issubclass(cls, c):
+                return c
+        return ptJsonEncoder._nativeObject
+
+    @staticmethod
+    def _nativeObject(obj):
+        if not hasattr(obj, '__dict__'):
+            raise TypeError("%s is not JSON serializable" % repr(obj))
+        return ptJsonEncoder.toDict(obj)
+
+    @staticmethod
+    def toNative(obj):
+        """Convert the object to the json-serializable types, lists and dicts are always copied"""
+        cls = obj.__class__
+        if cls in _JSON_PRIMITIVES:
+            return obj
+        converter = ptJsonEncoder._dispatch.get(cls)
+        if converter is None:
+            converter = ptJsonEncoder._getConverter(cls)
+            ptJsonEncoder._dispatch[cls] = converter
+        return converter(obj)
+
+    @staticmethod
+    def dumps(obj, native=False):
+        """
+        Compact json, the objects are converted by toNative() unless native=True. The orjson or ujson
+        encoders are used if installed
+        """
+        if not native:
+            obj = ptJsonEncoder.toNative(obj)
+        if _json_dumps is not None:
+            try:
+                return _json_dumps(obj)
+            except (TypeError, ValueError, OverflowError) as e:
+                logging.debug("fast json encoder failed, falling back to json: %s" % str(e))
+        return json.dumps(obj, separators=(',', ':'))
 
     @staticmethod
     def pretty(obj):
@@ -100,11 +290,26 @@ class ptJsonEncoder(json.JSONEncoder):
 
 
 class ptServer:
-    def __init__(self, pt_server_url=None):
+    def __init__(self, pt_server_url=None, pool_size=PT_SERVER_DEFAULT_POOL_SIZE,
+                 retries=PT_SERVER_DEFAULT_RETRIES, backoff_sec=PT_SERVER_DEFAULT_BACKOFF_SEC,
+                 timeout_sec=PT_SERVER_DEFAULT_TIMEOUT_SEC):
+        """
+        pool_size   - max number of keep-alive connections kept to the server (one per concurrent caller)
+        retries     - how many times to retry a request on connection errors, the idempotent requests (GET,
+                      DELETE, ...) are retried on read timeouts and 5xx responses too, POST and PATCH are not
+                      (the server may have committed it already)
+        backoff_sec - initial retry delay, doubled on every next attempt
+        timeout_sec - default per-call timeout (connect and read), can be overridden by the timeout= argument
+        """
         if pt_server_url is None:
             pt_server_url = PT_SERVER_DEFAULT_URL
         self.url = None
         self.api_url = None
+        self._pool_size = pool_size
+        self._retries = retries
+        self._backoff_sec = backoff_sec
+        self._timeout_sec = timeout_sec
+        self._session = None
         self.setUrl(pt_server_url)
 
     def setUrl(self, pt_server_url):
@@ -114,6 +319,48 @@ class ptServer:
         self.url = pt_server_url.rstrip("/")
         self.api_url = "%s/api/v%s" % (self.url, API_VER)
 
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self._pool_size))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    # the client side settings are private, so they are not serialized to the job json (see ptJsonEncoder)
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @property
+    def retries(self):
+        return self._retries
+
+    @property
+    def timeout_sec(self):
+        return self._timeout_sec
+
+    def setRetries(self, retries, backoff_sec=None):
+        self._retries = retries
+        if backoff_sec is not None:
+            self._backoff_sec = backoff_sec
+
+    def setTimeout(self, timeout_sec):
+        self._timeout_sec = timeout_sec
+
+    def setPoolSize(self, pool_size):
+        if pool_size == self._pool_size:
+            return
+        self._pool_size = pool_size
+        self.close()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
     def getProjectId(self, project_name):
         if not project_name:
             return None
@@ -122,7 +369,7 @@ class ptServer:
 
         if resp.status_code != httplib.OK:
             raise ptRuntimeException("can't get the list of existing projects: %d, %s" %
-                                     (j['http_status'], j.get('message', str(j))))
+                                     (resp.status_code, resp.json.get('message', str(resp.json))))
 
         for project_json in resp.json:
             if project_json['name'] == project_name:
@@ -132,32 +379,60 @@ class ptServer:
                          "available projects are: %s" % (", ".join(["'%s'" % p['name'] for p in resp.json]))])
         raise ptRuntimeException(msg)
 
+    def _send(self, method, url, headers, timeout, *args, **kwargs):
+        method = method.upper()
+        idempotent = method not in ("POST", "PATCH")
+        retry_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout) if idempotent else \
+            (requests.exceptions.ConnectionError,)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=timeout, *args, **kwargs)
+            except retry_errors as e:
+                if attempt >= self._retries:
+                    raise ptRuntimeException(str(e))
+                logging.warning("%s %s failed: %s, retrying..." % (method, url, str(e)))
+            except requests.exceptions.RequestException as e:
+                raise ptRuntimeException(str(e))
+            else:
+                if response.status_code < 500 or not idempotent or attempt >= self._retries:
+                    return response
+                logging.warning("%s %s status %d, retrying..." % (method, url, response.status_code))
+                response.close()
+
+            time.sleep(self._backoff_sec * (2 ** attempt))
+            attempt += 1
+
     def _http_request(self, method, url, decode_json=True, *args, **kwargs):
 
         url = "%s/%s" % (self.api_url, url.lstrip("/"))
 
         logging.debug("%s %s ..." % (method, url))
 
-        # FIXME: handle retry
         headers = {'Content-Type': 'application/json'} if method == "GET" else {}
-        try:
-            response = requests.__dict__[method](url, headers=headers, *args, **kwargs)
-        except requests.exceptions.ConnectionError as e:
-            raise ptRuntimeException(str(e))
+        headers.update(kwargs.pop('headers', {}))
+        timeout = kwargs.pop('timeout', self._timeout_sec)
+        ok_status = kwargs.pop('ok_status', (httplib.OK, httplib.PARTIAL_CONTENT))
+        response = self._send(method, url, headers, timeout, *args, **kwargs)
 
-        if decode_json or response.status_code != httplib.OK:
+        ok = response.status_code in ok_status
+
+        if decode_json or not ok:
             text = response.text.encode(response.encoding if response.encoding else 'utf-8', 'strict')
             text = text.decode('utf-8', 'strict')
             try:
                 j = json.loads(text)
                 response.json = j
             except ValueError as e:
-                raise ptRuntimeException("%s\nresponse:%s" % (str(e), str(text.encode('utf-8'))))
+                if decode_json:
+                    raise ptRuntimeException("%s\nresponse:%s" % (str(e), str(text.encode('utf-8'))))
 
-        if response.status_code == httplib.OK:
-            if logging.getLogger().getEffectiveLevel() >= logging.DEBUG:
+        if ok:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
                 if decode_json:
                     logging.debug("%s %s ... response:\n%s" % (method, url, ptJsonEncoder.pretty(j)))
+                elif kwargs.get('stream'):
+                    logging.debug("%s %s ... streaming response" % (method, url))
                 else:
                     logging.debug("%s %s ... response size %d" % (method, url, len(response.content)))
         else:
@@ -179,6 +454,92 @@ class ptServer:
         return self._http_request('patch', url, decode_json=decode_json, *args, **kwargs)
 
 
+class ptMultipartStream:
+    """
+    multipart/form-data request body which reads the file by chunks while the request is being sent, so the
+    memory usage doesn't depend on the file size. If compression is requested, the file is bz2-compressed
+    chunk by chunk into a temporary file first, so the exact Content-Length is always known (the server
+    doesn't accept the chunked transfer encoding).
+
+    progress_cb(done_bytes, total_bytes, bytes_per_sec) is called for every chunk sent, the bytes are counted
+    in the file being sent (i.e. in the compressed data if compression is requested)
+    """
+    def __init__(self, fields, filepath, filename, compression=False, chunk_size=PT_ARTIFACT_CHUNK_SIZE,
+                 progress_cb=None):
+        self.filepath = filepath
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.progress_cb = progress_cb
+        self.file_size = os.path.getsize(filepath)
+        self.sent_bytes = 0
+        self.duration_sec = 0
+
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % boundary
+
+        head = []
+        for name, value in fields.items():
+            if value is None:
+                continue
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value))
+        head.append('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n' % (boundary, filename.replace('"', '\\"')))
+        self._head = "".join(head).encode('utf-8')
+        self._tail = ("\r\n--%s--\r\n" % boundary).encode('utf-8')
+
+        self._compressed = self._compress() if compression else None
+        self.body_size = os.fstat(self._compressed.fileno()).st_size if compression else self.file_size
+
+        # requests takes the Content-Length from the 'len' attribute
+        self.len = len(self._head) + self.body_size + len(self._tail)
+
+    def _compress(self):
+        compressor = bz2.BZ2Compressor()
+        out = tempfile.TemporaryFile(prefix="pt-artifact-")
+        with open(self.filepath, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+        out.flush()
+        return out
+
+    def close(self):
+        if self._compressed:
+            self._compressed.close()
+            self._compressed = None
+
+    def __iter__(self):
+        # every iteration starts from scratch, so the request can be retried
+        ts = time.time()
+        self.sent_bytes = len(self._head)
+        yield self._head
+
+        done = 0
+        f = self._compressed if self._compressed else open(self.filepath, 'rb')
+        try:
+            f.seek(0)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                done += len(chunk)
+                self.sent_bytes += len(chunk)
+                yield chunk
+                if self.progress_cb:
+                    elapsed = time.time() - ts
+                    self.progress_cb(done, self.body_size, done / elapsed if elapsed else 0)
+        finally:
+            if f is not self._compressed:
+                f.close()
+
+        self.sent_bytes += len(self._tail)
+        self.duration_sec = time.time() - ts
+        yield self._tail
+
+
 class ptArtifact:
     def __init__(self, pt_server=None, uuid1=None, filename='', description='', ttl_days=180,
                  mime=None, inline=False, compression=False, linked_uuids=None, validate=True):
@@ -242,21 +603,15 @@ class ptArtifact:
 
         return self._pt_server.post(self._url, data=data)
 
-    def upload(self, filepath):
+    def upload(self, filepath, chunk_size=PT_ARTIFACT_CHUNK_SIZE, progress_cb=None):
+        """
+        Stream the file to the server, see ptMultipartStream for the progress_cb() details
+        """
         assert self.uuid is not None
 
         if not self.filename:
             self.filename = os.path.basename(filepath)
 
-        f = open(filepath, 'rb')
-        if self.compression:
-            data = bz2.compress(f.read())
-        else:
-            data = f.read()
-        f.close()
-
-        files = {'file': data}
-
         # FIXME: copy-paste
         data = {'description': self.description, 'ttl_days': self.ttl_days, 'mime': self.mime,
                 'filename': self.filename, 'inline': self.inline, 'compression': self.compression,
@@ -264,7 +619,17 @@ class ptArtifact:
                 'unlinked_uuids': json.dumps(list(self.unlinked_uuids))
                 }
 
-        return self._pt_server.post(self._url, files=files, data=data)
+        body = ptMultipartStream(data, filepath, self.filename, compression=self.compression,
+                                 chunk_size=chunk_size, progress_cb=progress_cb)
+        try:
+            resp = self._pt_server.post(self._url, data=body, headers={'Content-Type': body.content_type})
+        finally:
+            body.close()
+
+        self.size = body.file_size
+        logging.debug("%s: %d bytes uploaded (%d bytes sent) in %.1f sec" %
+                      (filepath, body.file_size, body.sent_bytes, body.duration_sec))
+        return resp
 
     def list(self, limit=10, offset=0):
         resp = self._pt_server.get(self._url_list)
@@ -291,21 +656,218 @@ class ptArtifact:
 
         return resp, ret
 
-    def download(self, filepath=None):
-        resp = self._pt_server.get(self._url_download, decode_json=False)
-        if resp.status_code == httplib.OK:
-            if filepath is not None:
-                f = open(filepath, 'wb')
-                f.write(resp.content)
-                f.close()
+    def download(self, filepath=None, fileobj=None, chunk_size=PT_ARTIFACT_CHUNK_SIZE, decompress=False,
+                 resume=True, progress_cb=None):
+        """
+        Download the artifact to filepath or fileobj chunk by chunk. If none of them is given,
+        the artifact content is returned in resp.content
+
+        decompress  - bz2-decompress the data on the fly (if it is compressed)
+        resume      - continue the download from the end of filepath + '.part' left by the interrupted download,
+                      resume the download if the connection breaks (if the server supports Range requests)
+        progress_cb - progress_cb(done_bytes, total_bytes, bytes_per_sec) is called for every chunk,
+                      total_bytes is 0 if unknown
+        """
+        if filepath is None and fileobj is None:
+            return self._pt_server.get(self._url_download, decode_json=False)
+
+        partpath = filepath + ".part" if filepath else None
+        offset = 0
+        if resume and partpath and os.path.exists(partpath) and not decompress:
+            offset = os.path.getsize(partpath)
+
+        ts = time.time()
+        done = 0
+        attempt = 0
+
+        while True:
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            ok_status = (httplib.OK, httplib.PARTIAL_CONTENT, httplib.REQUESTED_RANGE_NOT_SATISFIABLE) if offset \
+                else (httplib.OK, httplib.PARTIAL_CONTENT)
+            resp = self._pt_server.get(self._url_download, decode_json=False, stream=True, headers=headers,
+                                       ok_status=ok_status)
+
+            if resp.status_code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE and offset:
+                resp.close()
+                # 'Content-Range: bytes */<size>', the .part file is either complete or stale
+                size = resp.headers.get('Content-Range', '').rpartition('/')[2]
+                if size.isdigit() and int(size) == offset:
+                    resp.status_code = httplib.OK
+                    break
+                logging.warning("%s: %s (%d bytes) doesn't match the artifact size (%s), downloading from scratch" %
+                                (self.uuid, partpath, offset, size or "unknown"))
+                offset = 0
+                continue
+            if resp.status_code not in (httplib.OK, httplib.PARTIAL_CONTENT):
+                return resp
+            if resp.status_code == httplib.OK:
+                offset = 0  # Range is not supported, start from scratch
+
+            total = int(resp.headers.get('Content-Length', 0))
+            total = total + offset if total else 0
+            decompressor = bz2.BZ2Decompressor() if decompress else None
+
+            f = fileobj if fileobj else open(partpath, 'ab' if offset else 'wb')
+            try:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    offset += len(chunk)
+                    done += len(chunk)
+                    if decompressor:
+                        if done == len(chunk) and not chunk.startswith(b"BZh"):
+                            logging.debug("%s is not bz2-compressed, saving as is" % self.uuid)
+                            decompressor = None
+                        else:
+                            chunk = decompressor.decompress(chunk)
+                    f.write(chunk)
+                    if progress_cb:
+                        elapsed = time.time() - ts
+                        progress_cb(offset, total, done / elapsed if elapsed else 0)
+                break
+            except (requests.exceptions.RequestException, IOError) as e:
+                can_resume = partpath and not decompress and resp.headers.get('Accept-Ranges') == 'bytes'
+                if not can_resume or attempt >= self._pt_server.retries:
+                    raise ptRuntimeException("%s download failed: %s" % (self.uuid, str(e)))
+                attempt += 1
+                logging.warning("%s download interrupted at %d bytes, resuming: %s" % (self.uuid, offset, str(e)))
+            finally:
+                resp.close()
+                if f is not fileobj:
+                    f.close()
+
+        if partpath:
+            os.rename(partpath, filepath)
+            self.size = os.path.getsize(filepath)
+        else:
+            self.size = done
+
+        logging.debug("%s: %d bytes downloaded in %.1f sec" % (self.uuid, done, time.time() - ts))
         return resp
 
 
+PT_PROFILE_TOP = 10
+
+
+class ptProfiler:
+    """
+    cProfile stats collector: ptTest.run() iterations, ptTest.execute() python children (local shell only) and
+    ptBenchmark are profiled while the profiler is active. The top functions summary is appended to the test
+    description and the stats of all the tests are uploaded in one compressed artifact linked to the tests
+    """
+    active = None
+
+    def __init__(self, top=PT_PROFILE_TOP):
+        self.top = top
+        self._stats = OrderedDict()  # test uuid -> [test, pstats.Stats]
+        self._lock = threading.Lock()
+
+    def activate(self):
+        ptProfiler.active = self
+        return self
+
+    def deactivate(self):
+        if ptProfiler.active is self:
+            ptProfiler.active = None
+
+    def tests(self):
+        """The profiled tests"""
+        with self._lock:
+            return [test for test, _ in self._stats.values()]
+
+    def call(self, test, func, *args, **kwargs):
+        """Call the func under cProfile and add the stats to the test ones"""
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            prof.disable()
+            self.add(test, prof)
+
+    @staticmethod
+    def wrap_cmdline(cmdline, filename):
+        """Returns the python command line modified to save the cProfile stats to filename, None if not python"""
+        m = re.match(r"^\s*(\S*python[\d.]*)\s+((?:-m\s+)?[^-\s].*)$", cmdline)
+        if m and not m.group(2).startswith("-m cProfile"):
+            return "%s -m cProfile -o %s %s" % (m.group(1), pipes.quote(filename), m.group(2))
+        m = re.match(r"^\s*(\S+\.py)(\s.*)?$", cmdline)
+        if m:
+            return "%s -m cProfile -o %s %s" % (pipes.quote(sys.executable), pipes.quote(filename), cmdline.strip())
+        return None
+
+    def add(self, test, source):
+        """source - cProfile.Profile or the pstats file name"""
+        with self._lock:
+            key = str(test.uuid)
+            if key in self._stats:
+                self._stats[key][1].add(source)
+            else:
+                self._stats[key] = [test, pstats.Stats(source)]
+            stats = self._stats[key][1]
+            summary = self.summary(stats)
+
+        desc = test.description or ""
+        pos = desc.find("cProfile top ")
+        if pos >= 0:
+            desc = desc[:pos]
+        test.description = (desc.rstrip() + "\n\n" if desc.strip() else "") + summary
+
+    def summary(self, stats):
+        """Top functions by own time"""
+        rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:self.top]
+        lines = ["cProfile top %d functions by own time (total %.3f sec):" % (len(rows), stats.total_tt),
+                 "%9s %9s %9s  %s" % ("own sec", "cum sec", "calls", "function")]
+        for (filename, line, func), (cc, nc, tt, ct, callers) in rows:
+            if filename == "~":
+                name = func
+            else:
+                name = "%s:%d(%s)" % (os.path.join(*filename.split(os.sep)[-2:]), line, func)
+            lines.append("%9.3f %9.3f %9d  %s" % (tt, ct, nc, name))
+        return "\n".join(lines)
+
+    def save(self, filepath):
+        """Save the stats of every test as <test tag>-<test uuid>.pstats to the tar file, returns the tests uuids"""
+        with self._lock:
+            items = list(self._stats.items())
+
+        tmpdir = tempfile.mkdtemp(prefix="pt-profile-")
+        try:
+            with tarfile.open(filepath, "w") as tar:
+                for key, (test, stats) in items:
+                    name = "%s-%s.pstats" % (re.sub(r"[^\w.-]+", "_", str(test.tag)), key)
+                    path = os.path.join(tmpdir, name)
+                    stats.dump_stats(path)
+                    tar.add(path, arcname=name)
+                    os.unlink(path)
+        finally:
+            os.rmdir(tmpdir)
+        return [key for key, _ in items]
+
+    def upload(self, pt_server, ttl_days=180):
+        """Upload the stats of all the tests in one artifact linked to the tests, returns the ptArtifact or None"""
+        if not self._stats:
+            return None
+        fd, path = tempfile.mkstemp(prefix="pt-profile-", suffix=".tar")
+        os.close(fd)
+        try:
+            uuids = self.save(path)
+            a = ptArtifact(pt_server, filename="profile.tar", compression=True, ttl_days=ttl_days,
+                           description="cProfile stats of %d test(s)" % len(uuids), linked_uuids=uuids)
+            a.upload(path)
+        finally:
+            os.unlink(path)
+        with self._lock:
+            for key in uuids:
+                self._stats.pop(key, None)
+        logging.info("cProfile stats of %d test(s) uploaded, artifact %s" % (len(uuids), str(a.uuid)))
+        return a
+
+
 class ptTest:
     def __init__(self, tag=None, uuid1=None, group=None, binary=None, cmdline=None, description=None,
                  loops=None, scores=None, deviations=None, category=None, metrics="loops/sec",
                  links=None, attribs=None, less_better=False, errors=None, warnings=None,
-                 begin=None, end=None, duration_sec=0, status='SUCCESS', validate=True):
+                 begin=None, end=None, duration_sec=0, status='SUCCESS', compact=False, histogram=None,
+                 validate=True):
         """
         tag         - keyword used to match tests results in different suites: hdd sequential read
         group       - test group: memory, disk, cpu, ...)
@@ -329,8 +891,16 @@ class ptTest:
         end         - time when the test ended in datetime.datetime format
         duration_sec - test duration (sec)
         status      - test status: PASS, FAIL, SKIPPED, INPROGRESS, NOTSTARTED
+        compact     - keep scores and deviations in array('d') instead of lists (8 bytes per value),
+                      use it for the tests with millions of scores
+        histogram   - ptHistogram with the test samples (e.g. request latencies), its min, max, mean
+                      and percentiles are uploaded as the test attributes, see record()
+
+        Any attribute assignment marks the test as changed, so the next ptSuite.upload() re-sends it.
+        Use add_score(), add_scores() and add_deviation() to extend scores, in-place list changes are not tracked.
         """
 
+        self._dirty = True
         self.seq_num = None
         self.uuid = uuid1 if uuid1 else uuid.uuid1()
         self.tag = tag
@@ -338,9 +908,10 @@ class ptTest:
         self.binary = binary
         self.cmdline = cmdline
         self.description = description
-        self.scores = [pt_float(s) for s in scores] if scores else []
+        compact = compact or isinstance(scores, array)
+        self.scores = self._new_store(scores, compact)
         self.loops = loops
-        self.deviations = [pt_float(d) for d in deviations] if deviations else []
+        self.deviations = self._new_store(deviations, compact)
         self.category = category
         self.metrics = metrics
         self.links = links if links else {}
@@ -352,6 +923,7 @@ class ptTest:
         self.end = end if end else datetime.datetime.now()
         self.duration_sec = int(duration_sec)
         self.status = status
+        self.histogram = histogram
 
         self._auto_end = end
         self._auto_begin = begin
@@ -359,6 +931,11 @@ class ptTest:
         if validate:
             self.validate()
 
+    def __setattr__(self, name, value):
+        if not name.startswith("_"):
+            self.__dict__['_dirty'] = True
+        self.__dict__[name] = value
+
     def __eq__(self, other):
         assert isinstance(other, ptTest)
         attributes = ["tag", "group", "category", "metrics", "less_better"]
@@ -371,31 +948,65 @@ class ptTest:
         assert self.attribs is None or type(self.attribs) is dict
         assert self.errors is None or type(self.errors) is int or type(self.errors) is list
         assert self.warnings is None or type(self.warnings) is int or type(self.warnings) is list
-        assert self.scores is None or type(self.scores) is list
+        assert self.scores is None or type(self.scores) in (list, array)
         assert self.loops is None or type(self.loops) is int
-        assert self.deviations is None or type(self.deviations) is list
+        assert self.deviations is None or type(self.deviations) in (list, array)
         assert (self.deviations is None) or len(self.deviations) == 0 or \
                (self.scores is not None and len(self.scores) == len(self.deviations))
         assert self.begin is None or type(self.begin) is datetime.datetime
         assert self.end is None or type(self.end) is datetime.datetime
         assert self.duration_sec is None or type(self.duration_sec) is int
         assert self.status in TEST_STATUSES
+        assert self.histogram is None or isinstance(self.histogram, ptHistogram)
 
     def __repr__(self):
         return "ptTest('%s', group='%s', category='%s' scores=%s, duration_sec=%.1f, less_better=%s, status=%s)" % \
                (self.tag, self.group, self.category, str(self.scores),
                 self.duration_sec, str(self.less_better), self.status)
 
-    def execute(self, cmdline=None, shell=None, exc_on_err=False, log_file=None):
+    @contextlib.contextmanager
+    def sample(self, nodes, interval_sec=PT_SAMPLER_INTERVAL_SEC):
+        """
+        Sample the nodes (ptEnvNode or ptShell objects) cpu, memory, disk and network utilization while
+        the with-block runs, the per-node summaries are stored in the test attribs:
+
+            with test.sample([db_host, app_host]):
+                ...
+
+        see helpers.sampler.ptResourceSampler
+        """
+        samplers = []
+        for node in nodes or []:
+            if isinstance(node, ptEnvNode):
+                if not node._shell:
+                    logging.warning("env node %s: no ip or ssh user, can't sample it" % node.name)
+                    continue
+                samplers.append(ptResourceSampler(node._shell, name=node.name, interval_sec=interval_sec))
+            else:
+                samplers.append(ptResourceSampler(node, interval_sec=interval_sec))
+
+        for s in samplers:
+            s.start()
+        try:
+            yield samplers
+        finally:
+            for s in samplers:
+                s.stop().attach(self)
+            self._dirty = True
+
+    def execute(self, cmdline=None, shell=None, exc_on_err=False, log_file=None, sample=None,
+                sample_interval_sec=PT_SAMPLER_INTERVAL_SEC, profile=True):
         """
         Simple test executor:
         shell - Shell instance where to execute the test, keep None for local launch: '192.168.0.100'
         path - path to search tests (list): ['/tmp/tests', '/opt/tests/bin/']
+        sample - list of ptEnvNode (or ptShell) to sample the resources utilization on, see sample()
+        profile - run the python cmdline under cProfile if ptProfiler is active (--pt-profile)
         """
 
         if shell is None:
-            shell = ptShell()
-        if not (isinstance(shell, ptShell) or isinstance(shell, ptShellFromFile)):
+            shell = ptshell.ptShell()
+        if not (isinstance(shell, ptshell.ptShell) or isinstance(shell, ptshell.ptShellFromFile)):
             raise ptRuntimeException("shell argument must be an instance of the Shell class, got: " + str(type(shell)))
 
         if cmdline is None:
@@ -406,7 +1017,26 @@ class ptTest:
         if self._auto_begin is None:
             self.begin = datetime.datetime.now()
 
-        status, out, err = shell.execute(cmdline, raise_exc=exc_on_err)
+        profiler = ptProfiler.active if profile else None
+        profile_file = None
+        if profiler and isinstance(shell, ptshell.ptShell) and isinstance(shell.shell, citizenshell.LocalShell):
+            fd, profile_file = tempfile.mkstemp(prefix="pt-profile-", suffix=".pstats")
+            os.close(fd)
+            wrapped = profiler.wrap_cmdline(cmdline, profile_file)
+            if wrapped:
+                cmdline = wrapped
+            else:
+                os.unlink(profile_file)
+                profile_file = None
+
+        try:
+            with self.sample(sample, interval_sec=sample_interval_sec):
+                status, out, err = shell.execute(cmdline, raise_exc=exc_on_err)
+        finally:
+            if profile_file:
+                if os.path.getsize(profile_file):
+                    profiler.add(self, profile_file)
+                os.unlink(profile_file)
         if log_file:
             logging.debug("Storing the output to: %s" % log_file)
             lf = open(log_file, "a")
@@ -423,15 +1053,144 @@ class ptTest:
 
         return status, out, err
 
+    def run(self, func=None, cmdline=None, shell=None, parse_score=None, target_ci=0.02, confidence=0.95,
+            min_iterations=3, max_iterations=30, max_duration_sec=None):
+        """
+        Adaptive test runner: repeat the test iterations until the relative half-width of the mean score
+        confidence interval drops below target_ci (0.02 means +/- 2%), but at least min_iterations times
+        and at most max_iterations times or max_duration_sec.
+
+        func        - one iteration callable, returns the score (or list of scores) or None if it adds them itself.
+                      If ptProfiler is active (--pt-profile), one more iteration runs under cProfile after
+                      the scored ones and its scores are dropped, so the profiler overhead doesn't skew them
+        cmdline     - if func is not given, execute() the cmdline (self.cmdline by default) on the shell...
+        parse_score - ... and get the score from the stdout by parse_score(stdout)
+        confidence  - 0.90, 0.95 or 0.99
+
+        The confidence interval half-width achieved by every iteration is recorded in deviations.
+        Returns the achieved relative half-width, None if it can't be calculated
+        """
+        if func is None:
+            if parse_score is None:
+                raise ptRuntimeException("run() must be supplied with either 'func' or 'parse_score' argument")
+
+            def func(profile=False):
+                status, out, err = self.execute(cmdline, shell=shell, exc_on_err=True, profile=profile)
+                return parse_score(out)
+
+            profiled_func = functools.partial(func, profile=True)
+        elif ptProfiler.active:
+            profiled_func = functools.partial(ptProfiler.active.call, self, func)
+        profiler = ptProfiler.active
+
+        ts = time.time()
+        rel_ci = None
+        for n in range(1, max_iterations + 1):
+            score = func()
+            if score is not None:
+                self.add_score(score)
+
+            hw = ci_halfwidth(self.scores, confidence)
+            while len(self.deviations) < len(self.scores):
+                self.deviations.append(pt_float(hw) if hw else 0)
+            self._dirty = True
+
+            rel_ci = rel_ci_halfwidth(self.scores, confidence)
+            logging.debug("%s: iteration %d, score %s, CI +/- %s" %
+                          (self.tag, n, str(score), "%.2f%%" % (rel_ci * 100) if rel_ci is not None else "n/a"))
+
+            if n >= min_iterations and rel_ci is not None and rel_ci <= target_ci:
+                break
+            if max_duration_sec and time.time() - ts >= max_duration_sec:
+                logging.info("%s: stopped by the %s sec time limit" % (self.tag, str(max_duration_sec)))
+                break
+
+        logging.info("%s: %d iteration(s), CI +/- %s (target %.1f%%)" %
+                     (self.tag, n, "%.1f%%" % (rel_ci * 100) if rel_ci is not None else "n/a", target_ci * 100))
+
+        if profiler:
+            logging.debug("%s: profiling one more iteration" % self.tag)
+            scores = len(self.scores)
+            profiled_func()
+            del self.scores[scores:]
+        return rel_ci
+
+    @staticmethod
+    def _new_store(values, compact):
+        if not values:
+            return array('d') if compact else []
+        return ptTest._floats(values, compact)
+
+    @staticmethod
+    def _floats(values, compact):
+        if compact:
+            return pt_floats(values)
+        if len(values) < PT_FLOATS_NUMPY_MIN or not get_numpy():
+            return [pt_float(v) for v in values]  # keep ints for the large values
+        return pt_floats(values).tolist()
+
     def add_score(self, score):
-        if isinstance(score, list):
-            for s in score:
-                self.scores.append(pt_float(s))
-        else:
-            self.scores.append(pt_float(score))
+        if isinstance(score, (list, array)):
+            return self.add_scores(score)
+        self.scores.append(pt_float(score))
+        self._dirty = True
+
+    def add_scores(self, scores):
+        """Add a batch of scores (any iterable), much faster than add_score() in a loop"""
+        scores = scores if hasattr(scores, '__len__') else list(scores)
+        self.scores.extend(self._floats(scores, isinstance(self.scores, array)))
+        self._dirty = True
+
+    def clean_scores(self, warmup=True, outliers="mad"):
+        """
+        Drop the warm-up iterations and outliers ('mad', 'iqr' or None) from scores (and deviations),
+        the raw and cleaned scores mean and stdev, the number of dropped warm-up iterations and outliers
+        are stored in attribs. Returns helpers.stats.describe() of the raw scores
+        """
+        d = describe(self.scores, warmup=warmup, outliers=outliers)
+        if not d['warmup'] and not d['outliers']:
+            return d
+
+        mask = _clean_mask(self.scores, d['warmup'], outliers)
+        compact = isinstance(self.scores, array)
+        self.scores = self._new_store([v for v, keep in zip(self.scores, mask) if keep], compact)
+        if len(self.deviations):
+            self.deviations = self._new_store([v for v, keep in zip(self.deviations, mask) if keep], compact)
+
+        for kind in ('raw', 'clean'):
+            for name in ('mean', 'stdev'):
+                self.attribs["%s %s" % (kind, name)] = pt_float(d[kind][name])
+        self.attribs['warm-up iterations'] = d['warmup']
+        self.attribs['outliers'] = d['outliers']
+        return d
 
     def add_deviation(self, dev):
-        self.scores.append(pt_float(dev))
+        self.deviations.append(pt_float(dev))
+        self._dirty = True
+
+    def record(self, value, count=1):
+        """
+        Record a sample into the test histogram (created on the first call), it costs O(1) time and
+        memory regardless of the number of samples, unlike add_score()
+        """
+        if self.histogram is None:
+            self.histogram = ptHistogram()
+        self.histogram.record(value, count)
+        self._dirty = True
+
+    def add_histogram(self, histogram):
+        """Merge the histogram (e.g. recorded by another thread or process) into the test histogram"""
+        if self.histogram is None:
+            self.histogram = ptHistogram(resolution=histogram.resolution, bits=histogram.bits, unit=histogram.unit)
+        self.histogram.merge(histogram)
+        self._dirty = True
+
+    def _update_histogram_attribs(self):
+        if not self.histogram:
+            return
+        unit = " (%s)" % self.histogram.unit if self.histogram.unit else ""
+        for name, val in self.histogram.getStats().items():
+            self.attribs[name + unit] = pt_float(val)
 
     def add_artifact(self, artifact):
         assert isinstance(artifact, ptArtifact)
@@ -441,8 +1200,13 @@ class ptTest:
 class ptEnvNode:
     def __init__(self, name=None, version=None, node_type=None, ip=None, hostname=None, params=None,
                  cpus=0, cpus_topology=None, cpu_info=None, ram_info=None,
-                 ram_mb=0, ram_gb=0, disk_gb=0, links=None, scan_info=False,
+                 ram_mb=0, ram_gb=0, disk_gb=0, links=None, scan_info=False, defer_scan=False,
                  ssh_user=None, ssh_password=None, validate=True):
+        """
+        scan_info  - fill in the not specified attributes (hostname, cpus, ram, ...) by the info from the node
+        defer_scan - don't scan the node in the constructor, ptSuite.scanEnvironment() (or upload()) scans all
+                     the deferred nodes in parallel
+        """
         self.name = name
         self.version = version
         self.node_type = node_type
@@ -468,27 +1232,45 @@ class ptEnvNode:
         self.children = []  # start with x to show children in the end of prettified json
 
         self._scan_info = scan_info
-        if self._scan_info and self._shell:
-            if not self.hostname:
-                self.hostname = self._shell.os_info.hostname
-            if not self.ram_mb:
-                self.ram_mb = int(round(self._shell.hw_info.ram_kb / 1024, 0))
-            if not self.cpus:
-                self.cpus = self._shell.hw_info.cpu_count
-            if not self.cpus_topology:
-                self.cpus_topology = self._shell.hw_info.cpu_topology
-            if not self.cpu_info:
-                self.cpu_info = "%s @ %.1fGHz" % (self._shell.hw_info.cpu_model, self._shell.hw_info.cpu_freq_ghz)
-            if not self.version:
-                self.version = "%s %s" % (self._shell.os_info.family, self._shell.os_info.version)
+        self._scanned = False
+        if self._scan_info and not defer_scan:
+            self.scan()
+
+    def scan(self):
+        """Fill in the node attributes which were not specified by the info from the node shell"""
+        if self._scanned or not self._shell:
+            return self
+
+        if not self.hostname:
+            self.hostname = self._shell.os_info.hostname
+        if not self.ram_mb:
+            self.ram_mb = int(round(self._shell.hw_info.ram_kb / 1024, 0))
+        if not self.cpus:
+            self.cpus = self._shell.hw_info.cpu_count
+        if not self.cpus_topology:
+            self.cpus_topology = self._shell.hw_info.cpu_topology
+        if not self.cpu_info:
+            self.cpu_info = "%s @ %.1fGHz" % (self._shell.hw_info.cpu_model, self._shell.hw_info.cpu_freq_ghz)
+        if not self.version:
+            self.version = "%s %s" % (self._shell.os_info.family, self._shell.os_info.version)
+
+        self._scanned = True
+        return self
+
+    def _shellKey(self):
+        """The nodes with the same key share one shell (and one ssh connection)"""
+        if self.ip in (None, "127.0.0.1", "localhost"):
+            return ("localhost", None)
+        if self.ssh_user:
+            return (self.ip, self.ssh_user)
+        return None
 
     @cached_property
     def _shell(self):
         if self.ip in (None, "127.0.0.1", "localhost"):
-            return ptShell(citizenshell.LocalShell())
+            return ptshell.ptShell(citizenshell.LocalShell())
         if self.ssh_user:
-            return ptShell(
-                citizenshell.SecureShell(hostname=self.ip, username=self.ssh_user, password=self.ssh_password))
+            return ptshell.ptShell.ssh(self.ip, self.ssh_user, password=self.ssh_password)
         return None
 
     def validate(self):
@@ -505,20 +1287,28 @@ class ptEnvNode:
 
 
 class ptHost(ptEnvNode):
-    def __init__(self, name=None, model=None, hw_uuid=None, serial_num=None, numa_nodes=None, **kwargs):
-        ptEnvNode.__init__(self, name=name, **kwargs)
+    def __init__(self, name=None, model=None, hw_uuid=None, serial_num=None, numa_nodes=None, defer_scan=False,
+                 **kwargs):
+        ptEnvNode.__init__(self, name=name, defer_scan=True, **kwargs)
         self.node_type = "Host"
         self.model = model
         self.hw_uuid = hw_uuid
         self.serial_num = serial_num
 
-        if self._scan_info and self._shell:
-            if not self.model:
-                self.model = self._shell.hw_info.model
-            if not self.hw_uuid:
-                self.hw_uuid = self._shell.hw_info.uuid
-            if not self.serial_num:
-                self.serial_num = self._shell.hw_info.serial
+        if self._scan_info and not defer_scan:
+            self.scan()
+
+    def scan(self):
+        if self._scanned or not self._shell:
+            return self
+
+        if not self.model:
+            self.model = self._shell.hw_info.model
+        if not self.hw_uuid:
+            self.hw_uuid = self._shell.hw_info.uuid
+        if not self.serial_num:
+            self.serial_num = self._shell.hw_info.serial
+        return ptEnvNode.scan(self)
 
 
 class ptVM(ptEnvNode):
@@ -544,12 +1334,345 @@ class ptProduct:
         self.version = str(version)
 
 
+class ptUploader:
+    """
+    Background job uploader. ptSuite.upload() puts a snapshot of the job into the queue and returns,
+    the uploader thread merges all the snapshots queued within interval_sec into a single POST
+    """
+    def __init__(self, suite, interval_sec=5.0, flush_timeout_sec=60):
+        assert isinstance(suite, ptSuite)
+        self.interval_sec = interval_sec
+        self.flush_timeout_sec = flush_timeout_sec
+
+        self.snapshots = 0
+        self.uploads = 0
+        self.failures = 0
+        self.last_latency_sec = 0
+        self.max_latency_sec = 0
+        self._total_latency_sec = 0
+
+        self._suite = suite
+        self._queue = []
+        self._pending = None  # merged snapshot which failed to upload, retried on the next round
+        self._busy = False
+        self._flush = False
+        self._stop = False
+        self._need_full = False
+        self._last_upload_ts = 0
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name="ptUploader")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    @property
+    def queue_depth(self):
+        return len(self._queue) + (1 if self._pending else 0)
+
+    @property
+    def avg_latency_sec(self):
+        return self._total_latency_sec / self.uploads if self.uploads else 0
+
+    @property
+    def need_full(self):
+        return self._need_full
+
+    @property
+    def stopped(self):
+        return self._stop
+
+    def getStats(self):
+        return {'queue_depth': self.queue_depth, 'snapshots': self.snapshots, 'uploads': self.uploads,
+                'failures': self.failures, 'last_latency_sec': self.last_latency_sec,
+                'avg_latency_sec': self.avg_latency_sec, 'max_latency_sec': self.max_latency_sec}
+
+    def put(self, snapshot):
+        with self._cond:
+            if snapshot['delta'] is False:
+                self._need_full = False
+            self._queue.append(snapshot)
+            self.snapshots += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout_sec=None):
+        """Wait till all the queued snapshots are uploaded, returns False on timeout"""
+        if timeout_sec is None:
+            timeout_sec = self.flush_timeout_sec
+        deadline = time.time() + timeout_sec
+        with self._cond:
+            self._flush = True
+            self._cond.notify_all()
+            while (self._queue or self._pending or self._busy) and self._thread.is_alive():
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            self._flush = False
+            return not (self._queue or self._pending or self._busy)
+
+    def stop(self, timeout_sec=None):
+        if self._stop:
+            return
+        if not self.flush(timeout_sec):
+            logging.error("ptUploader: %d job snapshot(s) were not uploaded" % self.queue_depth)
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        logging.info("ptUploader: %d snapshots, %d uploads, %d failures, latency avg %.3f, max %.3f sec" %
+                     (self.snapshots, self.uploads, self.failures, self.avg_latency_sec, self.max_latency_sec))
+
+    @staticmethod
+    def merge(merged, snapshot):
+        if merged is None or not snapshot['delta']:
+            # a full snapshot already includes all the tests
+            return snapshot
+        header = snapshot['header']
+        if not merged['delta']:
+            header = OrderedDict(header)
+            header.pop('append', None)
+            for key in ('append', 'replace'):
+                if key in merged['header']:
+                    header[key] = merged['header'][key]
+        tests = merged['tests']
+        tests.update(snapshot['tests'])
+        return {'delta': merged['delta'], 'header': header, 'tests': tests, 'seq': snapshot.get('seq')}
+
+    @staticmethod
+    def toJson(snapshot):
+        j = OrderedDict(snapshot['header'])
+        if snapshot['tests']:
+            j['tests'] = list(snapshot['tests'].values())
+        return ptJsonEncoder.dumps(j, native=True)
+
+    def _upload(self, snapshot):
+        ts = time.time()
+        try:
+            response = self._suite._post(self.toJson(snapshot))
+        except ptRuntimeException as e:
+            logging.error("ptUploader: job json upload failed: %s" % str(e))
+            return False
+
+        latency = time.time() - ts
+        if response.status_code != httplib.OK:
+            logging.error("ptUploader: job json upload failed, status %d, %s" %
+                          (response.status_code, response.text))
+            if snapshot['delta'] and response.status_code < 500:
+                # the next ptSuite.upload() will take a full snapshot
+                logging.warning("ptUploader: delta upload rejected, requesting full upload")
+                self._suite._uploaded = False
+                self._need_full = True
+                return None
+            return False
+
+        if snapshot.get('seq') is not None and self._suite._spool:
+            self._suite._spool.ack(self._suite.uuid, snapshot['seq'])
+
+        self.uploads += 1
+        self.last_latency_sec = latency
+        self.max_latency_sec = max(self.max_latency_sec, latency)
+        self._total_latency_sec += latency
+        logging.debug("ptUploader: job json uploaded (%d tests) in %.3f sec" % (len(snapshot['tests']), latency))
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._pending and not self._stop:
+                    self._cond.wait()
+                if self._stop and not self._queue and not self._pending:
+                    return
+                # coalesce the snapshots coming within the interval, flush() doesn't wait for it unless the
+                # previous upload failed (so a dead server isn't hammered)
+                deadline = self._last_upload_ts + self.interval_sec
+                while time.time() < deadline and (not self._flush or self._pending) and not self._stop:
+                    self._cond.wait(deadline - time.time())
+                if self._stop:
+                    return
+                snapshots, self._queue = self._queue, []
+                self._busy = True
+
+            merged = self._pending
+            for snapshot in snapshots:
+                merged = self.merge(merged, snapshot)
+
+            ret = self._upload(merged)
+            self._last_upload_ts = time.time()
+
+            with self._cond:
+                if ret is False:
+                    self.failures += 1
+                    self._pending = merged
+                else:
+                    self._pending = None
+                self._busy = False
+                self._cond.notify_all()
+
+
+class ptSpool:
+    """
+    Durable append-only journal of the job snapshots, so results are not lost when the server is down.
+    Every process writes its own <job uuid>.<pid>.spool file in spool_dir, one json record per line:
+        {"seq": N, "project": "project name", "snapshot": {...}} - the snapshot taken by ptSuite.upload()
+        {"ack": N}                                                - records up to N are uploaded
+    The file is fsync-ed every fsync_records records or fsync_interval_sec, whatever comes first, and
+    removed once its last record is uploaded. Use replay() or pt-suite-uploader.py --replay-spool to
+    upload the rest
+    """
+    suffix = ".spool"
+
+    def __init__(self, spool_dir, fsync_records=16, fsync_interval_sec=1.0):
+        self.spool_dir = spool_dir
+        self.fsync_records = fsync_records
+        self.fsync_interval_sec = fsync_interval_sec
+
+        self._files = {}  # job uuid -> [file or None, last seq, acked seq, unsynced records, last fsync ts]
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+    def _path(self, job_uuid, pid=None):
+        return os.path.join(self.spool_dir, "%s.%d%s" % (job_uuid, os.getpid() if pid is None else pid,
+                                                         self.suffix))
+
+    def _write(self, job_uuid, record):
+        job_uuid = str(job_uuid)
+        if job_uuid not in self._files:
+            self._files[job_uuid] = [None, 0, 0, 0, time.time()]
+        f = self._files[job_uuid]
+        if f[0] is None:
+            f[0] = open(self._path(job_uuid), 'a')
+        f[0].write(ptJsonEncoder.dumps(record, native=True) + "\n")
+        f[0].flush()
+        f[3] += 1
+        if f[3] >= self.fsync_records or time.time() - f[4] >= self.fsync_interval_sec:
+            os.fsync(f[0].fileno())
+            f[3] = 0
+            f[4] = time.time()
+        return f
+
+    def append(self, job_uuid, project_name, snapshot):
+        """Store the snapshot, returns its sequence number to be passed to ack()"""
+        with self._lock:
+            f = self._files.get(str(job_uuid))
+            seq = f[1] + 1 if f else 1
+            f = self._write(job_uuid, OrderedDict([('seq', seq), ('project', project_name),
+                                                   ('snapshot', snapshot)]))
+            f[1] = seq
+            return seq
+
+    def ack(self, job_uuid, seq):
+        """Mark all the records up to seq as uploaded"""
+        with self._lock:
+            f = self._files.get(str(job_uuid))
+            if f is None or seq <= f[2]:
+                return
+            f[2] = seq
+            if seq >= f[1]:
+                # everything is uploaded, start from scratch
+                if f[0] is not None:
+                    f[0].close()
+                os.unlink(self._path(job_uuid))
+                del self._files[str(job_uuid)]
+            else:
+                self._write(job_uuid, {'ack': seq})
+
+    def pending(self):
+        """Number of records which are not uploaded yet"""
+        with self._lock:
+            return sum([f[1] - f[2] for f in self._files.values()])
+
+    def close(self):
+        """Sync and close the spool files, returns the number of closed files"""
+        closed = 0
+        with self._lock:
+            for f in self._files.values():
+                if f[0] is not None:
+                    os.fsync(f[0].fileno())
+                    f[0].close()
+                    f[0] = None
+                    f[3] = 0
+                    closed += 1
+        return closed
+
+    def files(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        files = [os.path.join(self.spool_dir, f) for f in os.listdir(self.spool_dir) if f.endswith(self.suffix)]
+        return sorted(files, key=os.path.getmtime)
+
+    @staticmethod
+    def load(path):
+        """Merge not uploaded records of a spool file, returns (project name, snapshot)"""
+        records = []
+        acked = 0
+        with open(path) as f:
+            for line in f:
+                try:
+                    r = json.loads(line, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    logging.warning("%s: skipping corrupted record: %s" % (path, line[:80]))
+                    continue
+                if 'ack' in r:
+                    acked = max(acked, r['ack'])
+                else:
+                    records.append(r)
+
+        project_name = None
+        merged = None
+        for r in records:
+            if r['seq'] <= acked:
+                continue
+            project_name = r['project']
+            merged = ptUploader.merge(merged, r['snapshot'])
+        return project_name, merged
+
+    def replay(self, pt_server, paths=None):
+        """Upload and remove the spool files, returns (number of uploaded jobs, number of failed jobs)"""
+        assert isinstance(pt_server, ptServer)
+
+        uploaded = 0
+        failed = 0
+        project_ids = {}
+
+        for path in (self.files() if paths is None else paths):
+            project_name, snapshot = self.load(path)
+            if snapshot is None:
+                os.unlink(path)
+                continue
+
+            try:
+                if project_name not in project_ids:
+                    project_ids[project_name] = pt_server.getProjectId(project_name)
+                response = pt_server.post('%d/job/' % project_ids[project_name], decode_json=False,
+                                          data=ptUploader.toJson(snapshot))
+            except ptRuntimeException as e:
+                logging.error("%s: replay failed: %s" % (path, str(e)))
+                failed += 1
+                continue
+
+            if response.status_code != httplib.OK:
+                logging.error("%s: replay failed, status %d, %s" % (path, response.status_code, response.text))
+                failed += 1
+                continue
+
+            logging.info("%s: job %s uploaded (%d tests)" % (path, snapshot['header'].get('uuid'),
+                                                             len(snapshot['tests'])))
+            os.unlink(path)
+            uploaded += 1
+
+        return uploaded, failed
+
+
 class ptSuite:
     def __init__(self, job_title='job title', project_name=None, cmdline=None,
                  product_name=None, product_ver=None, regression_name=None,
                  suite_name=None, suite_ver=None,
                  uuid1=None, append=False, replace=False, begin=None, end=None, links=None,
-                 pt_server_url=PT_SERVER_DEFAULT_URL, save_to_file=None):
+                 pt_server_url=PT_SERVER_DEFAULT_URL, save_to_file=None, delta_upload=True,
+                 async_upload=False, upload_interval_sec=5.0, upload_flush_timeout_sec=60,
+                 spool_dir=None, spool_only=False, profile=False):
         """
         job_name   - job title on portal: '[disk tests] KVM 2.6.32'
         suite_name - suite name to filter/search: 'disk tests'
@@ -557,6 +1680,14 @@ class ptSuite:
         append     - set to True to append data to existing job data with given uuid
         begin      - time when job started (must have the datetime.datetime type)
         end        - time when job ended (must have the datetime.datetime type)
+        delta_upload - after the first successful upload() send only new or changed tests (in append mode)
+        async_upload - upload() doesn't wait for the server, the job is uploaded by a background thread
+                       which merges the upload() calls made within upload_interval_sec into one request.
+                       fini() waits up to upload_flush_timeout_sec till all the data is uploaded
+        spool_dir  - upload() stores the results to the on-disk spool first, so the results which failed to
+                     upload can be replayed later by pt-suite-uploader.py --replay-spool
+        spool_only - don't upload anything, just store the results to the spool
+        profile    - activate ptProfiler: profile the tests and upload the stats in one artifact by fini()
         """
 
         self._seq_num = 0
@@ -579,6 +1710,7 @@ class ptSuite:
         self.end = end if end else datetime.datetime.now()
 
         self.env_nodes = []
+        self._env_scanned = False
         self.links = links if links else {}
 
         self._id2node = {}
@@ -589,11 +1721,23 @@ class ptSuite:
         self.pt_server = ptServer(pt_server_url)
         self._save_to_file = save_to_file
         self._pt_options_added = False
+        self._delta_upload = delta_upload
+        self._uploaded = False
+        self._async_upload = async_upload
+        self._upload_interval_sec = upload_interval_sec
+        self._upload_flush_timeout_sec = upload_flush_timeout_sec
+        self._uploader = None
+        self._spool = None
+        self._spool_only = spool_only
+        if spool_dir:
+            self.setSpool(spool_dir)
 
         self._stdout_filename = None
         self._stderr_filename = None
         self._stdout_artifact = None
         self._stderr_artifact = None
+        self._profiler = ptProfiler().activate() if profile else None
+        self._log_ttl_days = 180
 
         self.validate()
 
@@ -607,6 +1751,74 @@ class ptSuite:
         self.env_nodes.append(node)
         return node
 
+    def getNodes(self):
+        """All the environment nodes, parents go first"""
+        nodes = []
+        stack = list(reversed(self.env_nodes))
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def scanEnvironment(self, parallel=PT_ENV_SCAN_PARALLEL, timeout=PT_ENV_SCAN_TIMEOUT_SEC):
+        """
+        Scan the nodes created with scan_info=True, defer_scan=True on a pool of 'parallel' threads.
+        The nodes with the same ip and ssh user share one shell (and one pooled ssh session).
+        A host scan which takes longer than 'timeout' seconds is abandoned, so a dead host doesn't stall
+        the job. Returns the number of the scanned nodes
+        """
+        self._env_scanned = True
+
+        hosts = OrderedDict()
+        for node in self.getNodes():
+            if node._scan_info and not node._scanned:
+                key = node._shellKey()
+                if key is None:
+                    logging.debug("env node %s: no ip or ssh user, skipping scan" % node.name)
+                    continue
+                hosts.setdefault(key, []).append(node)
+        if not hosts:
+            return 0
+
+        def _scan(nodes, errors):
+            try:
+                shell = nodes[0]._shell
+                for node in nodes:
+                    node.__dict__['_shell'] = shell
+                    node.scan()
+            except Exception as e:
+                errors.append(e)
+
+        pending = list(hosts.items())
+        running = []
+        scanned = 0
+        while pending or running:
+            while pending and len(running) < parallel:
+                key, nodes = pending.pop(0)
+                errors = []
+                t = threading.Thread(target=_scan, args=(nodes, errors), name="ptEnvScan %s" % key[0])
+                t.daemon = True
+                t.start()
+                running.append((t, key, nodes, errors, time.time()))
+
+            running[0][0].join(0.05)
+
+            for r in list(running):
+                t, key, nodes, errors, started = r
+                if t.is_alive():
+                    if time.time() - started < timeout:
+                        continue
+                    logging.warning("env scan of %s has timed out after %d sec, nodes: %s" %
+                                    (key[0], timeout, ", ".join(str(n.name) for n in nodes)))
+                elif errors:
+                    logging.warning("env scan of %s failed: %s" % (key[0], str(errors[0])))
+                else:
+                    scanned += len(nodes)
+                running.remove(r)
+
+        return scanned
+
     def addLink(self, name, url):
         """
         name    - link name: 'monitoring dashboard'
@@ -640,7 +1852,7 @@ class ptSuite:
             self._key2test[key] = test
         elif added_test == test:
             # TODO add_deviations
-            added_test.add_score(test.scores)
+            added_test.add_scores(test.scores)
         else:
             raise ptRuntimeException("ptTest with received tag, group, category already exists, but other "
                                      "attributes differs")
@@ -684,6 +1896,8 @@ class ptSuite:
                     _initFromJson(new_obj, json_obj[el_name])
                 elif type(member) is datetime.datetime:
                     obj.__dict__[el_name] = json_obj[el_name]
+                elif type(member) is array:
+                    obj.__dict__[el_name] = array(member.typecode, json_obj[el_name])
                 elif type(member) is dict:
                     try:
                         obj.__dict__[el_name] = dict(json_obj[el_name])
@@ -699,14 +1913,22 @@ class ptSuite:
         return self._key2test.get(key, None)
 
     def toJson(self, pretty=False):
+        for t in self.tests:
+            t._update_histogram_attribs()
         if pretty:
-            return json.dumps(self, cls=ptJsonEncoder, indent=4, separators=(',', ': '))
-        return json.dumps(self, cls=ptJsonEncoder)
+            return json.dumps(ptJsonEncoder.toNative(self), indent=4, separators=(',', ': '))
+        return ptJsonEncoder.dumps(self)
 
     def validateProjectName(self):
-        if not self.project_name:
+        if not self.project_name or self._spool_only:
+            return
+        try:
+            self.project_id = self.pt_server.getProjectId(self.project_name)
+        except ptRuntimeException as e:
+            if not self._spool:
+                raise
+            logging.warning("%s, the results will be kept in the %s spool" % (str(e), self._spool.spool_dir))
             return
-        self.project_id = self.pt_server.getProjectId(self.project_name)
         if self.project_id is None:
             sys.exit(-1)
 
@@ -719,15 +1941,17 @@ class ptSuite:
                 logging.warning("%s, pass it as ptSuite(..., project_name=, ...)" % msg)
             return
 
-        if not self.project_id:
+        if not self._env_scanned:
+            self.scanEnvironment()
+
+        if not self.project_id and not self._spool_only:
             self.validateProjectName()
 
         if self._auto_end is None:
             self.end = datetime.datetime.now()
 
-        json_prettified = self.toJson(pretty=True)
-
         if self._save_to_file:
+            json_prettified = self.toJson(pretty=True)
             if self._save_to_file == "-":
                 print("Job json:")
                 print(json_prettified)
@@ -737,19 +1961,105 @@ class ptSuite:
                 logging.info("saving json data to %s" % self._save_to_file)
             return True
 
-        json_data = self.toJson()
-
-        logging.debug("posting data to %s:\n%s" % ('/%d/job/' % self.project_id, json_prettified))
+        delta = self._delta_upload and self._uploaded
+        tests = [t for t in self.tests if t._dirty] if delta else list(self.tests)
+        for t in tests:
+            t._dirty = False
+
+        async_upload = self._async_upload and not (self._uploader and self._uploader.stopped)
+
+        j = self._getUploadDict(tests, delta)
+
+        snapshot = None
+        if self._spool or async_upload:
+            snapshot = self._getUploadSnapshot(j, delta)
+        if self._spool:
+            snapshot['seq'] = self._spool.append(self.uuid, self.project_name, snapshot)
+            if self._spool_only:
+                self._uploaded = True
+                return True
+
+        if async_upload:
+            if self._uploader is None:
+                self._uploader = ptUploader(self, interval_sec=self._upload_interval_sec,
+                                            flush_timeout_sec=self._upload_flush_timeout_sec)
+            self._uploader.put(snapshot)
+            self._uploaded = True
+            return True
 
-        response = self.pt_server.post('%d/job/' % self.project_id, decode_json=False, data=json_data)
+        try:
+            response = self._post(ptJsonEncoder.dumps(j, native=True))
+            if delta and response.status_code != httplib.OK:
+                logging.warning("delta upload rejected, status %d, falling back to full upload" %
+                                response.status_code)
+                response = self._post(self._getUploadJson(self.tests, False))
+        except ptRuntimeException as e:
+            for t in tests:
+                t._dirty = True
+            if self._spool:
+                logging.warning("job json upload failed, the results are kept in the %s spool: %s" %
+                                (self._spool.spool_dir, str(e)))
+                return False
+            raise
 
         if response.status_code != httplib.OK:
+            for t in tests:
+                t._dirty = True
             logging.error("job json upload failed, status %d, %s" % (response.status_code, response.text))
+            if self._spool:
+                logging.warning("the results are kept in the %s spool" % self._spool.spool_dir)
+                return False
             raise ptRuntimeException("Suite run results upload failed, status %d:\n%s" %
                                      (response.status_code, response.text))
-        logging.info("status %d - job json uploaded, %s" % (response.status_code, response.text))
+        self._uploaded = True
+        if self._spool:
+            self._spool.ack(self.uuid, snapshot['seq'])
+        logging.info("status %d - job json uploaded (%d tests), %s" % (response.status_code, len(tests),
+                                                                       response.text))
         return True
 
+    def _getUploadDict(self, tests, delta):
+        j = ptJsonEncoder.toDict(self, skip=('tests',))
+        if delta:
+            # the job already exists on the server, so update the header and merge the tests by uuid
+            j.pop('replace', None)
+            j['append'] = True
+        if tests:
+            for t in tests:
+                t._update_histogram_attribs()
+            j['tests'] = [ptJsonEncoder.toDict(t) for t in tests]
+        return j
+
+    def _getUploadJson(self, tests, delta):
+        return ptJsonEncoder.dumps(self._getUploadDict(tests, delta), native=True)
+
+    @staticmethod
+    def _getUploadSnapshot(j, delta):
+        # the dict returned by _getUploadDict() is detached from the objects being changed by the caller
+        header = OrderedDict(j)
+        snapshot_tests = OrderedDict()
+        for t in header.pop('tests', []):
+            snapshot_tests[t['uuid']] = t
+        return {'delta': delta, 'header': header, 'tests': snapshot_tests}
+
+    def setSpool(self, spool_dir, spool_only=None):
+        self._spool = ptSpool(spool_dir)
+        if spool_only is not None:
+            self._spool_only = spool_only
+
+    def getUploadStats(self):
+        """Background uploader statistics: queue depth, upload latency, ..."""
+        return self._uploader.getStats() if self._uploader else None
+
+    def _post(self, json_data):
+        if self.project_id is None:
+            # the server could be unreachable when the suite started
+            self.project_id = self.pt_server.getProjectId(self.project_name)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            pretty = ptJsonEncoder.pretty(json.loads(json_data))
+            logging.debug("posting data to %s:\n%s" % ('/%d/job/' % self.project_id, pretty))
+        return self.pt_server.post('%d/job/' % self.project_id, decode_json=False, data=json_data)
+
     def addOptions(self, option_parser, pt_url=None, pt_project=None):
         self._pt_options_added = True
         if pt_url is not None:
@@ -766,6 +2076,16 @@ class ptSuite:
                      default=self.pt_server.url)
         g.add_option("--pt-replace", type="str", help="replace tests results in the job with given UUID")
         g.add_option("--pt-append", type="str", help="append tests results to the job with given UUID")
+        g.add_option("--pt-full-upload", action="store_true",
+                     help="always upload all the tests, by default only new and changed tests are re-uploaded")
+        g.add_option("--pt-async-upload", action="store_true",
+                     help="upload results in background, merge uploads made within --pt-upload-interval")
+        g.add_option("--pt-upload-interval", type="float", default=self._upload_interval_sec,
+                     help="background upload interval (sec), default %default")
+        g.add_option("--pt-spool", type="str", metavar="DIR",
+                     help="store results to the spool directory first, so they survive the server outage")
+        g.add_option("--pt-spool-only", action="store_true",
+                     help="don't upload results, just store them to the --pt-spool directory")
         g.add_option("--pt-title", type="str", help="PerfTracker job title to be used")
         g.add_option("--pt-version", type="str", help="PerfTracker suite version")
         g.add_option("--pt-regression-tag", type="str", help="PerfTracker suite regression tag")
@@ -776,6 +2096,16 @@ class ptSuite:
                      help="Upload stdout & stderr to perftracker and attach to the job")
         g.add_option("--pt-log-ttl", type="int", default=180,
                      help="stdout & stderr logs time to live (days), default %default")
+        g.add_option("--pt-profile", action="store_true",
+                     help="profile the tests (ptTest.run(), python commands run by ptTest.execute() and ptBenchmark) "
+                          "by cProfile, the stats are uploaded as one artifact linked to the tests")
+        g.add_option("--pt-profile-top", type="int", default=PT_PROFILE_TOP,
+                     help="number of the hot functions to add to the profiled test description, default %default")
+        g.add_option("--pt-retries", type="int", default=self.pt_server.retries,
+                     help="number of retries on server connection errors (and 5xx responses of the idempotent "
+                          "requests), default %default")
+        g.add_option("--pt-timeout", type="float", default=self.pt_server.timeout_sec,
+                     help="server request timeout (sec), default %default")
         option_parser.add_option_group(g)
 
     def handleOptions(self, options):
@@ -789,6 +2119,10 @@ class ptSuite:
             self._save_to_file = options.pt_to_file
         if _exists(options, 'pt_url'):
             self.pt_server.setUrl(options.pt_url)
+        if _exists(options, 'pt_retries'):
+            self.pt_server.setRetries(options.pt_retries)
+        if _exists(options, 'pt_timeout'):
+            self.pt_server.setTimeout(options.pt_timeout)
         if _exists(options, 'pt_replace'):
             self.uuid = options.pt_replace
             self.replace = True
@@ -809,6 +2143,18 @@ class ptSuite:
         if _exists(options, 'pt_append'):
             self.uuid = options.pt_append
             self.append = True
+        if _exists(options, 'pt_full_upload'):
+            self._delta_upload = False
+        if _exists(options, 'pt_async_upload'):
+            self._async_upload = True
+        if _exists(options, 'pt_upload_interval'):
+            self._upload_interval_sec = options.pt_upload_interval
+        if _exists(options, 'pt_spool'):
+            self.setSpool(options.pt_spool, spool_only=bool(options.pt_spool_only))
+        if _exists(options, 'pt_profile') and options.pt_profile:
+            self._profiler = ptProfiler(top=options.__dict__.get('pt_profile_top') or PT_PROFILE_TOP).activate()
+        if _exists(options, 'pt_log_ttl'):
+            self._log_ttl_days = options.pt_log_ttl
         if _exists(options, 'pt_log_upload'):
             self._stdout_filename = Tee('stdout').filename
             self._stderr_filename = Tee('stderr').filename
@@ -822,6 +2168,29 @@ class ptSuite:
         self.validateProjectName()
 
     def fini(self):
+        if self._uploader:
+            if self._uploader.need_full and not self._uploader.stopped:
+                self.upload()
+            self._uploader.stop()
+            self._uploader = None
+
+        if self._spool and self._spool.close():
+            pending = self._spool.pending()
+            if pending:
+                logging.warning("%d job snapshot(s) are not uploaded, use pt-suite-uploader.py --replay-spool %s" %
+                                (pending, self._spool.spool_dir))
+
+        if self._profiler:
+            self._profiler.deactivate()
+            if self._save_to_file or self._spool_only:
+                if self._profiler.tests():
+                    path = "pt-profile-%s.tar" % str(self.uuid)
+                    self._profiler.save(path)
+                    logging.info("cProfile stats are saved to %s" % path)
+            else:
+                self._profiler.upload(self.pt_server, ttl_days=self._log_ttl_days)
+            self._profiler = None
+
         if self._stdout_artifact and os.path.getsize(self._stdout_filename):
             self._stdout_artifact.upload(self._stdout_filename)
         if self._stderr_artifact and os.path.getsize(self._stderr_filename):
@@ -859,6 +2228,13 @@ def _coverage():
     vm1.addNode(ptComponent("backend", version="1.2.3"))
     vm2.addNode(ptComponent("database", version="10.0"))
 
+    client = suite.addNode(ptHost("client", scan_info=True, defer_scan=True))
+    client_vm = client.addNode(ptVM("client-vm", virt_type="docker image", scan_info=True, defer_scan=True))
+    client.addNode(ptVM("dead-vm", ip="192.0.2.1", ssh_user="root", scan_info=True, defer_scan=True))
+    assert not client.cpus
+    assert suite.scanEnvironment(parallel=2, timeout=2) == 2
+    assert client.cpus and client_vm.cpus and client._shell is client_vm._shell
+
     for p in range(1, 5 + random.randint(0, 2)):
         suite.addTest(ptTest("Login time", group="Latency tests", metrics="sec", less_better=True,
                              category="%d parallel users" % (2 ** p),
@@ -873,6 +2249,45 @@ def _coverage():
                          category="2 parallel users",
                          scores=[0.3 + sqrt(2) + random.randint(0, 20) / 40.0]))
 
+    latency = ptTest("Request latency", group="Latency tests", metrics="sec", less_better=True, compact=True)
+    latency.add_scores(0.1 + random.random() / 10 for i in range(2000))
+    latency.run(lambda: [random.random() for i in range(10)], target_ci=0.1, max_iterations=10)
+    latency.add_histogram(ptHistogram(unit="sec"))
+    for i in range(2000):
+        latency.record(random.expovariate(10))
+    suite.addTest(latency)
+
+    suite._profiler = ptProfiler(top=5).activate()
+    profiled = ptTest("Job json encoder", group="Profiling", metrics="sec", less_better=True)
+
+    def _encode():
+        ts = time.time()
+        suite.toJson()
+        return time.time() - ts
+
+    profiled.run(_encode, max_iterations=3)
+    assert len(profiled.scores) == 3 and profiled.description.startswith("cProfile top 5 ")
+    profiled.execute("%s -m platform" % sys.executable)
+    assert len(suite._profiler.tests()) == 1
+    suite.addTest(profiled)
+
+    profiled_cmd = ptTest("Platform name length", group="Profiling", metrics="chars")
+    profiled_cmd.run(cmdline="%s -m platform" % sys.executable, parse_score=len, max_iterations=3)
+    assert len(profiled_cmd.scores) == 3 and profiled_cmd.description.startswith("cProfile top 5 ")
+    suite.addTest(profiled_cmd)
+
+    warm = ptTest("Warm cache read", group="Latency tests", metrics="ms", less_better=True,
+                  scores=[90, 60, 30] + [10 + random.random() for i in range(20)] + [100])
+    warm.clean_scores()
+    assert len(warm.scores) == 20 and warm.attribs['warm-up iterations'] + warm.attribs['outliers'] == 4
+    suite.addTest(warm)
+
+    sampled = ptTest("Compression time", group="Latency tests", metrics="sec", less_better=True)
+    sampled.execute("gzip -c -9 %s > /dev/null; sleep 0.5" % sys.executable, sample=[client],
+                    sample_interval_sec=0.2)
+    assert "client cpu busy max (%)" in sampled.attribs
+    suite.addTest(sampled)
+
     a = suite.addArtifact(uuid1="11111111-3333-11e8-85cb-8c85907924aa")
     a.compressed = True
     a.inline = True
@@ -882,9 +2297,147 @@ def _coverage():
     suite.upload()
     j = suite.toJson()
     suite.initFromJson(json.loads(j))
+
+    _coverage_async_upload(suite)
+    _coverage_spool(suite)
+    _coverage_download(suite)
     print("Done, job: %s" % suite.uuid)
 
 
+def _coverage_async_upload(suite):
+    # the snapshots are kept while the server is down and uploaded by flush() when it is back
+    job = ptSuite(project_name=suite.project_name, pt_server_url="127.0.0.1:1", async_upload=True,
+                  upload_interval_sec=0.1, upload_flush_timeout_sec=10)
+    job.project_id = suite.project_id
+    job.pt_server.setRetries(0)
+    job.addTest(ptTest("Async upload", group="Upload tests", metrics="sec", scores=[1.0]))
+    assert job.upload()
+    uploader = job._uploader
+    assert not uploader.flush(timeout_sec=0.5)
+    stats = job.getUploadStats()
+    assert stats['failures'] >= 1 and stats['queue_depth'] == 1 and stats['uploads'] == 0, stats
+
+    job.pt_server.setUrl(suite.pt_server.url)
+    assert uploader.flush()
+    assert job.getUploadStats()['uploads'] == 1
+
+    # the delta snapshots are merged, fini() drains the queue
+    job.addTest(ptTest("Async upload 2", group="Upload tests", metrics="sec", scores=[2.0]))
+    job.upload()
+    job.getTest("Async upload", group="Upload tests").add_score(1.5)
+    job.upload()
+    job.fini()
+    stats = uploader.getStats()
+    print(stats)
+    assert stats['snapshots'] == 3 and stats['queue_depth'] == 0 and uploader.stopped
+    assert stats['uploads'] in (2, 3) and stats['max_latency_sec'] >= stats['avg_latency_sec'] > 0
+
+
+def _coverage_download(suite):
+    import io
+    import shutil
+
+    tmpdir = tempfile.mkdtemp(prefix="pt-download-")
+    try:
+        src = os.path.join(tmpdir, "src.txt")
+        with open(src, 'wb') as f:
+            f.write(b"".join(b"line %d\n" % i for i in range(20000)))
+        with open(src, 'rb') as f:
+            data = f.read()
+
+        body = ptMultipartStream({'inline': True}, src, "src.txt", compression=True, chunk_size=4096)
+        req = requests.Request('POST', suite.pt_server.api_url, data=body).prepare()
+        assert 'Transfer-Encoding' not in req.headers and int(req.headers['Content-Length']) == body.len
+        assert len(b"".join(body)) == len(b"".join(body)) == body.len < len(data)
+        body.close()
+
+        a = ptArtifact(suite.pt_server, filename="src.txt", compression=True)
+        resp = a.upload(src, chunk_size=4096)
+        assert resp.status_code == httplib.OK and a.size == len(data)
+
+        assert a.download().content != data
+        out = io.BytesIO()
+        assert a.download(fileobj=out, chunk_size=4096, decompress=True).status_code == httplib.OK
+        assert out.getvalue() == data
+
+        dst = os.path.join(tmpdir, "dst.bz2")
+        progress = []
+        resp = a.download(dst, chunk_size=4096, progress_cb=lambda *args: progress.append(args))
+        assert resp.status_code == httplib.OK and progress[-1][0] == progress[-1][1] == a.size
+        with open(dst, 'rb') as f:
+            compressed = f.read()
+        assert bz2.decompress(compressed) == data and not os.path.exists(dst + ".part")
+
+        # resume the interrupted download
+        with open(dst + ".part", 'wb') as f:
+            f.write(compressed[:len(compressed) // 2])
+        assert a.download(dst, chunk_size=4096).status_code == httplib.PARTIAL_CONTENT
+        with open(dst, 'rb') as f:
+            assert f.read() == compressed
+
+        # the interrupted download has been actually completed
+        shutil.copyfile(dst, dst + ".part")
+        assert a.download(dst).status_code == httplib.OK and a.size == len(compressed)
+        assert not os.path.exists(dst + ".part")
+
+        # stale .part file is bigger than the artifact, it is downloaded from scratch
+        with open(dst + ".part", 'wb') as f:
+            f.write(compressed + b"garbage")
+        assert a.download(dst).status_code == httplib.OK and a.size == len(compressed)
+        with open(dst, 'rb') as f:
+            assert f.read() == compressed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _coverage_spool(suite):
+    import shutil
+
+    spool_dir = tempfile.mkdtemp(prefix="pt-spool-")
+    try:
+        # the server is down: the snapshots stay in the spool
+        job = ptSuite(project_name=suite.project_name, pt_server_url="127.0.0.1:1", spool_dir=spool_dir)
+        job.project_id = suite.project_id
+        job.pt_server.setRetries(0)
+        job.addTest(ptTest("Spooled", group="Upload tests", metrics="sec", scores=[1.0]))
+        assert job.upload() is False
+        job.addTest(ptTest("Spooled 2", group="Upload tests", metrics="sec", scores=[2.0]))
+        assert job.upload() is False
+        assert job._spool.pending() == 2
+        job.fini()
+
+        spool = ptSpool(spool_dir)
+        paths = spool.files()
+        assert len(paths) == 1
+        with open(paths[0], 'a') as f:
+            f.write('{"seq": 3, "project": "Test", "snapsh\n')  # torn write of a crashed process
+        project_name, snapshot = ptSpool.load(paths[0])
+        assert project_name == suite.project_name and len(snapshot['tests']) == 2
+
+        # nothing is lost on replay failure
+        dead = ptServer("127.0.0.1:1", retries=0)
+        assert spool.replay(dead) == (0, 1) and spool.files() == paths
+
+        assert spool.replay(suite.pt_server) == (1, 0)
+        assert not spool.files()
+
+        # the acked records are not replayed, the spool file is removed when everything is uploaded
+        job = ptSuite(project_name=suite.project_name, spool_dir=spool_dir)
+        job.addTest(ptTest("Spooled 3", group="Upload tests", metrics="sec", scores=[3.0]))
+        assert job.upload() and not ptSpool(spool_dir).files()
+
+        job = ptSuite(project_name=suite.project_name, spool_dir=spool_dir, spool_only=True)
+        job.addTest(ptTest("Spooled 4", group="Upload tests", metrics="sec", scores=[4.0]))
+        assert job.upload()
+        job._spool.append(job.uuid, job.project_name, job._getUploadSnapshot(job._getUploadDict([], True), True))
+        job._spool.ack(job.uuid, 1)
+        job.fini()
+        project_name, snapshot = ptSpool.load(ptSpool(spool_dir).files()[0])
+        assert snapshot['delta'] and not snapshot['tests']
+    finally:
+        shutil.rmtree(spool_dir)
+
+
 if __name__ == "__main__":
     try:
         _coverage()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+"""
+Offline comparison of two PerfTracker jobs (json saved by --pt-to-file or ptSuite.toJson()): the tests are
+matched by tag, group and category like in ptSuite.getTest() and the scores difference significance is
+estimated by the Mann-Whitney U or bootstrap test. The tests with the same number of scores are processed
+in batches by numpy if it is installed. Without numpy the bootstrap test of more than
+PT_COMPARE_BOOTSTRAP_PURE_MAX tests falls back to Mann-Whitney (it would take ~5 msec per test)
+"""
+
+import json
+import math
+import logging
+import random
+
+from .stats import mean, mann_whitney, bootstrap_pvalue, get_numpy, _mw_exact_counts, PT_MW_EXACT_MAX
+from .texttable import TextTable, RED, GREEN
+
+try:
+    import orjson
+
+    def _json_load(f):
+        return orjson.loads(f.read())
+except ImportError:
+    _json_load = json.load
+
+PT_COMPARE_METHODS = ("mannwhitney", "bootstrap")
+PT_COMPARE_BOOTSTRAP_PURE_MAX = 100
+
+# max number of the array elements allocated by numpy per batch
+_PT_COMPARE_BATCH_SIZE = 4000000
+
+
+def test_key(test):
+    """The same key as ptSuite.getTest() uses, test is the job json test dict"""
+    return "%s-%s-%s" % (test.get('tag'), str(test.get('group')), str(test.get('category')))
+
+
+def load_job(job):
+    """job - the job json file path, json dict or ptSuite"""
+    if hasattr(job, 'toJson'):
+        job = json.loads(job.toJson())
+    elif not isinstance(job, dict):
+        with open(job, 'rb') as f:
+            job = _json_load(f)
+    if 'tests' not in job:
+        raise ValueError("not a PerfTracker job json, 'tests' are not found")
+    return job
+
+
+def _mw_batch(np, X, Y):
+    """Mann-Whitney p-values for every row of X (k x m) and Y (k x n), see stats.mann_whitney()"""
+    k, m = X.shape
+    n = Y.shape[1]
+    N = m + n
+
+    C = np.concatenate((X, Y), axis=1)
+    gt = (C[:, :, None] > C[:, None, :]).sum(axis=2)
+    eq = (C[:, :, None] == C[:, None, :]).sum(axis=2)
+    u = (gt[:, :m] + (eq[:, :m] + 1) / 2.0).sum(axis=1) - m * (m + 1) / 2.0
+    ties = (eq * eq - 1).sum(axis=1)  # every value of the t tied ones adds t^2 - 1, so it is sum(t^3 - t)
+
+    sigma = np.sqrt(m * n / 12.0 * ((N + 1) - ties / float(N * (N - 1))))
+    z = np.maximum(np.abs(u - m * n / 2.0) - 0.5, 0) / np.where(sigma > 0, sigma, 1)
+    p = np.array([math.erfc(v) for v in (z / math.sqrt(2)).tolist()])
+    p[sigma == 0] = 1.0
+
+    if N <= PT_MW_EXACT_MAX:
+        counts = _mw_exact_counts(m, n)
+        cdf = np.cumsum(counts) / float(sum(counts))
+        exact = ties == 0
+        p[exact] = np.minimum(1.0, 2.0 * cdf[np.minimum(u, m * n - u)[exact].astype(np.int64)])
+    return p
+
+
+def _bootstrap_batch(np, X, Y, resamples, rs):
+    """
+    Bootstrap p-values for every row of X (k x m) and Y (k x n), see stats.bootstrap_pvalue(). The rows share
+    the resamples, which are drawn as the multinomial counts of every score, so the resampled means of all
+    the rows are two matrix products instead of the resamples x k x (m + n) random indexes
+    """
+    m = X.shape[1]
+    n = Y.shape[1]
+    Wx = rs.multinomial(m, [1.0 / m] * m, size=resamples).T / float(m)
+    Wy = rs.multinomial(n, [1.0 / n] * n, size=resamples).T / float(n)
+    d = Y.dot(Wy) - X.dot(Wx)
+    le = (d <= 0).sum(axis=1)
+    ge = (d >= 0).sum(axis=1)
+    return np.minimum(1.0, 2.0 * np.minimum(le, ge) / resamples)
+
+
+def pvalues(pairs, method="mannwhitney", resamples=1000, seed=0):
+    """
+    Two-sided p-values for the list of (x, y) scores pairs, None for the pairs with less than 2 scores
+    on either side. The pairs with the same number of scores are processed in batches if numpy is installed
+    """
+    if method not in PT_COMPARE_METHODS:
+        raise ValueError("method must be one of %s, got: %s" % (str(PT_COMPARE_METHODS), str(method)))
+
+    ret = [None] * len(pairs)
+    np = get_numpy()
+    rng = random.Random(seed)
+
+    if method == "bootstrap" and not np and len(pairs) > PT_COMPARE_BOOTSTRAP_PURE_MAX:
+        logging.warning("numpy is not installed, bootstrap of %d tests is too slow, using mannwhitney instead" %
+                        len(pairs))
+        method = "mannwhitney"
+
+    shapes = {}
+    for i, (x, y) in enumerate(pairs):
+        if len(x) < 2 or len(y) < 2:
+            continue
+        if np:
+            shapes.setdefault((len(x), len(y)), []).append(i)
+        elif method == "mannwhitney":
+            ret[i] = mann_whitney(x, y)[1]
+        else:
+            ret[i] = bootstrap_pvalue(x, y, resamples, rng)
+
+    rs = np.random.RandomState(seed) if np else None
+    for (m, n), idx in sorted(shapes.items()):
+        if method == "mannwhitney":
+            per_row = (m + n) ** 2
+        else:
+            per_row = resamples * 3
+
+        if per_row > _PT_COMPARE_BATCH_SIZE:
+            for i in idx:
+                x, y = pairs[i]
+                ret[i] = mann_whitney(x, y)[1] if method == "mannwhitney" else bootstrap_pvalue(x, y, resamples, rng)
+            continue
+
+        chunk = max(1, _PT_COMPARE_BATCH_SIZE // per_row)
+        for c in range(0, len(idx), chunk):
+            ids = idx[c:c + chunk]
+            X = np.array([pairs[i][0] for i in ids], dtype=np.float64)
+            Y = np.array([pairs[i][1] for i in ids], dtype=np.float64)
+            if method == "mannwhitney":
+                p = _mw_batch(np, X, Y)
+            else:
+                p = _bootstrap_batch(np, X, Y, resamples, rs)
+            for i, v in zip(ids, p.tolist()):
+                ret[i] = v
+    return ret
+
+
+class ptTestDelta:
+    def __init__(self, a, b, key=None):
+        """a, b - the job json test dicts"""
+        self.key = key if key else test_key(b)
+        self.tag = b.get('tag')
+        self.group = b.get('group')
+        self.category = b.get('category')
+        self.metrics = b.get('metrics')
+        self.less_better = b.get('less_better', False) in (True, "true", "True")
+        self.scores_a = a.get('scores') or []
+        self.scores_b = b.get('scores') or []
+        self.mean_a = mean(self.scores_a)
+        self.mean_b = mean(self.scores_b)
+
+        self.delta = None  # relative change of the mean: 0.05 means +5%
+        if self.mean_a and self.mean_b is not None:
+            self.delta = (self.mean_b - self.mean_a) / abs(self.mean_a)
+        self.p_value = None
+        self.status = "unknown"
+
+    def __repr__(self):
+        return "ptTestDelta('%s', group='%s', category='%s', %s -> %s, delta=%s, p=%s, %s)" % \
+               (self.tag, self.group, self.category, str(self.mean_a), str(self.mean_b), str(self.delta),
+                str(self.p_value), self.status)
+
+    @property
+    def badness(self):
+        """delta sign-adjusted by less_better: positive is worse"""
+        if self.delta is None:
+            return 0
+        return self.delta if self.less_better else -self.delta
+
+    def classify(self, alpha, threshold):
+        """
+        The change is a regression or improvement if it is larger than threshold and it is significant
+        (p-value < alpha). If p-value can't be calculated (a single score) only the threshold is used
+        """
+        if self.delta is None or (self.p_value is None and not threshold):
+            self.status = "unknown"
+        elif abs(self.delta) <= threshold or (self.p_value is not None and self.p_value >= alpha):
+            self.status = "same"
+        else:
+            self.status = "regression" if self.badness > 0 else "improvement"
+        return self.status
+
+
+class ptJobCompare:
+    def __init__(self, job_a, job_b, method="mannwhitney", alpha=0.05, threshold=0.0, resamples=1000, seed=0):
+        """
+        job_a, job_b - the base and new jobs: json file path, json dict or ptSuite
+        method       - significance test: mannwhitney or bootstrap
+        alpha        - significance level
+        threshold    - min relative change of the scores mean to be reported: 0.05 means 5%
+        resamples    - number of the bootstrap resamples
+        seed         - the bootstrap random seed, so the results are reproducible
+        """
+        if method not in PT_COMPARE_METHODS:
+            raise ValueError("method must be one of %s, got: %s" % (str(PT_COMPARE_METHODS), str(method)))
+
+        self.job_a = load_job(job_a)
+        self.job_b = load_job(job_b)
+        self.method = method
+        self.alpha = alpha
+        self.threshold = threshold
+        self.resamples = resamples
+        self.seed = seed
+
+        self.deltas = []
+        self.only_a = []
+        self.only_b = []
+
+    def compare(self):
+        """Returns the list of ptTestDelta: regressions first (the worst first), then the rest by badness"""
+        keys_a = [test_key(t) for t in self.job_a['tests']]
+        tests_a = dict(zip(keys_a, self.job_a['tests']))
+        keys_b = set()
+
+        self.deltas = []
+        self.only_b = []
+        for t in self.job_b['tests']:
+            key = test_key(t)
+            keys_b.add(key)
+            if key in tests_a:
+                self.deltas.append(ptTestDelta(tests_a[key], t, key))
+            else:
+                self.only_b.append(key)
+        self.only_a = [key for key in keys_a if key not in keys_b]
+
+        pairs = [(d.scores_a, d.scores_b) for d in self.deltas]
+        for d, p in zip(self.deltas, pvalues(pairs, self.method, self.resamples, self.seed)):
+            d.p_value = p
+            d.classify(self.alpha, self.threshold)
+
+        self.deltas.sort(key=lambda d: (d.status != "regression", -d.badness))
+        return self.deltas
+
+    def getRegressions(self):
+        return [d for d in self.deltas if d.status == "regression"]
+
+    def getSummary(self):
+        cnt = dict((s, 0) for s in ("regression", "improvement", "same", "unknown"))
+        for d in self.deltas:
+            cnt[d.status] += 1
+        return "%d tests compared: %d regression(s), %d improvement(s), %d same, %d unknown; " \
+               "%d test(s) only in A, %d only in B" % \
+               (len(self.deltas), cnt["regression"], cnt["improvement"], cnt["same"], cnt["unknown"],
+                len(self.only_a), len(self.only_b))
+
+    def getTable(self, max_rows=None, show_all=False):
+        """TextTable with the regressions and improvements (and the rest if show_all is set)"""
+        def _fmt(v):
+            return "%.4g" % v if v is not None else "-"
+
+        t = TextTable(left_aligned=[1, 2, 3, 4], autoreplace={})
+        t.add_row(["#", "Group", "Tag", "Category", "Metrics", "A", "B", "Delta", "p-value", "Status"])
+        t.add_row("-")
+        n = 0
+        for d in self.deltas:
+            if not show_all and d.status not in ("regression", "improvement"):
+                continue
+            if max_rows and n >= max_rows:
+                break
+            n += 1
+            style = {"regression": RED, "improvement": GREEN}.get(d.status)
+            t.add_row([n, d.group or "", d.tag, d.category or "", d.metrics or "", _fmt(d.mean_a), _fmt(d.mean_b),
+                       "%+.1f%%" % (d.delta * 100) if d.delta is not None else "-",
+                       "%.3g" % d.p_value if d.p_value is not None else "-", d.status], style=style)
+        return t
+
+
+##############################################################################
+# Autotests
+##############################################################################
+
+
+def _coverage():
+    global _PT_COMPARE_BATCH_SIZE
+
+    rnd = random.Random(1)
+
+    def _test(tag, scores, less_better=False, group="cpu", category="1-thread"):
+        return {'tag': tag, 'group': group, 'category': category, 'metrics': "ops/sec", 'scores': scores,
+                'less_better': less_better}
+
+    a = {'tests': [_test("fast", [100 + rnd.random() for i in range(10)]),
+                   _test("slow", [100 + rnd.random() for i in range(10)]),
+                   _test("latency", [10 + rnd.random() for i in range(10)], less_better=True),
+                   _test("noise", [100 + rnd.random() for i in range(5)]),
+                   _test("single", [100]),
+                   _test("only in a", [1, 2])]}
+    b = {'tests': [_test("fast", [110 + rnd.random() for i in range(10)]),
+                   _test("slow", [90 + rnd.random() for i in range(10)]),
+                   _test("latency", [12 + rnd.random() for i in range(10)], less_better=True),
+                   _test("noise", [100 + rnd.random() for i in range(5)]),
+                   _test("single", [50]),
+                   _test("only in b", [1, 2])]}
+
+    for method in PT_COMPARE_METHODS:
+        c = ptJobCompare(a, b, method=method, threshold=0.1)
+        deltas = c.compare()
+        status = dict((d.tag, d.status) for d in deltas)
+        assert status == {"fast": "improvement", "slow": "same", "latency": "regression", "noise": "same",
+                          "single": "regression"}, status
+        assert [d.tag for d in c.getRegressions()] == ["single", "latency"]
+        assert c.only_a == [test_key(a['tests'][-1])] and c.only_b == [test_key(b['tests'][-1])]
+        print("\n".join(c.getTable(show_all=True).get_lines()))
+        print(c.getSummary())
+
+    c = ptJobCompare(a, b)
+    c.compare()
+    assert len(c.getTable(max_rows=1).get_lines()) == 3
+    assert dict((d.tag, d.status) for d in c.deltas)["single"] == "unknown"
+
+    # the numpy batches must give the same Mann-Whitney p-values as the pure python code
+    pairs = [([rnd.randint(0, 5) for i in range(m)], [rnd.randint(0, 5) for i in range(n)])
+             for m, n in ((3, 3), (10, 12), (2, 30)) * 20]
+    pairs += [([1, 2, 3], [4, 5, 6]), ([1, 1], [1, 1]), ([1], [2, 3])]
+    p = pvalues(pairs)
+    for (x, y), v in zip(pairs, p):
+        ref = mann_whitney(x, y)[1]
+        assert (v is None and ref is None) or abs(v - ref) < 0.000001, (x, y, v, ref)
+
+    _PT_COMPARE_BATCH_SIZE = 10  # too small for any batch
+    assert all(v is None and ref is None or abs(v - ref) < 0.000001 for v, ref in zip(pvalues(pairs), p))
+    assert pvalues(pairs[-3:], method="bootstrap")[1:] == [1.0, None]
+
+    # the shared resamples give about the same bootstrap p-values as the pure python code
+    pairs = [([100 + rnd.random() for i in range(10)], [100.3 + rnd.random() for i in range(8)]) for t in range(50)]
+    ref = [bootstrap_pvalue(x, y, 1000, rnd) for x, y in pairs]
+    assert all(abs(v - r) < 0.1 for v, r in zip(pvalues(pairs, method="bootstrap"), ref))
+    assert pvalues(pairs * 3, method="bootstrap") == pvalues(pairs * 3, method="mannwhitney") or get_numpy()
+
+    for args in ((a, b, "xxx"), ({}, b)):
+        try:
+            ptJobCompare(*args)
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    _coverage()
+    print("OK")
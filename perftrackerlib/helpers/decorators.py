@@ -5,12 +5,33 @@ __author__ = "perfguru87@gmail.com"
 __copyright__ = "Copyright 2018, The PerfTracker project"
 __license__ = "MIT"
 
-# based on https://github.com/pydanny/cached-property/blob/master/cached_property.py
+import gc
+import sys
+import time
+import timeit
+import inspect
+import datetime
+import itertools
+import functools
 
 try:
-    import asyncio
-except (ImportError, SyntaxError):
-    asyncio = None
+    _now_ns = time.perf_counter_ns
+except AttributeError:
+    def _now_ns():
+        return int(timeit.default_timer() * 1000000000)
+
+_PT_BENCHMARK_UNITS = {"nsec": 1, "usec": 1000, "msec": 1000000, "sec": 1000000000}
+
+
+def _iscoroutinefunction(func):
+    # asyncio is slow to import, so it is not imported unless the function is a coroutine
+    if getattr(inspect, 'iscoroutinefunction', None) and inspect.iscoroutinefunction(func):
+        return True
+    asyncio = sys.modules.get('asyncio')  # the legacy @asyncio.coroutine generators need asyncio imported
+    return asyncio is not None and asyncio.iscoroutinefunction(func)
+
+
+# based on https://github.com/pydanny/cached-property/blob/master/cached_property.py
 
 
 class cached_property(object):
@@ -28,13 +49,14 @@ class cached_property(object):
         if obj is None:
             return self
 
-        if asyncio and asyncio.iscoroutinefunction(self.func):
+        if _iscoroutinefunction(self.func):
             return self._wrap_in_coroutine(obj)
 
         value = obj.__dict__[self.func.__name__] = self.func(obj)
         return value
 
     def _wrap_in_coroutine(self, obj):
+        import asyncio
 
         @asyncio.coroutine
         def wrapper():
@@ -45,6 +67,180 @@ class cached_property(object):
         return wrapper()
 
 
+class ptBenchmark(object):
+    def __init__(self, tag=None, suite=None, group=None, category=None, params=None, setup=None, teardown=None,
+                 repeat=5, loops=None, min_time_sec=0.2, unit="usec", gc_disable=True, **test_kwargs):
+        """
+        In-process micro-benchmark producing ptTest results (time per call in the unit, less is better):
+
+          @ptBenchmark(suite=suite, group="json", params=[10, 1000], category="%d items")
+          def dumps(n):
+              json.dumps(list(range(n)))
+
+          dumps()  # returns the list of ptTest, one per param
+
+        tag          - test tag, the function name by default
+        suite        - ptSuite to add the tests to
+        category     - test category or, if params are given, the format string for a param: '%d threads'
+        params       - parameter sweep: the function is called with every param, one test per param
+        setup        - called (with the param) before every timed repeat and loops calibration trial, not
+                       timed. If it returns anything but None, the result is passed to the function and
+                       teardown instead
+        teardown     - called after every timed repeat and calibration trial, not timed
+        NOTE: if ptProfiler is active (--pt-profile) one more repeat is made under cProfile, it is not scored
+        repeat       - number of the timed repeats, every repeat gives a score
+        loops        - number of the calls per repeat, calibrated to take at least min_time_sec by default
+        unit         - scores unit: nsec, usec, msec or sec
+        gc_disable   - disable the garbage collector during the timed repeats
+        test_kwargs  - other ptTest arguments: description, attribs, ...
+
+        Used as a context manager it times the 'with' block (gc disabled) and adds one score per block
+        to the same test, so there is no calibration in this mode:
+
+          b = ptBenchmark("request", suite=suite, unit="msec")
+          for i in range(10):
+              with b:
+                  send_request()
+        """
+        if unit not in _PT_BENCHMARK_UNITS:
+            raise ValueError("unit must be one of %s, got: %s" % (", ".join(_PT_BENCHMARK_UNITS), str(unit)))
+        self.tag = tag
+        self.suite = suite
+        self.group = group
+        self.category = category
+        self.params = params
+        self.setup = setup
+        self.teardown = teardown
+        self.repeat = repeat
+        self.loops = loops
+        self.min_time_sec = min_time_sec
+        self.unit = unit
+        self.gc_disable = gc_disable
+        self.test_kwargs = test_kwargs
+
+        self.func = None
+        self.test = None
+        self._ts = None
+        self._gc_was_enabled = None
+
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as a decorator
+            self.func = args[0]
+            functools.update_wrapper(self, self.func)
+            return self
+        if args or kwargs:
+            raise TypeError("%s() takes no arguments, use ptBenchmark(params=...) to pass them" %
+                            (self.tag or self.func.__name__))
+        return self.run()
+
+    def _timeit(self, args, loops):
+        gc_was_enabled = gc.isenabled()
+        if self.gc_disable:
+            gc.disable()
+        try:
+            func = self.func
+            ts = _now_ns()
+            for _ in itertools.repeat(None, loops):
+                func(*args)
+            return _now_ns() - ts
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _setup(self, args):
+        """Returns the function arguments for a new repeat: the setup() result if there is one"""
+        state = self.setup(*args) if self.setup else None
+        return args if state is None else (state,)
+
+    def _teardown(self, run_args):
+        if self.teardown:
+            self.teardown(*run_args)
+
+    def _timeit_fresh(self, args, loops):
+        """_timeit() on a fresh setup() state"""
+        run_args = self._setup(args)
+        try:
+            return self._timeit(run_args, loops)
+        finally:
+            self._teardown(run_args)
+
+    def _calibrate(self, args):
+        """
+        The number of loops (1, 2, 5, 10, 20, 50, ...) taking at least min_time_sec, like timeit.autorange().
+        Every trial runs on its own setup() state, so the timed repeats never get the state changed by it
+        """
+        i = 1
+        while True:
+            for loops in (i, 2 * i, 5 * i):
+                if self._timeit_fresh(args, loops) >= self.min_time_sec * 1000000000:
+                    return loops
+            i *= 10
+
+    def _run_one(self, param):
+        from perftrackerlib.client import ptTest, ptProfiler, pt_float
+        from perftrackerlib.helpers.stats import ci_halfwidth
+
+        args = () if self.params is None else (param,)
+        begin = datetime.datetime.now()
+        loops = self.loops or self._calibrate(args)
+        scores = [self._timeit_fresh(args, loops) / float(loops) / _PT_BENCHMARK_UNITS[self.unit]
+                  for n in range(self.repeat)]
+        end = datetime.datetime.now()
+
+        category = self.category
+        if self.params is not None:
+            category = (self.category or "%s") % param
+
+        hw = ci_halfwidth(scores)
+        kwargs = dict(self.test_kwargs)
+        kwargs.setdefault('description', self.func.__doc__)
+        t = ptTest(self.tag or self.func.__name__, group=self.group, category=category, metrics=self.unit,
+                   less_better=True, loops=loops, scores=scores, deviations=[pt_float(hw or 0)] * len(scores),
+                   begin=begin, end=end, duration_sec=(end - begin).total_seconds(), **kwargs)
+
+        if ptProfiler.active:
+            # one more repeat under the profiler, so the scores don't include its overhead
+            run_args = self._setup(args)
+            try:
+                ptProfiler.active.call(t, self._timeit, run_args, loops)
+            finally:
+                self._teardown(run_args)
+
+        if self.suite is not None:
+            self.suite.addTest(t)
+        return t
+
+    def run(self):
+        """Run the benchmark, returns the list of ptTest (one per param)"""
+        if self.func is None:
+            raise TypeError("ptBenchmark.run() requires a function to benchmark, use it as a decorator")
+        return [self._run_one(p) for p in (self.params if self.params is not None else [None])]
+
+    def __enter__(self):
+        self._gc_was_enabled = gc.isenabled()
+        if self.gc_disable:
+            gc.disable()
+        self._ts = _now_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        score = (_now_ns() - self._ts) / float(_PT_BENCHMARK_UNITS[self.unit])
+        if self._gc_was_enabled:
+            gc.enable()
+        if exc_type is not None:
+            return False
+
+        if self.test is None:
+            from perftrackerlib.client import ptTest
+            self.test = ptTest(self.tag, group=self.group, category=self.category, metrics=self.unit,
+                               less_better=True, loops=1, **self.test_kwargs)
+            if self.suite is not None:
+                self.suite.addTest(self.test)
+        self.test.add_score(score)
+        return False
+
+
 ##############################################################################
 # Autotests
 ##############################################################################
@@ -67,6 +263,64 @@ def _coverage():
     print(c.value)
     print(c.value)
 
+    from perftrackerlib.client import ptSuite, ptProfiler
+
+    suite = ptSuite()
+    calls = []
+
+    @ptBenchmark(suite=suite, group="list", params=[10, 1000], category="%d items", repeat=3, min_time_sec=0.01)
+    def sort(n):
+        """sort a list"""
+        sorted(range(n, 0, -1))
+
+    profiler = ptProfiler().activate()
+    tests = sort()
+    profiler.deactivate()
+    assert len(profiler.tests()) == 2 and "cProfile top" in tests[0].description
+    assert [t.category for t in tests] == ["10 items", "1000 items"]
+    assert all(len(t.scores) == 3 and len(t.deviations) == 3 and t.loops > 1 for t in tests)
+    assert tests[0].scores[0] < tests[1].scores[0] and tests[0].description.startswith("sort a list\n\ncProfile")
+    assert sort.__name__ == "sort" and len(suite.tests) == 2
+
+    bench = ptBenchmark("append", loops=10, repeat=2, unit="nsec", gc_disable=False,
+                        setup=lambda: [], teardown=lambda lst: calls.append(len(lst)))
+    bench(lambda lst: lst.append(1))
+    t = bench()[0]
+    assert t.loops == 10 and t.tag == "append" and calls == [10, 10], calls
+    try:
+        bench(1)
+        assert False
+    except TypeError:
+        pass
+
+    # the calibration trials get own setup() states, every timed repeat starts on a fresh one
+    del calls[:]
+    bench = ptBenchmark("pop", repeat=3, min_time_sec=0.001, setup=lambda: list(range(1000000)),
+                        teardown=lambda lst: calls.append(1000000 - len(lst)))
+    bench(lambda lst: lst.pop())
+    t = bench()[0]
+    assert t.loops > 1 and len(calls) > 3 and calls[-3:] == [t.loops] * 3, (t.loops, calls)
+
+    b = ptBenchmark("sleep", suite=suite, unit="msec")
+    for i in range(2):
+        with b:
+            time.sleep(0.01)
+    assert len(b.test.scores) == 2 and b.test.scores[0] >= 10 and gc.isenabled()
+    try:
+        with b:
+            raise KeyError()
+    except KeyError:
+        pass
+    assert len(b.test.scores) == 2 and gc.isenabled()
+
+    for args, kwargs in (((), {'unit': 'day'}), (("run",), {})):
+        try:
+            ptBenchmark(*args, **kwargs).run()
+            assert False
+        except (ValueError, TypeError):
+            pass
+    print(suite.tests)
+
 
 if __name__ == "__main__":
     _coverage()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+"""
+HDR-style (log-linear) histogram to record millions of samples (e.g. request latencies) in a fixed amount
+of memory and report the percentiles with a bounded relative error
+"""
+
+import math
+from collections import OrderedDict
+
+PT_HISTOGRAM_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class ptHistogram:
+    def __init__(self, resolution=0.001, bits=8, unit=""):
+        """
+        resolution - the lowest distinguishable value: 0.001 for 1 usec resolution of the samples in msec
+        bits       - values are counted in buckets of the 1/2^(bits-1) relative width, the percentiles error
+                     is within a half of it: 0.4% for bits=8
+        unit       - samples unit: 'ms', 'sec', ...
+
+        record() is O(1) and does not allocate memory (except for the values larger than ever seen before).
+        It is not thread-safe: record samples into per-thread (or per-process) histograms and merge() them,
+        use toDict()/fromDict() to pass a histogram between processes
+        """
+        assert resolution > 0
+        assert 2 <= bits <= 30
+
+        self.resolution = resolution
+        self.bits = bits
+        self.unit = unit
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+        self._scale = 1.0 / resolution
+        self._linear = 1 << bits  # values below it are counted in the buckets of resolution width
+        self._half_bits = bits - 1
+        self._counts = [0] * self._linear
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        unit = ", unit=%s" % self.unit if self.unit else ""
+        return "ptHistogram(count=%d, min=%s, max=%s, mean=%s%s)" % \
+               (self.count, str(self.min), str(self.max), str(self.mean()), unit)
+
+    def _index(self, value):
+        v = int(value * self._scale)
+        if v < self._linear:
+            return v
+        shift = v.bit_length() - self.bits
+        return (shift << self._half_bits) + (v >> shift)
+
+    def _bucket(self, index):
+        """Returns [low, high) values range of the bucket"""
+        if index < self._linear:
+            low, width = index, 1
+        else:
+            shift = (index >> self._half_bits) - 1
+            low, width = (index - (shift << self._half_bits)) << shift, 1 << shift
+        return low / self._scale, (low + width) / self._scale
+
+    def record(self, value, count=1):
+        if value < 0:
+            raise ValueError("ptHistogram can't record negative values: %s" % str(value))
+
+        index = self._index(value)
+        if index >= len(self._counts):
+            self._counts.extend([0] * (index + 1 - len(self._counts)))
+        self._counts[index] += count
+
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def record_many(self, values):
+        for v in values:
+            self.record(v)
+
+    def merge(self, other):
+        """Add other histogram samples to this one, the histograms resolution and bits must be the same"""
+        if other.resolution != self.resolution or other.bits != self.bits:
+            raise ValueError("can't merge histograms with different layout: resolution %s bits %d vs %s bits %d" %
+                             (str(self.resolution), self.bits, str(other.resolution), other.bits))
+        if not other.count:
+            return self
+
+        if len(other._counts) > len(self._counts):
+            self._counts.extend([0] * (len(other._counts) - len(self._counts)))
+        for index, cnt in enumerate(other._counts):
+            if cnt:
+                self._counts[index] += cnt
+
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentiles(self, percentiles=PT_HISTOGRAM_PERCENTILES):
+        """Returns the list of values (bucket middles) for given list of percentiles in one pass"""
+        if not self.count:
+            return [None] * len(percentiles)
+
+        ranks = sorted((max(1, int(math.ceil(p * self.count / 100.0))), n) for n, p in enumerate(percentiles))
+        ret = [None] * len(percentiles)
+
+        r = 0
+        total = 0
+        for index, cnt in enumerate(self._counts):
+            if not cnt:
+                continue
+            total += cnt
+            while r < len(ranks) and ranks[r][0] <= total:
+                low, high = self._bucket(index)
+                ret[ranks[r][1]] = min(max((low + high) / 2.0, self.min), self.max)
+                r += 1
+            if r == len(ranks):
+                break
+        return ret
+
+    def percentile(self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def getStats(self, percentiles=PT_HISTOGRAM_PERCENTILES):
+        """min, p50, p90, ... max and mean"""
+        ret = OrderedDict()
+        ret['min'] = self.min
+        for p, val in zip(percentiles, self.percentiles(percentiles)):
+            ret["p%s" % ("%g" % p)] = val
+        ret['max'] = self.max
+        ret['mean'] = self.mean()
+        return ret
+
+    def toDict(self):
+        """Compact json-serializable representation, the non-empty buckets are stored as (index delta, count)"""
+        buckets = []
+        prev = 0
+        for index, cnt in enumerate(self._counts):
+            if cnt:
+                buckets += [index - prev, cnt]
+                prev = index
+
+        ret = OrderedDict()
+        for key in ('resolution', 'bits', 'unit', 'count', 'sum', 'min', 'max'):
+            ret[key] = self.__dict__[key]
+        ret['buckets'] = buckets
+        return ret
+
+    @staticmethod
+    def fromDict(d):
+        h = ptHistogram(resolution=d['resolution'], bits=d['bits'], unit=d.get('unit', ""))
+        index = 0
+        buckets = d['buckets']
+        for n in range(0, len(buckets), 2):
+            index += buckets[n]
+            if index >= len(h._counts):
+                h._counts.extend([0] * (index + 1 - len(h._counts)))
+            h._counts[index] += buckets[n + 1]
+        h.count = d['count']
+        h.sum = d['sum']
+        h.min = d['min']
+        h.max = d['max']
+        return h
+
+
+##############################################################################
+# Autotests
+##############################################################################
+
+
+def _coverage():
+    import random
+    import json
+
+    values = [random.expovariate(0.1) for n in range(100000)] + [0, 0.0005, 1000000]
+    h = ptHistogram(unit="ms")
+    h.record_many(values[:50000])
+
+    h2 = ptHistogram(unit="ms")
+    for v in values[50000:]:
+        h2.record(v)
+    h += h2
+
+    values.sort()
+    for p in (1, 50, 90, 99, 99.9, 100):
+        exact = values[max(0, int(math.ceil(p * len(values) / 100.0)) - 1)]
+        approx = h.percentile(p)
+        assert abs(approx - exact) <= max(exact / 2 ** (h.bits - 1), h.resolution), (p, exact, approx)
+
+    assert h.count == len(values)
+    assert h.min == 0 and h.max == 1000000
+    assert abs(h.mean() - sum(values) / len(values)) < 0.000001
+
+    h3 = ptHistogram.fromDict(json.loads(json.dumps(h.toDict())))
+    assert h3.getStats() == h.getStats()
+    print(h3, h3.getStats())
+
+    try:
+        h.merge(ptHistogram(bits=4))
+        assert False
+    except ValueError:
+        pass
+
+    try:
+        h.record(-1)
+        assert False
+    except ValueError:
+        pass
+
+    assert ptHistogram().percentile(50) is None
+
+
+if __name__ == "__main__":
+    _coverage()
+    print("OK")
@@ -10,20 +10,35 @@ __license__ = "MIT"
 
 """
     HTTP connection pool with LIFO logic, and 2 implementations of connections: pycurl (fast) and httplib (slow).
-    HTTPS is supported.
+    HTTPS is supported, HTTP/2 (with the streams multiplexing by the 'curlmulti' engine) is supported by pycurl.
 """
+import os
 import threading
 import socket
+import select
+import time
 import re
 import logging
 import six
 import pycurl
+from collections import deque
+
+try:
+    import selectors
+except ImportError:
+    selectors = None  # python2: plain select()
 
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
 
+_PYCURL_ACTIVESOCKET = getattr(pycurl, "ACTIVESOCKET", pycurl.LASTSOCKET)
+_PYCURL_SIZE_DOWNLOAD = getattr(pycurl, "SIZE_DOWNLOAD_T", pycurl.SIZE_DOWNLOAD)
+# libcurl verbose info line of the TLS handshake offering the cached session: 'SSL re-using session ID' before
+# 8.x, 'SSL reusing session ID' or 'SSL reusing session with ALPN ...' since then
+_PYCURL_TLS_RESUME_RE = re.compile(br"^SSL re-?using session")
+
 if six.PY2:
     import httplib
     from StringIO import StringIO as BytesIO
@@ -39,11 +54,102 @@ try:
 except ImportError:
     pass
 
+HTTP_POOL_TIMEOUT_SEC = 60
+HTTP_POOL_IDLE_TIMEOUT_SEC = 60
+HTTP_POOL_MAX_LIFETIME_SEC = 600
+HTTP_POOL_MAX_STREAMS = 100  # default max concurrent HTTP/2 streams of a pool (and so of its connection)
+HTTP_MULTI_MAX_STREAMS = 1000  # CurlMulti per connection streams limit, the pools are limited by max_conns
+
+# the response body policy, the max_body argument of the pycurl connections request(): None - keep the whole
+# body, 0 - discard it (only its length is counted), N - keep the first N bytes (enough for a validator)
+HTTP_BODY_KEEP = None
+HTTP_BODY_DISCARD = 0
+
+_PYCURL_HTTP_VERSIONS = {getattr(pycurl, "CURL_HTTP_VERSION_%s" % v, -1): n
+                         for v, n in (("1_0", "1.0"), ("1_1", "1.1"), ("2_0", "2"), ("3", "3"))}
+
+
+def _socket_is_alive(sock):
+    """
+    An idle keep-alive connection socket must not be readable, otherwise the server has closed it (or sent
+    something unexpected), so it can't be reused
+    """
+    if sock is None or sock == -1:
+        return True  # not connected yet
+    try:
+        r, _, _ = select.select([sock], [], [], 0)
+    except (ValueError, socket.error, select.error):
+        return False
+    return not r
+
+
+def _conn_is_alive(con):
+    if hasattr(con, "is_alive"):
+        return con.is_alive()
+    return _socket_is_alive(getattr(con, "sock", None))
+
+
+class HTTPCurlShare:
+    def __init__(self, track_tls=False):
+        """
+        pycurl.CurlShare of the DNS cache and TLS sessions of the pool members, so a new pool member (or a
+        reconnect) doesn't resolve the name again and resumes the TLS session instead of the full handshake.
+        pycurl serializes the share access between the threads by its own locks (CURLSHOPT_LOCKFUNC).
+        The connections cache is not shared: libcurl doesn't support it between concurrent threads (the
+        connections get closed instead of reuse), the 'curlmulti' engine shares the CurlMulti one anyway.
+        Stats:
+            connects       - connections opened
+            tls_handshakes - TLS connections opened
+            tls_resumed    - track_tls=True only: TLS handshakes which offered the shared session to resume
+                             (the server may still refuse it). It is counted from the libcurl verbose info, so
+                             the https members run with CURLOPT_VERBOSE and every header line and body chunk
+                             passes through a python DEBUGFUNCTION, i.e. it costs the discarded bodies too
+        """
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self._lock = threading.Lock()
+        self.track_tls = track_tls
+        self.connects = 0
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+
+    def attach(self, curl):
+        curl.setopt(pycurl.SHARE, self.share)
+
+    def account(self, con):
+        """Count the completed transfer of the con connection (HTTPConnectionPycurl)"""
+        if not con.new_connections:
+            return
+        tls = con.prefix.startswith("https") and con.curl.getinfo(pycurl.APPCONNECT_TIME) > 0
+        with self._lock:
+            self.connects += con.new_connections
+            if tls:
+                self.tls_handshakes += con.new_connections
+                self.tls_resumed += con.tls_resumed
+
+    def get_stats(self):
+        with self._lock:
+            stats = {'connects': self.connects, 'tls_handshakes': self.tls_handshakes}
+            if self.track_tls:
+                stats['tls_resumed'] = self.tls_resumed
+            return stats
+
 
 class HTTPConnectionPycurl:
-    def __init__(self, prefix, key_file=None, cert_file=None):
+    def __init__(self, prefix, key_file=None, cert_file=None, http2=False, share=None):
+        """
+        http2 - negotiate HTTP/2 by TLS ALPN (so https only, http stays HTTP/1.1), the transfers wait for
+                an existing connection to multiplex on (PIPEWAIT) instead of opening a new one.
+                Otherwise HTTP/1.1 is used
+        share - HTTPCurlShare of the pool members
+        """
         self.prefix = prefix
+        self.http2 = http2
+        self.share = share
         self.curl = pycurl.Curl()
+        if share:
+            share.attach(self.curl)
         self.curl.setopt(pycurl.SSL_VERIFYPEER, 0)
         self.curl.setopt(pycurl.SSL_VERIFYHOST, 0)
         if key_file:
@@ -51,17 +157,47 @@ class HTTPConnectionPycurl:
         if cert_file:
             self.curl.setopt(pycurl.SSLCERT, cert_file)
         self.curl.setopt(pycurl.ENCODING, "")
+        if http2:
+            self.curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            self.curl.setopt(pycurl.PIPEWAIT, 1)
+        else:
+            # libcurl >= 7.62 negotiates HTTP/2 for https by default
+            self.curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_1_1)
         self.buf = None
+        self.max_body = HTTP_BODY_KEEP
+        self.body_length = 0
         self.status = 0
         self.response_headers = None
         self._response_string = None
         self.reason = ''
+        self.http_version = None
+        self.new_connections = 0
+        self.connection_id = None
         self.cleaning_needed = False
+        self.tls_resumed = 0
+        self._debug_level = 0
+        self._track_tls = bool(share) and share.track_tls and prefix.startswith("https")
+        if self._track_tls:
+            self.curl.setopt(pycurl.VERBOSE, 1)
+            self.curl.setopt(pycurl.DEBUGFUNCTION, self._debug)
 
     def close(self):
         self.curl.close()
 
-    def request(self, verb, path, body, headers):
+    def is_alive(self):
+        return _socket_is_alive(self.curl.getinfo(_PYCURL_ACTIVESOCKET))
+
+    def request(self, verb, path, body, headers, max_body=HTTP_BODY_KEEP):
+        self._prepare(verb, path, body, headers, max_body)
+        self.curl.perform()
+        self._account()
+
+    def _account(self):
+        if self.share:
+            self.new_connections = self.curl.getinfo(pycurl.NUM_CONNECTS)
+            self.share.account(self)
+
+    def _prepare(self, verb, path, body, headers, max_body=HTTP_BODY_KEEP):
         c = self.curl
         hdrs = [str(h + ": " + v) for h, v in six.iteritems(headers)] if headers else []
         verb = verb.upper()
@@ -99,28 +235,52 @@ class HTTPConnectionPycurl:
             raise pycurl.error("unsupported verb: " + verb)
         c.setopt(pycurl.URL, str(self.prefix + path))
         c.setopt(pycurl.HTTPHEADER, hdrs)
-        self.buf = BytesIO()
+        self.max_body = max_body
         self.response_headers = []
-        c.setopt(pycurl.WRITEFUNCTION, self.buf.write)
+        self.tls_resumed = 0
+        if max_body is None:
+            self.buf = BytesIO()
+            c.setopt(pycurl.WRITEFUNCTION, self.buf.write)
+        elif max_body > 0:
+            self.buf = BytesIO()
+            c.setopt(pycurl.WRITEFUNCTION, self._write_head)
+        else:
+            self.buf = None
+            c.setopt(pycurl.WRITEFUNCTION, self._write_discard)
         c.setopt(pycurl.HEADERFUNCTION, self._header_handler)
-        c.perform()
+
+    def _write_head(self, data):
+        room = self.max_body - self.buf.tell()
+        if room > 0:
+            self.buf.write(data[:room])
+
+    def _write_discard(self, data):
+        pass
 
     def getresponse(self):
-        self.status = self.curl.getinfo(pycurl.HTTP_CODE)
+        c = self.curl
+        self.status = c.getinfo(pycurl.HTTP_CODE)
         m = re.match(r'HTTP\/\S*\s*\d+\s*(.*?)\s*$', self._response_string)
         if m:
             self.reason = m.group(1)
         else:
             self.reason = ''
+        self.http_version = _PYCURL_HTTP_VERSIONS.get(c.getinfo(pycurl.INFO_HTTP_VERSION))
+        self.new_connections = c.getinfo(pycurl.NUM_CONNECTS)
+        self.connection_id = "%s:%d" % (c.getinfo(pycurl.LOCAL_IP), c.getinfo(pycurl.LOCAL_PORT))
+        self.body_length = int(c.getinfo(_PYCURL_SIZE_DOWNLOAD))
         return self
 
     def set_debuglevel(self, level):
-        self.curl.setopt(pycurl.VERBOSE, 1 if level else 0)
-        if level:
+        self._debug_level = level
+        self.curl.setopt(pycurl.VERBOSE, 1 if level or self._track_tls else 0)
+        if level or self._track_tls:
             self.curl.setopt(pycurl.DEBUGFUNCTION, self._debug)
 
     def _debug(self, debug_type, debug_msg):
-        if debug_type in (0, 3, 4, 5, 6):
+        if debug_type == 0 and self._track_tls and _PYCURL_TLS_RESUME_RE.match(debug_msg):
+            self.tls_resumed += 1
+        if not self._debug_level or debug_type in (0, 3, 4, 5, 6):
             return  # skip details(0), body (3,4), and ssl (5,6)
         if type(debug_msg) == bytes:
             debug_msg = debug_msg.decode("utf-8")
@@ -129,7 +289,8 @@ class HTTPConnectionPycurl:
         logging.log(logging.DEBUG - 1, "pycurl(%d): %s" % (debug_type, debug_msg.strip()))
 
     def read(self):
-        return self.buf.getvalue()
+        """The response body, or its first max_body bytes, see request()"""
+        return self.buf.getvalue() if self.buf is not None else b""
 
     def getheaders(self):
         return self.response_headers
@@ -153,78 +314,423 @@ class HTTPConnectionPycurl:
         self.response_headers.append((x[0].strip(), x[1].strip()))
 
 
+class HTTPResponse:
+    """Detached copy of the completed request response, the connection can be reused after it is taken"""
+    def __init__(self, con):
+        con.getresponse()
+        self.status = con.status
+        self.reason = con.reason
+        self.http_version = con.http_version
+        self.new_connections = con.new_connections
+        self.connection_id = con.connection_id
+        self.body_length = con.body_length
+        self.response_headers = con.response_headers
+        self._data = con.read()
+
+    def read(self):
+        return self._data
+
+    def getheaders(self):
+        return self.response_headers
+
+    def getheader(self, header, default=None):
+        for h, v in self.response_headers:
+            if h.lower() == header.lower():
+                return v
+        return default
+
+
+class HTTPCurlMultiLoop:
+    """
+    pycurl.CurlMulti event loop running the transfers of all the 'curlmulti' HTTPPool connections on one
+    thread: libcurl reports the sockets to watch (M_SOCKETFUNCTION) and the timeout (M_TIMERFUNCTION),
+    the loop waits for them by select (or epoll via selectors) and calls socket_action().
+    The connections cache belongs to the CurlMulti, so the HTTP/2 transfers to the same origin are
+    multiplexed on one connection
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get():
+        with HTTPCurlMultiLoop._instance_lock:
+            if HTTPCurlMultiLoop._instance is None:
+                HTTPCurlMultiLoop._instance = HTTPCurlMultiLoop()
+            return HTTPCurlMultiLoop._instance
+
+    def __init__(self):
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer)
+        self.multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        if hasattr(pycurl, "M_MAX_CONCURRENT_STREAMS"):  # pycurl >= 7.44, the default is 100
+            self.multi.setopt(pycurl.M_MAX_CONCURRENT_STREAMS, HTTP_MULTI_MAX_STREAMS)
+        self._selector = selectors.DefaultSelector() if selectors else None
+        self._fds = {}  # fd -> pycurl.POLL_*
+        self._timeout_ms = -1
+        self._pending = deque()
+        self._running = {}  # curl -> connection
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        if self._selector:
+            self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self.in_flight = 0
+        self.completed = 0
+        self._thread = threading.Thread(target=self._run, name="HTTPCurlMultiLoop")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _on_socket(self, event, fd, multi, data):
+        if self._selector:
+            if fd in self._fds:
+                self._selector.unregister(fd)
+            if event != pycurl.POLL_REMOVE:
+                mask = 0
+                if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+                    mask |= selectors.EVENT_READ
+                if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+                    mask |= selectors.EVENT_WRITE
+                self._selector.register(fd, mask)
+        if event == pycurl.POLL_REMOVE:
+            self._fds.pop(fd, None)
+        else:
+            self._fds[fd] = event
+
+    def _on_timer(self, timeout_ms):
+        self._timeout_ms = timeout_ms
+
+    def submit(self, con):
+        """Start the prepared connection transfer, con._done(error) is called on the loop thread"""
+        with self._lock:
+            self._pending.append(con)
+            self.in_flight += 1
+        os.write(self._wake_w, b"x")
+
+    def _wait(self):
+        timeout = None if self._timeout_ms < 0 else self._timeout_ms / 1000.0
+        if self._selector:
+            events = self._selector.select(timeout)
+            ready = {}
+            for key, mask in events:
+                if key.fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                ready[key.fd] = (pycurl.CSELECT_IN if mask & selectors.EVENT_READ else 0) | \
+                                (pycurl.CSELECT_OUT if mask & selectors.EVENT_WRITE else 0)
+            return ready
+
+        rlist = [fd for fd, ev in self._fds.items() if ev in (pycurl.POLL_IN, pycurl.POLL_INOUT)]
+        wlist = [fd for fd, ev in self._fds.items() if ev in (pycurl.POLL_OUT, pycurl.POLL_INOUT)]
+        r, w, _ = select.select(rlist + [self._wake_r], wlist, [], timeout)
+        if self._wake_r in r:
+            os.read(self._wake_r, 4096)
+        ready = {}
+        for fd in r:
+            if fd != self._wake_r:
+                ready[fd] = pycurl.CSELECT_IN
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | pycurl.CSELECT_OUT
+        return ready
+
+    def _action(self, fd, mask):
+        while True:
+            ret, _ = self.multi.socket_action(fd, mask)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+    def _run(self):
+        while True:
+            try:
+                self._iterate()
+            except Exception as e:
+                logging.error("HTTPCurlMultiLoop: %s" % str(e))
+
+    def _iterate(self):
+        with self._lock:
+            pending, self._pending = self._pending, deque()
+        for con in pending:
+            try:
+                self.multi.add_handle(con.curl)
+            except pycurl.error as e:
+                with self._lock:
+                    self.in_flight -= 1
+                con._done(e)
+                continue
+            self._running[con.curl] = con
+
+        ready = self._wait()
+        if ready:
+            for fd, mask in ready.items():
+                self._action(fd, mask)
+        else:
+            self._action(pycurl.SOCKET_TIMEOUT, 0)
+
+        while True:
+            queued, ok, failed = self.multi.info_read()
+            for c in ok:
+                self._complete(c, None)
+            for c, errno, errmsg in failed:
+                self._complete(c, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+    def _complete(self, curl, error):
+        self.multi.remove_handle(curl)
+        con = self._running.pop(curl)
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        try:
+            con._done(error)
+        except Exception as e:
+            logging.error("HTTPCurlMultiLoop: completion callback failed: %s" % str(e))
+
+
+class HTTPConnectionCurlMulti(HTTPConnectionPycurl):
+    """
+    The pycurl connection which transfers on the HTTPCurlMultiLoop thread, request() blocks the caller
+    until the response is received, request_async() returns immediately
+    """
+    def __init__(self, prefix, key_file=None, cert_file=None, http2=False, share=None, loop=None):
+        HTTPConnectionPycurl.__init__(self, prefix, key_file=key_file, cert_file=cert_file, http2=http2,
+                                      share=share)
+        self.loop = loop if loop else HTTPCurlMultiLoop.get()
+        self._event = threading.Event()
+        self._callback = None
+        self._error = None
+
+    def request_async(self, verb, path, body, headers, callback, max_body=HTTP_BODY_KEEP):
+        """callback(con, error) is called on the loop thread when the transfer completes"""
+        self._prepare(verb, path, body, headers, max_body)
+        self._callback = callback
+        self._error = None
+        self.loop.submit(self)
+
+    def request(self, verb, path, body, headers, max_body=HTTP_BODY_KEEP):
+        self._event.clear()
+        self.request_async(verb, path, body, headers, lambda con, error: self._event.set(), max_body)
+        self._event.wait()
+        if self._error:
+            raise self._error
+
+    def _done(self, error):
+        self._error = error
+        if error is None:
+            self._account()
+        self._callback(self, error)
+
+
+class LIFOPoolTimeout(Exception):
+    pass
+
+
 class _ctx_manager:
-    def __init__(self, pool):
+    def __init__(self, pool, timeout=None):
         self.pool = pool
+        self.timeout = timeout
 
     def __enter__(self):
-        self.tup = self.pool.get()
+        self.tup = self.pool.get(timeout=self.timeout)
         return self.tup
 
     def __exit__(self, exc_type, exc_value, traceback):
         con = self.tup[0]
-        if exc_type is not None or getattr(con, "_invalidate", False):
-            self.pool.cnt -= 1
-            self.pool._dctor(con)
-            # logging.error("!!!!pool.borrow.exit - error. cnt=%d, inpool=%d", pool.cnt, len(pool._items))
+        if exc_type is not None:
+            self.pool.discard(con)
         else:
             self.pool.put(con)
-            # logging.error("!!!!pool.borrow.exit - ok. cnt=%d, inpool=%d", pool.cnt, len(pool._items))
 
 
 class LIFOPool(object):
-    def __init__(self, ctor, dctor, max_items=10, verbose=None):
+    def __init__(self, ctor, dctor, max_items=10, verbose=None, max_size=None, timeout=None,
+                 idle_timeout=None, max_lifetime=None, is_alive=None):
+        """
+        max_items    - max number of the idle items kept in the pool
+        max_size     - max number of the items (idle + borrowed), get() waits for a free item when it is
+                       reached, None - no limit
+        timeout      - default get() wait timeout (sec), LIFOPoolTimeout is raised when it expires,
+                       None - wait forever
+        idle_timeout - the items which are idle for longer are destroyed (sec)
+        max_lifetime - the items which were created earlier are destroyed instead of reuse (sec)
+        is_alive     - is_alive(item) cheap check if an idle item can be reused
+        """
         self._ctor = ctor
         self._dctor = dctor
         self.max_items = max(0, max_items)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self._is_alive = is_alive
         self.verbose = logging.getLogger().getEffectiveLevel() < logging.DEBUG if verbose is None else verbose
-        self._items = []
-        self._lock = threading.Lock()
+        self._items = deque()  # (item, created, last used), the most recently used is on the right
+        self._created = {}  # id(item) -> created, for all the items (idle and borrowed)
+        self._cond = threading.Condition(threading.Lock())
         self.cnt = 0
 
+        self.waits = 0
+        self.creates = 0
+        self.reuses = 0
+        self.evictions = 0
+
     def __del__(self):
-        self.clear()
+        if hasattr(self, "_cond"):  # HTTPPool.__init__ may fail before LIFOPool.__init__
+            self.clear()
+
+    def _expired(self, created, now):
+        return self.max_lifetime is not None and now - created > self.max_lifetime
+
+    def _destroy(self, items):
+        for item in items:
+            self._dctor(item)
+
+    def _evict_idle(self, now):
+        """Pop the idle and expired items, the caller must hold the lock and destroy them out of the lock"""
+        evicted = []
+        while self._items and self.idle_timeout is not None and now - self._items[0][2] > self.idle_timeout:
+            evicted.append(self._items.popleft()[0])
+        for item in evicted:
+            self._forget(item)
+        return evicted
+
+    def _forget(self, item):
+        self._created.pop(id(item), None)
+        self.cnt -= 1
+        self.evictions += 1
+        self._cond.notify()
 
     def clear(self):
         """Clear all pool"""
-        with self._lock:
-            while self._items:
+        with self._cond:
+            items = [item for item, _, _ in self._items]
+            self._items.clear()
+            for item in items:
+                self._created.pop(id(item), None)
                 self.cnt -= 1
-                self._dctor(self._items.pop())
+            self._cond.notify_all()
+        self._destroy(items)
+
+    def evict(self):
+        """Destroy the idle items which are expired (idle_timeout, max_lifetime), returns their number"""
+        now = time.time()
+        with self._cond:
+            evicted = self._evict_idle(now)
+            for entry in [e for e in self._items if self._expired(e[1], now)]:
+                self._items.remove(entry)
+                self._forget(entry[0])
+                evicted.append(entry[0])
+        self._destroy(evicted)
+        return len(evicted)
 
-    def get(self):
+    def get(self, timeout=None):
         """Get an (item, is_new) from the pool or create a new one. After use, return item via put().
-        Or, better, use borrow() that ensures the item is properly returned"""
-        with self._lock:
-            if self._items:
-                return self._items.pop(), False
-            self.cnt += 1
-        con = self._ctor()
+        Or, better, use borrow() that ensures the item is properly returned.
+        If there are max_size items already, wait up to timeout (or self.timeout) sec for a returned item"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        waited = False
+
+        while True:
+            now = time.time()
+            item = None
+            create = False
+            with self._cond:
+                evicted = self._evict_idle(now)
+                if self._items:
+                    item, created, _ = self._items.pop()
+                elif self.max_size is None or self.cnt < self.max_size:
+                    self.cnt += 1
+                    self.creates += 1
+                    create = True
+                else:
+                    if deadline is not None and now >= deadline:
+                        raise LIFOPoolTimeout("no free item in the pool of %d items in %.1f sec" %
+                                              (self.max_size, timeout))
+                    if not waited:
+                        self.waits += 1
+                        waited = True
+                    self._cond.wait(None if deadline is None else deadline - now)
+            self._destroy(evicted)
+
+            if create:
+                break
+            if item is None:
+                continue
+            if self._expired(created, now) or (self._is_alive and not self._is_alive(item)):
+                with self._cond:
+                    self._forget(item)
+                self._dctor(item)
+                continue
+            with self._cond:
+                self.reuses += 1
+            return item, False
+
+        try:
+            con = self._ctor()
+        except Exception:
+            with self._cond:
+                self.cnt -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(con)] = time.time()
         if self.verbose:
             con.set_debuglevel(1)
         return con, True
 
     def put(self, item):
-        """Return item, previously obtained via get(). Do not return bad (not reusable) items.
+        """Return item, previously obtained via get(). Do not return bad (not reusable) items, use discard().
         Or, better, use borrow() that ensures the item is properly returned"""
-        with self._lock:
-            self._items.append(item)
-            while len(self._items) > self.max_items:
-                self.cnt -= 1
-                self._dctor(self._items.pop(0))
+        now = time.time()
+        evicted = []
+        with self._cond:
+            created = self._created.get(id(item), now)
+            if self._expired(created, now):
+                self._forget(item)
+                evicted.append(item)
+            else:
+                self._items.append((item, created, now))
+                self._cond.notify()
+                while len(self._items) > self.max_items:
+                    old = self._items.popleft()[0]
+                    self._forget(old)
+                    evicted.append(old)
+        self._destroy(evicted)
 
-    def borrow(self):
+    def discard(self, item):
+        """Destroy the bad item obtained via get()"""
+        with self._cond:
+            self._created.pop(id(item), None)
+            self.cnt -= 1
+            self._cond.notify()
+        self._dctor(item)
+
+    def borrow(self, timeout=None):
         """Exception-safe fool-proof way to get and return the (item, is_new). Use with keyword 'with' like this:
         with pool.borrow() as (x, is_new):
             do_stuff(x)
         """
-        return _ctx_manager(self)
+        return _ctx_manager(self, timeout)
+
+    def get_stats(self):
+        with self._cond:
+            return {'items': self.cnt, 'idle': len(self._items), 'waits': self.waits, 'creates': self.creates,
+                    'reuses': self.reuses, 'evictions': self.evictions}
 
 
 class HTTPPool(LIFOPool):
-    """Connection pool, keeps at most <max_conns> connections to given <server_uri>.
-    Parses URI and uses appropriate HTTP/HTTPS connection objects.
-    If <max_items> == 0, it is equivalent to keep-alive = False
+    """Connection pool, keeps at most <max_conns> connections to given <server_uri>, borrow() waits up to
+    <timeout> sec for a free connection when all of them are busy.
+    Parses URI and uses appropriate HTTP/HTTPS connection objects. The engines:
+        pycurl    - blocking pycurl transfers in the caller thread
+        curlmulti - all the transfers run on one HTTPCurlMultiLoop thread, see request_async()
+        httplib   - blocking python httplib connections
+    If <max_conns> == 0, it is equivalent to keep-alive = False (and there is no connections limit)
+    The pycurl engines members share the DNS cache and TLS sessions, see HTTPCurlShare and get_stats(),
+    <share> = False disables it. <track_tls> = True counts the resumed TLS sessions too (it is expensive)
+    If <http2> is True, the pycurl engines negotiate HTTP/2 for https. The 'curlmulti' pool multiplexes the
+    requests on one connection then, the pool items are the streams and <max_conns> is the max concurrent
+    streams number (see HTTP_POOL_MAX_STREAMS)
     Connections are handled in LIFO order, thread safety is provided.
     Public properties (readonly):
         host - server host (from URI)
@@ -232,7 +738,8 @@ class HTTPPool(LIFOPool):
         url - full server part of uri, like "https://yourserver.com:1234"
     """
     def __init__(self, server_uri, max_conns=10, parse_exception=Exception, key_file=None, cert_file=None,
-                 verbose=None, engine="pycurl"):
+                 verbose=None, engine="pycurl", timeout=HTTP_POOL_TIMEOUT_SEC, idle_timeout=HTTP_POOL_IDLE_TIMEOUT_SEC,
+                 max_lifetime=HTTP_POOL_MAX_LIFETIME_SEC, http2=False, share=True, track_tls=False):
         u = urlparse(server_uri)
         if u.params != '':
             raise parse_exception("Invalid URI: " + server_uri)
@@ -246,12 +753,21 @@ class HTTPPool(LIFOPool):
 
         self.url = server_uri
 
-        if engine == "pycurl":
+        self.engine = engine
+        self.http2 = http2
+        self.share = None
+        if engine in ("pycurl", "curlmulti"):
+            cls = HTTPConnectionPycurl if engine == "pycurl" else HTTPConnectionCurlMulti
+            if share:
+                self.share = HTTPCurlShare(track_tls=track_tls)
+
             def ctor():
-                return HTTPConnectionPycurl(server_uri, key_file=key_file, cert_file=cert_file)
+                return cls(server_uri, key_file=key_file, cert_file=cert_file, http2=http2, share=self.share)
             self.temporary_errors = (pycurl.error, socket.error)
-            self.fatal_errors = (pycurl.error, )   # we don't know suitable errors
+            self.fatal_errors = (pycurl.error, LIFOPoolTimeout)   # we don't know suitable errors
         elif engine == "httplib":
+            if http2:
+                raise ValueError("HTTP/2 is not supported by the 'httplib' engine")
             if u.scheme == 'https':
                 def ctor():
                     return httplib.HTTPSConnection(self.host, self.port, key_file=key_file, cert_file=cert_file)
@@ -259,11 +775,50 @@ class HTTPPool(LIFOPool):
                 def ctor():
                     return httplib.HTTPConnection(self.host, self.port)
             self.temporary_errors = (httplib.BadStatusLine, httplib.ImproperConnectionState, socket.error)
-            self.fatal_errors = (httplib.HTTPException, )
+            self.fatal_errors = (httplib.HTTPException, LIFOPoolTimeout)
         else:
             raise Exception("unknown http engine")
 
-        LIFOPool.__init__(self, ctor=ctor, dctor=lambda x: x.close(), max_items=max_conns, verbose=verbose)
+        LIFOPool.__init__(self, ctor=ctor, dctor=lambda x: x.close(), max_items=max_conns, verbose=verbose,
+                          max_size=max_conns if max_conns > 0 else None, timeout=timeout, idle_timeout=idle_timeout,
+                          max_lifetime=max_lifetime, is_alive=_conn_is_alive)
+
+    def get_stats(self):
+        stats = LIFOPool.get_stats(self)
+        if self.share:
+            stats.update(self.share.get_stats())
+        return stats
+
+    def request_async(self, verb, path, body, headers, callback, max_body=HTTP_BODY_KEEP):
+        """
+        curlmulti engine only: start the request and return, callback(response, error) is called on the
+        HTTPCurlMultiLoop thread when it completes (response is HTTPResponse or None on error). Blocks while
+        all the max_conns connections are in flight, so don't call it from a callback.
+        max_body - the response body policy: HTTP_BODY_KEEP, HTTP_BODY_DISCARD or max bytes to keep
+        """
+        if self.engine != "curlmulti":
+            raise ValueError("request_async() requires the 'curlmulti' engine, the pool engine is '%s'" %
+                             self.engine)
+        con, _ = self.get()
+
+        def _done(con, error):
+            response = None
+            if error is None:
+                try:
+                    response = HTTPResponse(con)
+                except Exception as e:
+                    error = e
+            if error is None:
+                self.put(con)
+            else:
+                self.discard(con)
+            callback(response, error)
+
+        try:
+            con.request_async(verb, path, body, headers, _done, max_body)
+        except Exception:
+            self.discard(con)
+            raise
 
 
 ##############################################################################
@@ -273,8 +828,227 @@ class HTTPPool(LIFOPool):
 
 def _coverage():
     p = HTTPPool("127.0.0.1")
+
+    class Item:
+        alive = True
+
+        def set_debuglevel(self, level):
+            pass
+
+    destroyed = []
+    pool = LIFOPool(Item, destroyed.append, max_items=2, max_size=3, timeout=0.1, idle_timeout=0.2,
+                    max_lifetime=0.6, is_alive=lambda item: item.alive)
+
+    # hard cap: the 4th get() waits and times out
+    items = [pool.get()[0] for i in range(3)]
+    try:
+        pool.get()
+        assert False
+    except LIFOPoolTimeout:
+        pass
+
+    # the waiter gets the returned item
+    threading.Timer(0.05, pool.put, args=(items[2],)).start()
+    item, is_new = pool.get(timeout=1)
+    assert item is items[2] and not is_new
+
+    # max_items: only 2 idle items are kept, LIFO order
+    for i in items:
+        pool.put(i)
+    assert pool.cnt == 2 and destroyed == [items[0]]
+    item = pool.get()[0]
+    assert item is items[2]
+    pool.put(item)
+
+    # liveness check
+    items[1].alive = items[2].alive = False
+    with pool.borrow() as (item, is_new):
+        assert is_new and items[1] in destroyed and items[2] in destroyed
+
+    # idle timeout
+    time.sleep(0.3)
+    assert pool.evict() == 1 and pool.cnt == 0
+
+    # max lifetime
+    item = pool.get()[0]
+    time.sleep(0.65)
+    pool.put(item)
+    assert item in destroyed and pool.cnt == 0
+
+    stats = pool.get_stats()
+    print(stats)
+    assert stats['waits'] == 2 and stats['reuses'] == 2 and stats['evictions'] == 5
+
+    _coverage_curlmulti()
+    _coverage_tls()
     print("OK")
 
 
+def _coverage_curlmulti():
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = self.path.encode()
+            self.send_response(200 if self.path != "/missing" else 404)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    p = HTTPPool("http://127.0.0.1:%d" % server.server_address[1], engine="curlmulti", max_conns=4)
+    with p.borrow() as (con, is_new):
+        con.request("GET", "/sync", None, {})
+        assert con.getresponse().read() == b"/sync"
+
+    results = []
+    done = threading.Event()
+
+    def callback(response, error):
+        results.append((response, error))
+        if len(results) == 20:
+            done.set()
+
+    for n in range(20):
+        p.request_async("GET", "/%d" % n if n else "/missing", None, {}, callback)
+    assert done.wait(10)
+    assert sorted(r.status for r, e in results) == [200] * 19 + [404]
+    assert set(r.read() for r, e in results if r.status == 200) == set(("/%d" % n).encode() for n in range(1, 20))
+    assert set(r.http_version for r, e in results) == set(["1.1"])
+    assert len(set(r.connection_id for r, e in results)) == sum(r.new_connections for r, e in results) + 1
+
+    # body policy: the length is counted anyway
+    with p.borrow() as (con, is_new):
+        for max_body, data in ((HTTP_BODY_DISCARD, b""), (3, b"/bo"), (HTTP_BODY_KEEP, b"/body")):
+            con.request("GET", "/body", None, {}, max_body=max_body)
+            assert con.getresponse().read() == data and con.body_length == 5
+
+    # shared DNS cache and TLS sessions, the connections are per member
+    p1 = HTTPPool(p.url, engine="pycurl")
+    with p1.borrow() as (con1, is_new):
+        con1.request("GET", "/1", None, {})
+        with p1.borrow() as (con2, is_new):
+            con2.request("GET", "/2", None, {})
+            assert con2.getresponse().read() == b"/2" and con2.new_connections == 1
+        con1.request("GET", "/1", None, {})
+    stats = p1.get_stats()
+    assert stats['connects'] == 2 and stats['tls_handshakes'] == 0 and 'tls_resumed' not in stats, stats
+
+    # HTTP/2 is negotiated by TLS ALPN, so plain http stays HTTP/1.1
+    p2 = HTTPPool(p.url, engine="curlmulti", http2=True)
+    with p2.borrow() as (con, is_new):
+        con.request("GET", "/h2", None, {})
+        assert con.getresponse().read() == b"/h2" and con.http_version == "1.1"
+    try:
+        HTTPPool(p.url, engine="httplib", http2=True)
+        assert False
+    except ValueError:
+        pass
+
+    p = HTTPPool("http://127.0.0.1:1", engine="curlmulti")
+    done.clear()
+    del results[:]
+    p.request_async("GET", "/", None, {}, lambda r, e: results.append((r, e)) or done.set())
+    assert done.wait(10) and results[0][0] is None and isinstance(results[0][1], pycurl.error)
+
+    loop = HTTPCurlMultiLoop.get()
+    print("curlmulti: in flight %d, completed %d" % (loop.in_flight, loop.completed))
+    server.shutdown()
+
+
+def _coverage_tls():
+    import ssl
+    import shutil
+    import tempfile
+    import subprocess
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    # the resumed sessions counter is taken from the libcurl info lines
+    con = HTTPConnectionPycurl("https://127.0.0.1", share=HTTPCurlShare(track_tls=True))
+    for msg in (b"SSL re-using session ID", b"SSL reusing session with ALPN '-'", b"SSL connection using TLSv1.3"):
+        con._debug(0, msg)
+    con._debug(3, b"SSL reusing session")  # the body data
+    assert con.tls_resumed == 2
+    con.close()
+
+    tmpdir = tempfile.mkdtemp()
+    key, cert = os.path.join(tmpdir, "key.pem"), os.path.join(tmpdir, "cert.pem")
+    try:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+                               "-out", cert, "-subj", "/CN=127.0.0.1", "-days", "1"],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        shutil.rmtree(tmpdir)
+        print("openssl is not found, skipping the TLS test: %s" % str(e))
+        return
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = b"x" * 65536
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(("127.0.0.1", 0), Handler)
+    ctx = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_SERVER", ssl.PROTOCOL_SSLv23))
+    ctx.load_cert_chain(cert, key)
+    server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = "https://127.0.0.1:%d" % server.server_address[1]
+
+    try:
+        # 'pycurl' members have own connections ('curlmulti' would reuse the idle one of the CurlMulti cache)
+        for track_tls in (False, True):
+            p = HTTPPool(url, engine="pycurl", track_tls=track_tls)
+            with p.borrow() as (con1, is_new):
+                con1.request("GET", "/", None, {}, max_body=HTTP_BODY_DISCARD)
+                assert con1._track_tls == track_tls  # no CURLOPT_VERBOSE otherwise
+                with p.borrow() as (con2, is_new):
+                    con2.request("GET", "/", None, {}, max_body=HTTP_BODY_DISCARD)
+                    assert con2.getresponse().status == 200 and con2.body_length == 65536
+            stats = p.get_stats()
+            assert stats['connects'] == stats['tls_handshakes'] == 2, stats
+            # the first handshake has no session to resume
+            assert stats.get('tls_resumed') == (1 if track_tls else None), stats
+            p.clear()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+
+
 if __name__ == "__main__":
     _coverage()
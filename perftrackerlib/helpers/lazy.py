@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, absolute_import
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+"""
+Lazy module loading to keep the tools startup fast: the heavy modules (requests, citizenshell, selenium, ...)
+are imported on the first attribute access instead of the import time
+"""
+
+import sys
+import types
+import importlib
+
+
+class ptLazyModule(types.ModuleType):
+    def __init__(self, name):
+        """
+        Module proxy: the 'name' module is imported on the first attribute access, so
+
+            requests = ptLazyModule("requests")
+            ...
+            requests.Session()  # actual import
+
+        The module import errors are raised at the first access too
+        """
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_pt_module'] = None
+
+    def _pt_load(self):
+        module = self.__dict__['_pt_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_pt_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._pt_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._pt_load(), name, value)
+
+    def __dir__(self):
+        return dir(self._pt_load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_pt_module'] is not None else "not loaded"
+        return "<lazy module '%s' (%s)>" % (self.__name__, state)
+
+
+def lazy_import(name):
+    """Returns the module if it is already imported or its ptLazyModule proxy otherwise"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return ptLazyModule(name)
+
+
+##############################################################################
+# Autotests
+##############################################################################
+
+
+def _coverage():
+    assert lazy_import("sys") is sys
+
+    name = "xml.dom.minidom"
+    if name in sys.modules:
+        del sys.modules[name]
+
+    m = lazy_import(name)
+    assert isinstance(m, ptLazyModule) and name not in sys.modules
+    print(repr(m))
+    assert m.parseString("<a/>").documentElement.tagName == "a"
+    assert name in sys.modules
+    print(repr(m))
+
+    m.pt_test_attr = 1
+    assert sys.modules[name].pt_test_attr == 1
+    assert "parseString" in dir(m)
+
+    try:
+        ptLazyModule("pt_no_such_module").attr
+        assert False
+    except ImportError:
+        pass
+
+
+if __name__ == "__main__":
+    _coverage()
+    print("OK")
@@ -5,16 +5,315 @@ __author__ = "perfguru87@gmail.com"
 __copyright__ = "Copyright 2018, The PerfTracker project"
 __license__ = "MIT"
 
+import os
+import re
+import json
+import time
+import base64
+import socket
+import atexit
+import threading
 import citizenshell
+import paramiko
 import logging
 from perftrackerlib.helpers.decorators import cached_property
 from functools import wraps
 
+PT_SHELL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".perftracker", "hostinfo")
+PT_SHELL_CACHE_TTL_SEC = 24 * 3600
+PT_SSH_POOL_IDLE_SEC = 300
+PT_SSH_POOL_MAX_CHANNELS = 8
+
+# The host probe: collects all the Os and Hw facts in one shell round trip and prints them as json.
+# Must work on the target host python2 and python3, so no f-strings and no 3rd party modules.
+_PT_SHELL_PROBE = '''
+import json, os, platform, socket, subprocess
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def run(cmd):
+    try:
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return p.communicate()[0].decode("utf-8", "replace").strip()
+    except OSError:
+        return ""
+
+
+f = {"platform": platform.platform(), "hostname": socket.gethostname(), "boot_id": None}
+
+if f["platform"].startswith("Linux"):
+    f["boot_id"] = read("/proc/sys/kernel/random/boot_id")
+    for name in ("product_uuid", "product_serial", "sys_vendor", "product_name"):
+        f[name] = read("/sys/class/dmi/id/" + name)
+    for line in (read("/proc/meminfo") or "").splitlines():
+        if line.startswith("MemTotal"):
+            f["ram_kb"] = int(line.split()[1])
+    cpus, sockets, cores = 0, set(), set()
+    for line in (read("/proc/cpuinfo") or "").splitlines():
+        key, _, val = line.partition(":")
+        key, val = key.strip(), val.strip()
+        if key == "processor":
+            cpus += 1
+        elif key == "model name":
+            f.setdefault("cpu_model", val)
+        elif key == "cpu MHz":
+            f.setdefault("cpu_mhz", float(val))
+        elif key == "physical id":
+            sockets.add(val)
+        elif key == "core id":
+            cores.add(val)
+    f.update({"cpu_count": cpus, "cpu_sockets": len(sockets), "cpu_cores": len(cores)})
+
+elif f["platform"].startswith("Darwin"):
+    f["boot_id"] = run("sysctl -n kern.boottime")
+    f["os_version"] = run("system_profiler SPSoftwareDataType | grep 'System Version' | cut -d':' -f 2")
+    f["system_profiler"] = run("system_profiler SPHardwareDataType")
+    f["cpu_count"] = int(run("sysctl -n hw.ncpu") or 0)
+
+print(json.dumps(f))
+'''
+
 
 class ShellError(Exception):
     pass
 
 
+class ptHostInfoCache:
+    def __init__(self, cache_dir=None, ttl_sec=PT_SHELL_CACHE_TTL_SEC):
+        """
+        On-disk cache of the host probe results, one json file per host:
+
+            {"time": <probe timestamp>, "boot_id": ..., "uuid": ..., "facts": {...}}
+
+        An entry expires after ttl_sec or when the host boot id has changed (if the caller knows it)
+        """
+        self.cache_dir = cache_dir if cache_dir else PT_SHELL_CACHE_DIR
+        self.ttl_sec = ttl_sec
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "%s.json" % re.sub(r"[^\w.-]", "_", key))
+
+    def get(self, key, boot_id=None):
+        """
+        boot_id - the current host boot id or a callable returning it, the callable is called only if there is
+                  an entry which is not expired (so the remote host round trip is saved otherwise)
+        """
+        if not key or self.ttl_sec <= 0:
+            return None
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('time', 0) > self.ttl_sec:
+            logging.debug("%s: host info cache has expired" % key)
+            return None
+        if callable(boot_id):
+            boot_id = boot_id()
+        if boot_id and entry.get('boot_id') != boot_id:
+            logging.debug("%s: host has been rebooted, host info cache is invalid" % key)
+            return None
+        return entry.get('facts')
+
+    def put(self, key, facts):
+        if not key or self.ttl_sec <= 0:
+            return
+        entry = {'time': time.time(), 'boot_id': facts.get('boot_id'), 'uuid': facts.get('product_uuid'),
+                 'facts': facts}
+        path = self._path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logging.debug("%s: can't save host info cache to %s: %s" % (key, path, str(e)))
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class ptSshSession:
+    def __init__(self, key, max_channels):
+        self.key = key
+        self.shell = None
+        self.last_used = time.time()
+        self.in_use = 0
+        self.connects = 0
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._channels = threading.BoundedSemaphore(max_channels)
+
+    def is_alive(self):
+        if self.shell is None or not self.shell.is_connected():
+            return False
+        transport = self.shell._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self, password=None):
+        with self._lock:
+            if self.is_alive():
+                return self.shell
+            hostname, username, port = self.key
+            if self.shell is None:
+                self.shell = citizenshell.SecureShell(hostname=hostname, username=username, password=password,
+                                                      port=port)
+            else:
+                logging.debug("%s@%s: ssh session is dead, reconnecting" % (username, hostname))
+                self.shell.disconnect()
+                self.shell.connect()
+            self.connects += 1
+            return self.shell
+
+    def disconnect(self):
+        with self._lock:
+            if self.shell is not None and self.in_use == 0:
+                self.shell.disconnect()
+
+
+class ptSshPool:
+    def __init__(self, idle_sec=PT_SSH_POOL_IDLE_SEC, max_channels=PT_SSH_POOL_MAX_CHANNELS):
+        """
+        Process-wide pool of the persistent ssh sessions keyed by (host, user, port), so all the ptShell.ssh()
+        objects to the same host share one ssh connection:
+        - the session is checked to be alive and is reconnected before every command
+        - not more than max_channels commands run on the session concurrently, the others wait
+        - the sessions which are idle for more than idle_sec are closed (and reconnected on demand)
+        """
+        self.idle_sec = idle_sec
+        self.max_channels = max_channels
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._passwords = {}
+
+    @staticmethod
+    def _key(hostname, username, port=22):
+        return (hostname, username, int(port))
+
+    def _session(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = ptSshSession(key, self.max_channels)
+            return session
+
+    def get(self, hostname, username, password=None, port=22):
+        """Returns the pooled citizenshell.SecureShell to the host"""
+        key = self._key(hostname, username, port)
+        if password is not None:
+            self._passwords[key] = password
+        return self._session(key).connect(self._passwords.get(key))
+
+    def owns(self, shell):
+        """True if the shell is a pooled session one (see get()), the pool never touches the other shells"""
+        with self._lock:
+            session = self._sessions.get(self._key(shell._hostname, shell._username, shell._port))
+        return session is not None and session.shell is shell
+
+    def execute(self, shell, cmdline, wait=True):
+        """
+        Runs the command on the pooled shell session, returns the citizenshell result. The channel
+        limit applies while the command starts, so a wait=False (streaming) command doesn't hold a slot,
+        but it keeps the session pinned (not evicted as idle) until the caller calls release()
+        """
+        key = self._key(shell._hostname, shell._username, shell._port)
+        session = self._session(key)
+        self.evict_idle()
+
+        with session._channels:
+            with session._lock:
+                session.in_use += 1
+            pinned = False
+            try:
+                try:
+                    ret = session.connect(self._passwords.get(key))(cmdline, wait=wait)
+                except (EOFError, socket.error, paramiko.SSHException) as e:
+                    # the connection has been closed by the peer after the liveness check, retry once
+                    logging.debug("%s@%s: ssh command failed: %s, retrying" % (key[1], key[0], str(e)))
+                    with session._lock:
+                        session.shell.disconnect()
+                    ret = session.connect(self._passwords.get(key))(cmdline, wait=wait)
+                session.commands += 1
+                pinned = not wait
+                return ret
+            finally:
+                if not pinned:
+                    self._release(session)
+
+    @staticmethod
+    def _release(session):
+        with session._lock:
+            session.in_use -= 1
+            session.last_used = time.time()
+
+    def release(self, shell):
+        """Unpins the session after the wait=False command output has been read"""
+        self._release(self._session(self._key(shell._hostname, shell._username, shell._port)))
+
+    def evict_idle(self):
+        """Closes the sessions which are not used for more than idle_sec, returns the number of closed ones"""
+        now = time.time()
+        with self._lock:
+            idle = [s for s in self._sessions.values()
+                    if s.in_use == 0 and now - s.last_used > self.idle_sec and s.is_alive()]
+        for s in idle:
+            logging.debug("%s@%s: closing idle ssh session" % (s.key[1], s.key[0]))
+            s.disconnect()
+        return len(idle)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for s in sessions:
+            s.disconnect()
+
+    def stats(self):
+        with self._lock:
+            return dict(("%s@%s:%d" % (k[1], k[0], k[2]),
+                         {'connects': s.connects, 'commands': s.commands, 'in_use': s.in_use,
+                          'connected': s.shell is not None and s.shell.is_connected()})
+                        for k, s in self._sessions.items())
+
+
+ssh_pool = ptSshPool()
+atexit.register(ssh_pool.close)
+
+
+def _parse_system_profiler(hw, out):
+    hw._vendor = "Apple Inc."
+
+    for line in out.split("\n"):
+        if "Model Identifier" in line:
+            hw._model = line.split(":")[1].strip()
+        elif "Processor Name" in line:
+            hw._cpu_model = line.split(":")[1].strip()
+        elif "Number of Processors" in line:
+            hw._cpu_sockets = int(line.split(":")[1].strip())
+        elif "Total Number of Cores" in line:
+            hw._cpu_cores = int(line.split(":")[1].strip())
+        elif "Processor Speed" in line:
+            hw._cpu_freq_ghz = float(line.split(":")[1].split()[0].strip().replace(',', '.'))
+        elif "Memory" in line:
+            hw._ram_kb = int(line.split()[1].strip()) * 1024 * 1024
+        elif "Serial Number" in line:
+            hw._serial = line.split(":")[1].strip()
+        elif "Hardware UUID" in line:
+            hw._uuid = line.split(":")[1].strip()
+
+
 class Os:
     def __init__(self, shell):
         assert isinstance(shell, ptShell)
@@ -35,6 +334,9 @@ class Os:
 
     @cached_property
     def hostname(self):
+        if self._init()._hostname:
+            return self._hostname
+
         if self.family in ("Linux", "Darwin"):
             return self._shell.execute_fetch_one("hostname")
 
@@ -45,6 +347,20 @@ class Os:
         if self._inited:
             return self
 
+        facts = self._shell.facts
+        if facts:
+            self._version = facts['platform']
+            self._hostname = facts.get('hostname') or ''
+            for family in ("Linux", "Darwin", "Windows"):
+                if self._version.startswith(family):
+                    self._family = family
+            if self._family == "Darwin":
+                self._version = facts.get('os_version') or self._version
+            if self._family is None:
+                raise ShellError("%s: can't recognize the OS family" % (str(self._shell)))
+            self._inited = True
+            return self
+
         f = self._shell.execute
 
         status, out, _ = f("python -c 'from __future__ import print_function; import platform; "
@@ -52,7 +368,6 @@ class Os:
         self._version = out.strip()
         if self._version.startswith("Linux"):
             self._family = "Linux"
-            self._hostname = f("hostname")
         elif self._version.startswith("Darwin"):
             self._family = "Darwin"
             self._version = self._shell.execute_fetch_one("system_profiler SPSoftwareDataType | "
@@ -91,7 +406,32 @@ class Hw:
         if self._inited:
             return self
 
-        if self.os_info.family == "Linux":
+        facts = self._shell.facts
+
+        if facts and self.os_info.family == "Linux":
+            self._uuid = facts.get('product_uuid')
+            self._serial = facts.get('product_serial')
+            self._vendor = facts.get('sys_vendor')
+            self._model = facts.get('product_name')
+            self._ram_kb = facts.get('ram_kb', 0)
+
+            self._cpu_model = facts.get('cpu_model', '')
+            self._cpu_freq_ghz = round(facts.get('cpu_mhz', 0.0) / 1000, 1)
+            self._cpu_count = facts.get('cpu_count', 0)
+            self._cpu_sockets = max(1, facts.get('cpu_sockets', 0))
+            self._cpu_cores = max(1, facts.get('cpu_cores', 0))
+
+            cores = self._cpu_sockets * self._cpu_cores
+            self._cpu_threads = self._cpu_count / cores
+
+        elif facts and self.os_info.family == "Darwin":
+            _parse_system_profiler(self, facts.get('system_profiler', ''))
+            self._cpu_count = facts.get('cpu_count', 0)
+
+            cores = self._cpu_sockets * self._cpu_cores
+            self._cpu_threads = self._cpu_count / cores
+
+        elif self.os_info.family == "Linux":
             f = self._shell.execute_fetch_one
 
             self._uuid = f("cat /sys/class/dmi/id/product_uuid")
@@ -104,34 +444,15 @@ class Hw:
             self._cpu_freq_ghz = round(f("cat /proc/cpuinfo | grep 'cpu MHz' "
                                          "| head -n 1 | cut -d':' -f 2", float) / 1000, 1)
             self._cpu_count = f("cat /proc/cpuinfo | grep processor | wc -l", int)
-            self._cpu_sockets = min(1, f("cat /proc/cpuinfo | grep 'physical id' | sort | uniq | wc -l", int))
-            self._cpu_cores = min(1, f("cat /proc/cpuinfo | grep 'core id' | sort | uniq | wc -l", int))
+            self._cpu_sockets = max(1, f("cat /proc/cpuinfo | grep 'physical id' | sort | uniq | wc -l", int))
+            self._cpu_cores = max(1, f("cat /proc/cpuinfo | grep 'core id' | sort | uniq | wc -l", int))
 
             cores = self._cpu_sockets * self._cpu_cores
             self._cpu_threads = self._cpu_count / cores
 
         elif self.os_info.family == "Darwin":
             _, out, _ = self._shell.execute("system_profiler SPHardwareDataType")
-
-            self._vendor = "Apple Inc."
-
-            for line in out.split("\n"):
-                if "Model Identifier" in line:
-                    self._model = line.split(":")[1].strip()
-                elif "Processor Name" in line:
-                    self._cpu_model = line.split(":")[1].strip()
-                elif "Number of Processors" in line:
-                    self._cpu_sockets = int(line.split(":")[1].strip())
-                elif "Total Number of Cores" in line:
-                    self._cpu_cores = int(line.split(":")[1].strip())
-                elif "Processor Speed" in line:
-                    self._cpu_freq_ghz = float(line.split(":")[1].split()[0].strip().replace(',', '.'))
-                elif "Memory" in line:
-                    self._ram_kb = int(line.split()[1].strip()) * 1024 * 1024
-                elif "Serial Number" in line:
-                    self._serial = line.split(":")[1].strip()
-                elif "Hardware UUID" in line:
-                    self._uuid = line.split(":")[1].strip()
+            _parse_system_profiler(self, out)
 
             self._cpu_count = self._shell.execute_fetch_one("sysctl -n hw.ncpu", type=int)
 
@@ -140,7 +461,7 @@ class Hw:
 
         else:
             logging.warning("the %s.%s function is not implemented for OS: %s" %
-                            (self.__class__.__name__, f.__name__, self.os_info.family))
+                            (self.__class__.__name__, "_init", self.os_info.family))
 
         self._inited = True
 
@@ -189,14 +510,82 @@ class Hw:
 
 
 class ptShell:
-    def __init__(self, shell=None):
+    def __init__(self, shell=None, probe=True, cache_dir=None, cache_ttl_sec=PT_SHELL_CACHE_TTL_SEC):
+        """
+        probe         - collect the hw_info and os_info facts by one python script execution instead of
+                        a dozen shell commands (falls back to the commands if there is no python on the host)
+        cache_dir     - the probe results cache directory, default: PT_SHELL_CACHE_DIR
+        cache_ttl_sec - the probe results cache TTL, 0 - disable the cache
+        """
         if shell is None:
             shell = citizenshell.LocalShell()
         assert isinstance(shell, citizenshell.abstractshell.AbstractShell)
+        # the caller's own ssh shells are used as is, only the ptShell.ssh() ones are pooled
+        self._pooled = isinstance(shell, citizenshell.SecureShell) and ssh_pool.owns(shell)
         self.shell = shell
+        self.probe = probe
+        self.cache = ptHostInfoCache(cache_dir, cache_ttl_sec)
         self._hw_info = None
         self._os_info = None
 
+    @staticmethod
+    def ssh(hostname, username, password=None, port=22, **kwargs):
+        """ptShell on the pooled ssh session to the host"""
+        return ptShell(ssh_pool.get(hostname, username, password=password, port=port), **kwargs)
+
+    @cached_property
+    def cache_key(self):
+        """The host id in the probe cache, None if the shell type is unknown"""
+        if isinstance(self.shell, citizenshell.LocalShell):
+            return "localhost"
+        if isinstance(self.shell, citizenshell.SecureShell):
+            return "%s@%s:%d" % (self.shell._username, self.shell._hostname, self.shell._port)
+        return None
+
+    def _boot_id(self):
+        """The host boot id as the probe gets it, None if unknown"""
+        if self.cache_key == "localhost":
+            try:
+                with open("/proc/sys/kernel/random/boot_id") as f:
+                    return f.read().strip()
+            except (IOError, OSError):
+                pass
+        try:
+            ret = self._run("cat /proc/sys/kernel/random/boot_id 2>/dev/null || sysctl -n kern.boottime")
+        except (EOFError, socket.error, paramiko.SSHException) as e:
+            self._debug("can't get the boot id: %s" % str(e))
+            return None
+        if ret.exit_code():
+            return None
+        return "\n".join(ret.stdout()).strip() or None
+
+    @cached_property
+    def facts(self):
+        """The host facts dict collected by the probe (or taken from the cache), None if the probe failed"""
+        if not self.probe:
+            return None
+
+        facts = self.cache.get(self.cache_key, boot_id=self._boot_id)
+        if facts:
+            self._debug("host info is taken from the cache")
+            return facts
+
+        script = base64.b64encode(_PT_SHELL_PROBE.encode("utf-8")).decode("ascii")
+        cmdline = "$(command -v python3 || command -v python) -c " \
+                  "\"import base64; exec(base64.b64decode('%s'))\"" % script
+        self._debug("running the host probe ...")
+        ret = self._run(cmdline)
+        try:
+            facts = json.loads("\n".join(ret.stdout())) if not ret.exit_code() else None
+        except ValueError:
+            facts = None
+        if not facts or not facts.get('platform'):
+            self._debug("host probe has failed, falling back to the shell commands")
+            return None
+
+        self.cache.put(self.cache_key, facts)
+        return facts
+
     @cached_property
     def hw_info(self):
         return Hw(self, self.os_info)
@@ -215,9 +604,25 @@ class ptShell:
     def _debug(self, msg):
         logging.debug("%s: %s" % (str(self), msg))
 
+    def _run(self, cmdline, wait=True):
+        if self._pooled:
+            return ssh_pool.execute(self.shell, cmdline, wait=wait)
+        return self.shell(cmdline, wait=wait)
+
+    def stream(self, cmdline):
+        """Execute the long running command, yields its stdout lines as they arrive"""
+        self._debug("%s (streaming) ..." % cmdline)
+        ret = self._run(cmdline, wait=False)
+        try:
+            for line in ret:
+                yield line
+        finally:
+            if self._pooled:
+                ssh_pool.release(self.shell)
+
     def execute(self, cmdline, raise_exc=True):
         self._debug("%s ..." % cmdline)
-        ret = self.shell(cmdline)
+        ret = self._run(cmdline)
         if ret.exit_code():
             msg = "ERROR: %s: %s, exit status: %d\n%s %s" % (str(self), cmdline, ret.exit_code(), ret.stderr(),
                                                              ret.stdout())
@@ -258,9 +663,13 @@ class ptShellFromFile(citizenshell.abstractshell.AbstractShell):
 
 
 def _coverage():
+    import tempfile
+    import shutil
+
     logging.basicConfig(level=logging.DEBUG)
 
-    sh = ptShell(citizenshell.LocalShell())
+    cache_dir = tempfile.mkdtemp()
+    sh = ptShell(citizenshell.LocalShell(), cache_dir=cache_dir)
 
     print("os family:    ", sh.os_info.family)
     print("os version:   ", sh.os_info.version)
@@ -276,6 +685,30 @@ def _coverage():
     print("cpu_topology: ", sh.hw_info.cpu_topology)
     print("ram_kb:       ", sh.hw_info.ram_kb)
 
+    # the probe results must match the shell commands results
+    legacy = ptShell(citizenshell.LocalShell(), probe=False)
+    assert legacy.facts is None
+    for attr in ("family", "version", "hostname"):
+        assert getattr(sh.os_info, attr) == getattr(legacy.os_info, attr), attr
+    for attr in ("cpu_count", "cpu_topology", "ram_kb", "cpu_freq_ghz"):
+        assert getattr(sh.hw_info, attr) == getattr(legacy.hw_info, attr), attr
+
+    # the second shell takes the facts from the cache
+    assert sh.facts and os.path.exists(sh.cache._path("localhost"))
+    assert ptShell(cache_dir=cache_dir).facts == sh.facts
+    assert sh.cache.get("localhost", boot_id="rebooted") is None
+    assert sh.cache.get("localhost", boot_id=lambda: "rebooted") is None
+    assert sh._boot_id() == sh.facts['boot_id'] and sh.cache.get("localhost", boot_id=sh._boot_id) == sh.facts
+    assert ptHostInfoCache(cache_dir, ttl_sec=-1).get("localhost") is None
+    sh.cache.invalidate("localhost")
+    assert sh.cache.get("localhost") is None
+    assert ptShell(cache_dir=cache_dir, cache_ttl_sec=0).facts
+    assert not os.listdir(cache_dir)
+    shutil.rmtree(cache_dir)
+
+    # the local shells don't use the ssh pool
+    assert not sh._pooled and not ssh_pool.stats() and ssh_pool.evict_idle() == 0
+
 
 if __name__ == "__main__":
     _coverage()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, absolute_import
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+"""
+Linux host resources sampler: reads /proc/stat, /proc/meminfo, /proc/diskstats and /proc/net/dev every
+interval_sec by one long-lived shell command (a remote loop), so there is no per-sample round trip
+"""
+
+import re
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+PT_SAMPLER_INTERVAL_SEC = 1.0
+PT_SAMPLER_MAX_DURATION_SEC = 24 * 3600
+
+# metric name -> unit, the summary has avg and max of every metric
+PT_SAMPLER_METRICS = OrderedDict([
+    ("cpu busy", "%"),
+    ("cpu iowait", "%"),
+    ("mem used", "MB"),
+    ("swap used", "MB"),
+    ("disk read", "MB/s"),
+    ("disk write", "MB/s"),
+    ("disk util", "%"),
+    ("net rx", "MB/s"),
+    ("net tx", "MB/s"),
+])
+
+_PT_SAMPLE_MARK = "@@pt-sample"
+_PT_SAMPLE_FILES = "/proc/stat /proc/meminfo /proc/diskstats /proc/net/dev"
+
+# whole disks only: the partitions, loop, ram and device mapper devices would be counted twice or are not disks
+_PT_SKIP_DISK_RE = re.compile(r"^(loop|ram|dm-|sr|fd|zram)|^(sd|hd|vd|xvd)[a-z]+\d+$|^(nvme\d+n\d+|mmcblk\d+)p\d+$")
+_PT_SECTOR_SIZE = 512
+_MB = 1024.0 * 1024
+
+
+def parse_sample(lines):
+    """Parse one sample of the /proc files, returns the dict of the counters"""
+    s = {'cpu': None, 'mem': {}, 'disk': [0, 0], 'disk_ticks': {}, 'net': [0, 0]}
+    for line in lines:
+        if line.startswith("cpu "):
+            s['cpu'] = [int(v) for v in line.split()[1:]]
+            continue
+        key, sep, rest = line.partition(":")
+        if sep:
+            fields = rest.split()
+            if len(fields) >= 16:
+                if key.strip() != "lo":
+                    s['net'][0] += int(fields[0])
+                    s['net'][1] += int(fields[8])
+            elif fields and fields[0].isdigit():
+                s['mem'][key] = int(fields[0])
+            continue
+        fields = line.split()
+        if len(fields) >= 14 and fields[0].isdigit() and fields[1].isdigit():
+            if _PT_SKIP_DISK_RE.match(fields[2]):
+                continue
+            s['disk'][0] += int(fields[5]) * _PT_SECTOR_SIZE
+            s['disk'][1] += int(fields[9]) * _PT_SECTOR_SIZE
+            s['disk_ticks'][fields[2]] = int(fields[12])  # io_ticks (ms) are per disk, see sample_values()
+    return s
+
+
+def sample_values(prev, cur, interval_sec):
+    """The metrics values (see PT_SAMPLER_METRICS) between two samples"""
+    v = OrderedDict()
+
+    if prev['cpu'] and cur['cpu']:
+        delta = [c - p for c, p in zip(cur['cpu'], prev['cpu'])]
+        # user nice system idle iowait irq softirq steal [guest guest_nice], guest is included to user
+        total = float(sum(delta[:8])) or 1.0
+        idle = delta[3] + (delta[4] if len(delta) > 4 else 0)
+        v["cpu busy"] = 100.0 * (total - idle) / total
+        v["cpu iowait"] = 100.0 * (delta[4] if len(delta) > 4 else 0) / total
+
+    mem = cur['mem']
+    if 'MemTotal' in mem:
+        avail = mem.get('MemAvailable', mem.get('MemFree', 0) + mem.get('Buffers', 0) + mem.get('Cached', 0))
+        v["mem used"] = (mem['MemTotal'] - avail) / 1024.0
+        v["swap used"] = (mem.get('SwapTotal', 0) - mem.get('SwapFree', 0)) / 1024.0
+
+    if interval_sec > 0:
+        v["disk read"] = max(0, cur['disk'][0] - prev['disk'][0]) / _MB / interval_sec
+        v["disk write"] = max(0, cur['disk'][1] - prev['disk'][1]) / _MB / interval_sec
+        # the busiest disk utilization, the new (hotplugged) disks are counted from the next sample
+        ticks = [t - prev['disk_ticks'][d] for d, t in cur['disk_ticks'].items() if d in prev['disk_ticks']]
+        v["disk util"] = min(100.0, max([0] + ticks) / 10.0 / interval_sec)
+        v["net rx"] = max(0, cur['net'][0] - prev['net'][0]) / _MB / interval_sec
+        v["net tx"] = max(0, cur['net'][1] - prev['net'][1]) / _MB / interval_sec
+    return v
+
+
+class ptResourceSampler:
+    def __init__(self, shell, name=None, interval_sec=PT_SAMPLER_INTERVAL_SEC,
+                 max_duration_sec=PT_SAMPLER_MAX_DURATION_SEC):
+        """
+        Sample the host resources utilization via the ptShell shell while a test runs:
+
+            with ptResourceSampler(node_shell, name="db") as s:
+                test.execute(...)
+            s.attach(test)  # adds 'db cpu busy avg (%)', 'db cpu busy max (%)', ... to the test attribs
+
+        The sampling loop runs on the host as one shell command streaming the /proc files every
+        interval_sec, it stops by stop() or after max_duration_sec
+        """
+        self.shell = shell
+        self.name = name if name else str(shell)
+        self.interval_sec = interval_sec
+        self.max_duration_sec = max_duration_sec
+        self.timestamps = []
+        self.series = OrderedDict((m, []) for m in PT_SAMPLER_METRICS)
+
+        self._stop_file = "/tmp/pt-sampler-%s.stop" % uuid.uuid4()
+        self._thread = None
+        self._error = None
+
+    def _cmdline(self):
+        count = max(1, int(self.max_duration_sec / self.interval_sec))
+        sample = "echo %s $(date +%%s.%%N); cat %s" % (_PT_SAMPLE_MARK, _PT_SAMPLE_FILES)
+        return "n=0; while [ $n -lt %d ] && [ ! -e %s ]; do %s; n=$((n+1)); sleep %s; done; %s; rm -f %s" % \
+               (count, self._stop_file, sample, self.interval_sec, sample, self._stop_file)
+
+    def _add(self, ts, lines, prev):
+        cur = parse_sample(lines)
+        if prev is not None:
+            values = sample_values(prev[1], cur, ts - prev[0])
+            if values:
+                self.timestamps.append(ts)
+                for m in PT_SAMPLER_METRICS:
+                    self.series[m].append(values.get(m))
+        return (ts, cur)
+
+    def _run(self):
+        ts, lines, prev = None, [], None
+        try:
+            for line in self.shell.stream(self._cmdline()):
+                if line.startswith(_PT_SAMPLE_MARK):
+                    if ts is not None:
+                        prev = self._add(ts, lines, prev)
+                    try:
+                        ts = float(line.split()[1])
+                    except (IndexError, ValueError):
+                        ts = time.time()  # no 'date +%N' support
+                    lines = []
+                else:
+                    lines.append(line)
+            if ts is not None:
+                self._add(ts, lines, prev)
+        except Exception as e:
+            self._error = e
+            logging.warning("%s: resources sampler failed: %s" % (self.name, str(e)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ptResourceSampler %s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return self
+        self.shell.execute("touch %s" % self._stop_file, raise_exc=False)
+        self._thread.join(self.interval_sec + 10)
+        if self._thread.is_alive():
+            logging.warning("%s: resources sampler didn't stop in time" % self.name)
+        self._thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def summary(self):
+        """OrderedDict: metric -> (avg, max) of the collected samples"""
+        ret = OrderedDict()
+        for m, values in self.series.items():
+            values = [v for v in values if v is not None]
+            if values:
+                ret[m] = (sum(values) / len(values), max(values))
+        return ret
+
+    def attach(self, test):
+        """Store the summary in the test attribs: '<name> <metric> avg (<unit>)', '<name> <metric> max (<unit>)'"""
+        for m, (avg, mx) in self.summary().items():
+            unit = PT_SAMPLER_METRICS[m]
+            test.attribs["%s %s avg (%s)" % (self.name, m, unit)] = round(avg, 2)
+            test.attribs["%s %s max (%s)" % (self.name, m, unit)] = round(mx, 2)
+        return test
+
+
+##############################################################################
+# Autotests
+##############################################################################
+
+
+def _coverage():
+    import platform
+    from perftrackerlib.helpers.ptshell import ptShell
+
+    sample = ["cpu  100 0 100 700 100 0 0 0 0 0",
+              "cpu0 100 0 100 700 100 0 0 0 0 0",
+              "MemTotal:        2048000 kB",
+              "MemAvailable:    1024000 kB",
+              "SwapTotal:        102400 kB",
+              "SwapFree:          51200 kB",
+              "   8       0 sda 100 0 2048 0 100 0 4096 0 0 500 0 0 0 0 0",
+              "   8       1 sda1 100 0 2048 0 100 0 4096 0 0 500 0 0 0 0 0",
+              "   7       0 loop0 100 0 2048 0 100 0 4096 0 0 500 0 0 0 0 0",
+              "Inter-|   Receive                                                |  Transmit",
+              "    lo: 1000 10 0 0 0 0 0 0 1000 10 0 0 0 0 0 0",
+              "  eth0: 1048576 10 0 0 0 0 0 0 2097152 10 0 0 0 0 0 0"]
+    s0 = parse_sample(sample)
+    assert s0['disk'] == [2048 * 512, 4096 * 512] and s0['disk_ticks'] == {'sda': 500}
+    assert s0['net'] == [1048576, 2097152]
+    assert s0['mem']['MemTotal'] == 2048000
+
+    s1 = parse_sample([line.replace("cpu  100 0 100 700 100", "cpu  200 0 200 1300 300")
+                       .replace("1048576 10", "3145728 10") for line in sample])
+    v = sample_values(s0, s1, 2.0)
+    assert v["cpu busy"] == 20.0 and v["cpu iowait"] == 20.0, v
+    assert v["mem used"] == 1000.0 and v["swap used"] == 50.0
+    assert v["net rx"] == 1.0 and v["net tx"] == 0.0 and v["disk util"] == 0.0
+
+    # two disks: idle sda with the big io_ticks counter and sdb 100% busy for 1 second
+    disks = ["   8       0 sda 100 0 2048 0 100 0 4096 0 0 9000000 0 0 0 0 0",
+             "   8      16 sdb 100 0 2048 0 100 0 4096 0 0 %d 0 0 0 0 0"]
+    s0 = parse_sample([disks[0], disks[1] % 1000])
+    s1 = parse_sample([disks[0], disks[1] % 2000, "   8      32 sdc 1 0 8 0 1 0 8 0 0 5000 0 0 0 0 0"])
+    v = sample_values(s0, s1, 1.0)
+    assert abs(v["disk util"] - 100.0) < 0.01, v
+
+    if not platform.system() == "Linux":
+        return
+
+    sh = ptShell(cache_ttl_sec=0)
+    with ptResourceSampler(sh, name="localhost", interval_sec=0.2) as s:
+        t = time.time()
+        while time.time() - t < 1.0:
+            sum(range(10000))
+    summary = s.summary()
+    print(summary)
+    assert len(s.timestamps) >= 3 and "cpu busy" in summary and summary["mem used"][0] > 0
+
+    class _Test:
+        attribs = {}
+    assert "localhost cpu busy avg (%)" in s.attach(_Test()).attribs
+
+
+if __name__ == "__main__":
+    _coverage()
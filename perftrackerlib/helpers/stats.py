@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+"""
+Descriptive statistics helpers: mean, standard deviation, Student's t confidence intervals,
+warm-up detection and outliers rejection. The large samples are processed by numpy if it is installed
+"""
+
+import math
+import bisect
+from collections import OrderedDict
+
+# use numpy for the samples larger than this
+PT_STATS_NUMPY_MIN = 1024
+
+_numpy = None
+
+# two-sided Student's t critical values by degrees of freedom for 90%, 95% and 99% confidence
+_T_CONFIDENCES = (0.90, 0.95, 0.99)
+_T_DF = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20,
+         21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 40, 60, 120]
+_T_TABLE = [
+    (6.314, 12.706, 63.657), (2.920, 4.303, 9.925), (2.353, 3.182, 5.841), (2.132, 2.776, 4.604),
+    (2.015, 2.571, 4.032), (1.943, 2.447, 3.707), (1.895, 2.365, 3.499), (1.860, 2.306, 3.355),
+    (1.833, 2.262, 3.250), (1.812, 2.228, 3.169), (1.796, 2.201, 3.106), (1.782, 2.179, 3.055),
+    (1.771, 2.160, 3.012), (1.761, 2.145, 2.977), (1.753, 2.131, 2.947), (1.746, 2.120, 2.921),
+    (1.740, 2.110, 2.898), (1.734, 2.101, 2.878), (1.729, 2.093, 2.861), (1.725, 2.086, 2.845),
+    (1.721, 2.080, 2.831), (1.717, 2.074, 2.819), (1.714, 2.069, 2.807), (1.711, 2.064, 2.797),
+    (1.708, 2.060, 2.787), (1.706, 2.056, 2.779), (1.703, 2.052, 2.771), (1.701, 2.048, 2.763),
+    (1.699, 2.045, 2.756), (1.697, 2.042, 2.750), (1.684, 2.021, 2.704), (1.671, 2.000, 2.660),
+    (1.658, 1.980, 2.617)]
+_T_INF = (1.645, 1.960, 2.576)
+
+
+def get_numpy():
+    """numpy module or None if it is not installed, imported on the first call"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _np(values):
+    return get_numpy() if len(values) >= PT_STATS_NUMPY_MIN else None
+
+
+def mean(values):
+    if not len(values):
+        return None
+    return math.fsum(values) / len(values)
+
+
+def stdev(values):
+    """Sample standard deviation"""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    m = mean(values)
+    return math.sqrt(math.fsum((v - m) ** 2 for v in values) / (n - 1))
+
+
+def t_value(df, confidence=0.95):
+    """
+    Two-sided Student's t critical value, confidence must be 0.90, 0.95 or 0.99. The df values missing in
+    the table are rounded down (i.e. the interval is a bit wider than the exact one)
+    """
+    if confidence not in _T_CONFIDENCES:
+        raise ValueError("confidence must be one of %s, got %s" % (str(_T_CONFIDENCES), str(confidence)))
+    if df < 1:
+        raise ValueError("degrees of freedom must be >= 1, got %s" % str(df))
+
+    col = _T_CONFIDENCES.index(confidence)
+    if df > _T_DF[-1]:
+        return _T_INF[col]
+    return _T_TABLE[bisect.bisect_right(_T_DF, df) - 1][col]
+
+
+def ci_halfwidth(values, confidence=0.95):
+    """Half-width of the confidence interval of the mean, None if there are less than 2 values"""
+    n = len(values)
+    if n < 2:
+        return None
+    return t_value(n - 1, confidence) * stdev(values) / math.sqrt(n)
+
+
+def rel_ci_halfwidth(values, confidence=0.95):
+    """ci_halfwidth() relative to the mean: 0.05 means +/- 5%, None if can't be calculated"""
+    hw = ci_halfwidth(values, confidence)
+    if hw is None:
+        return None
+    m = mean(values)
+    if not m:
+        return 0.0 if not hw else None
+    return hw / abs(m)
+
+
+def quantile(values, q):
+    """Quantile (0 <= q <= 1) with linear interpolation between the closest ranks (same as numpy default)"""
+    if not len(values):
+        return None
+    np = _np(values)
+    if np:
+        return float(np.quantile(np.asarray(values, dtype=np.float64), q))
+    v = sorted(values)
+    pos = (len(v) - 1) * q
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(v) - 1)
+    return v[lo] + (v[hi] - v[lo]) * (pos - lo)
+
+
+def median(values):
+    return quantile(values, 0.5)
+
+
+def warmup_length(values, batch=None):
+    """
+    Number of the leading warm-up samples detected by the MSER-m steady state detection rule: the
+    truncation point d (within the first half) minimizing the variance of the mean of values[d:], computed
+    over the means of batch-sized windows (batch is 5 for 50+ samples by default and 1 for smaller ones)
+    """
+    if batch is None:
+        batch = 5 if len(values) >= 50 else 1
+    m = len(values) // batch
+    if m < 4:
+        return 0
+
+    np = _np(values)
+    if np:
+        x = np.asarray(values[:m * batch], dtype=np.float64).reshape(m, batch).mean(axis=1)
+        x -= x.mean()
+        s1 = np.cumsum(x[::-1])[::-1]
+        s2 = np.cumsum((x * x)[::-1])[::-1]
+        k = np.arange(m, 0, -1, dtype=np.float64)
+        mser = (s2 - s1 * s1 / k) / (k * k)
+        return int(np.argmin(mser[:m // 2 + 1])) * batch
+
+    x = [math.fsum(values[i * batch:(i + 1) * batch]) / batch for i in range(m)]
+    avg = math.fsum(x) / m
+    x = [v - avg for v in x]  # avoid the precision loss in s2 - s1^2/k
+
+    s1 = s2 = 0.0
+    best, best_d = None, 0
+    for d in range(m - 1, -1, -1):
+        s1 += x[d]
+        s2 += x[d] * x[d]
+        if d > m // 2:
+            continue
+        k = m - d
+        mser = (s2 - s1 * s1 / k) / (k * k)
+        if best is None or mser <= best:
+            best, best_d = mser, d
+    return best_d * batch
+
+
+def outliers_mask(values, method="mad", threshold=None):
+    """
+    Returns the list of booleans: False for the outliers, True for the values to keep.
+
+    method 'mad' - modified z-score |0.6745 * (x - median) / MAD| > threshold (3.5 by default)
+    method 'iqr' - x outside of [Q1 - threshold * IQR, Q3 + threshold * IQR] (threshold is 1.5 by default)
+    """
+    if method not in ("mad", "iqr"):
+        raise ValueError("outliers method must be 'mad' or 'iqr', got: %s" % str(method))
+    if len(values) < 3:
+        return [True] * len(values)
+
+    np = _np(values)
+    if method == "iqr":
+        threshold = 1.5 if threshold is None else threshold
+        q1, q3 = quantile(values, 0.25), quantile(values, 0.75)
+        lo, hi = q1 - threshold * (q3 - q1), q3 + threshold * (q3 - q1)
+        if np:
+            v = np.asarray(values, dtype=np.float64)
+            return ((v >= lo) & (v <= hi)).tolist()
+        return [lo <= v <= hi for v in values]
+
+    threshold = 3.5 if threshold is None else threshold
+    med = median(values)
+    if np:
+        absdev = np.abs(np.asarray(values, dtype=np.float64) - med)
+    else:
+        absdev = [abs(v - med) for v in values]
+
+    # MAD is 0 if more than a half of values are the same, use the mean absolute deviation then
+    scale = median(absdev) / 0.6745
+    if not scale:
+        scale = 1.253314 * mean(absdev)
+    if not scale:
+        return [True] * len(values)
+
+    if np:
+        return (absdev <= threshold * scale).tolist()
+    return [d <= threshold * scale for d in absdev]
+
+
+def clean_mask(values, warmup=True, outliers="mad"):
+    """
+    Returns the list of booleans: False for the warm-up samples and outliers, outliers are detected after
+    the warm-up is dropped. outliers - 'mad', 'iqr' or None
+    """
+    return _clean_mask(values, warmup_length(values) if warmup else 0, outliers)
+
+
+def _clean_mask(values, w, outliers):
+    mask = [False] * w
+    if outliers:
+        mask += outliers_mask(values[w:], method=outliers)
+    else:
+        mask += [True] * (len(values) - w)
+    return mask
+
+
+def _aggregates(values):
+    ret = OrderedDict()
+    ret['n'] = len(values)
+    ret['mean'] = mean(values)
+    ret['median'] = median(values)
+    ret['stdev'] = stdev(values)
+    ret['min'] = min(values) if len(values) else None
+    ret['max'] = max(values) if len(values) else None
+    return ret
+
+
+def describe(values, warmup=True, outliers="mad"):
+    """Raw and cleaned (see clean_mask()) aggregates: n, mean, median, stdev, min, max"""
+    w = warmup_length(values) if warmup else 0
+    mask = _clean_mask(values, w, outliers)
+    clean = [v for v, keep in zip(values, mask) if keep]
+
+    ret = OrderedDict()
+    ret['raw'] = _aggregates(values)
+    ret['clean'] = _aggregates(clean)
+    ret['warmup'] = w
+    ret['outliers'] = len(values) - w - len(clean)
+    return ret
+
+
+def _mw_exact_counts(m, n):
+    """Number of the (m, n) samples arrangements for every Mann-Whitney U value: 0..m*n"""
+    key = (m, n)
+    if key not in _mw_exact_cache:
+        # f[j][u] for the current i: f(i, j, u) = f(i - 1, j, u - j) + f(i, j - 1, u)
+        prev = [[1] + [0] * (m * n) for j in range(n + 1)]
+        for i in range(1, m + 1):
+            cur = [[1] + [0] * (m * n)]
+            for j in range(1, n + 1):
+                cur.append([prev[j][u - j] if u >= j else 0 for u in range(m * n + 1)])
+                cur[j] = [a + b for a, b in zip(cur[j], cur[j - 1])]
+            prev = cur
+        _mw_exact_cache[key] = prev[n]
+    return _mw_exact_cache[key]
+
+
+_mw_exact_cache = {}
+
+# exact Mann-Whitney p-values are calculated for the samples without ties up to this total size
+PT_MW_EXACT_MAX = 20
+
+
+def mw_pvalue(u, m, n, ties=0):
+    """
+    Two-sided Mann-Whitney p-value for given U statistic of the m and n sized samples.
+    ties - sum(t^3 - t) over the groups of t tied values in the combined sample
+    """
+    if m + n <= PT_MW_EXACT_MAX and not ties and u == int(u):
+        counts = _mw_exact_counts(m, n)
+        u = int(min(u, m * n - u))
+        return min(1.0, 2.0 * sum(counts[:u + 1]) / sum(counts))
+
+    N = m + n
+    sigma = math.sqrt(m * n / 12.0 * ((N + 1) - ties / float(N * (N - 1))))
+    if not sigma:
+        return 1.0
+    z = max(abs(u - m * n / 2.0) - 0.5, 0) / sigma
+    return math.erfc(z / math.sqrt(2))
+
+
+def mann_whitney(x, y):
+    """Mann-Whitney U test of x and y samples, returns (U of x, two-sided p-value), None p-value if m or n < 2"""
+    m, n = len(x), len(y)
+    pairs = sorted([(v, 0) for v in x] + [(v, 1) for v in y])
+
+    r1 = 0.0
+    ties = 0
+    i = 0
+    while i < len(pairs):
+        j = i
+        while j + 1 < len(pairs) and pairs[j + 1][0] == pairs[i][0]:
+            j += 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        rank = (i + j) / 2.0 + 1
+        r1 += rank * sum(1 for k in range(i, j + 1) if not pairs[k][1])
+        i = j + 1
+
+    u = r1 - m * (m + 1) / 2.0
+    if m < 2 or n < 2:
+        return u, None
+    return u, mw_pvalue(u, m, n, ties)
+
+
+def bootstrap_pvalue(x, y, resamples=1000, rng=None):
+    """
+    Two-sided bootstrap p-value of the mean(y) - mean(x) difference: the doubled fraction of the resampled
+    differences on the other side of zero, None if x or y has less than 2 values
+    """
+    if len(x) < 2 or len(y) < 2:
+        return None
+    if rng is None:
+        import random
+        rng = random.Random(0)
+
+    m, n = len(x), len(y)
+    le = ge = 0
+    for b in range(resamples):
+        d = math.fsum(y[int(rng.random() * n)] for i in range(n)) / n - \
+            math.fsum(x[int(rng.random() * m)] for i in range(m)) / m
+        le += d <= 0
+        ge += d >= 0
+    return min(1.0, 2.0 * min(le, ge) / resamples)
+
+
+##############################################################################
+# Autotests
+##############################################################################
+
+
+def _coverage():
+    values = [10.0, 12.0, 11.0, 13.0, 9.0]
+    assert mean(values) == 11.0
+    assert abs(stdev(values) - math.sqrt(2.5)) < 0.000001
+    assert abs(ci_halfwidth(values) - 2.776 * math.sqrt(2.5) / math.sqrt(5)) < 0.000001
+    assert abs(rel_ci_halfwidth(values) - ci_halfwidth(values) / 11.0) < 0.000001
+
+    assert t_value(35) == t_value(30)
+    assert t_value(1000, 0.99) == 2.576
+    assert mean([]) is None
+    assert stdev([1]) == 0.0
+    assert ci_halfwidth([1]) is None
+    assert rel_ci_halfwidth([0, 0]) == 0.0
+    assert rel_ci_halfwidth([-1, 1]) is None
+
+    for args in ((10, 0.5), (0, 0.95)):
+        try:
+            t_value(*args)
+            assert False
+        except ValueError:
+            pass
+
+    print("ci: %.3f +/- %.3f (%.1f%%)" % (mean(values), ci_halfwidth(values), 100 * rel_ci_halfwidth(values)))
+
+    import random
+    global PT_STATS_NUMPY_MIN
+
+    # slow warm-up, steady state with noise and a few spikes
+    values = [300.0 - 20 * i for i in range(10)] + [100 + random.gauss(0, 2) for i in range(990)]
+    for i in (300, 600, 900):
+        values[i] = 1000.0
+
+    for numpy_min in (0, len(values) + 1):
+        PT_STATS_NUMPY_MIN = numpy_min
+        w = warmup_length(values)
+        assert 5 <= w <= 15, w
+        d = describe(values)
+        assert d['warmup'] == w and d['outliers'] >= 3, d
+        assert abs(d['clean']['mean'] - 100) < 1 and d['raw']['mean'] > 102, d
+        assert sum(outliers_mask(values[w:], method="iqr")) < len(values) - w
+        print(d)
+
+    assert warmup_length([1, 2, 3]) == 0
+    assert warmup_length([10, 1, 1, 1, 1, 1, 1]) == 1
+    assert outliers_mask([1, 1, 1, 1, 5]) == [True, True, True, True, False]
+    assert outliers_mask([1, 1, 1]) == [True, True, True]
+    assert outliers_mask([1, 2]) == [True, True]
+    assert clean_mask([1, 2, 3, 100], warmup=False, outliers=None) == [True] * 4
+    assert quantile([], 0.5) is None
+    assert median([3, 1, 2, 4]) == 2.5
+
+    # exact: 1 of C(6, 3) = 20 arrangements has U = 0, the normal approximation uses tie and continuity corrections
+    assert mann_whitney([1, 2, 3], [4, 5, 6]) == (0.0, 0.1)
+    assert mann_whitney([1, 2, 3, 4], [3, 5, 6])[0] == 1.5
+    assert abs(mann_whitney([1, 2, 3, 4], [3, 5, 6])[1] - 0.1536) < 0.001
+    assert mann_whitney(list(range(30)), list(range(10, 40)))[0] == 200
+    assert abs(mann_whitney(list(range(30)), list(range(10, 40)))[1] - 0.000224) < 0.00001
+    assert mann_whitney([1], [2, 3]) == (0.0, None)
+    assert mw_pvalue(4.5, 3, 3, ties=6 ** 3 - 6) == 1.0  # all the values are the same
+    assert bootstrap_pvalue([1, 2, 3], [11, 12, 13]) == 0.0
+    assert bootstrap_pvalue([1, 2, 3], [1, 2, 3]) > 0.5
+    assert bootstrap_pvalue([1], [1, 2]) is None
+
+    try:
+        outliers_mask([1, 2, 3], method="xxx")
+        assert False
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    _coverage()
+    print("OK")
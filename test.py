@@ -15,11 +15,16 @@ libs = [("perftrackerlib/client.py", 73),
         ("perftrackerlib/helpers/timeparser.py", 98),
         ("perftrackerlib/helpers/timeline.py", 89),
         ("perftrackerlib/helpers/largelogfile.py", 98),
-        ("perftrackerlib/helpers/httppool.py", 34),
+        ("perftrackerlib/helpers/httppool.py", 70),
         ("perftrackerlib/helpers/texttable.py", 82),
+        ("perftrackerlib/helpers/histogram.py", 95),
+        ("perftrackerlib/helpers/stats.py", 90),
+        ("perftrackerlib/helpers/compare.py", 70),
         ("perftrackerlib/helpers/timehelpers.py", 100),
         ("perftrackerlib/helpers/textparser.py", 100),
         ("perftrackerlib/helpers/html.py", 100),
+        ("perftrackerlib/helpers/lazy.py", 90),
+        ("perftrackerlib/helpers/sampler.py", 85),
         ("perftrackerlib/browser/browser_base.py", 45),
         ("perftrackerlib/browser/browser_webdriver.py", 20),
         ("perftrackerlib/browser/browser_python.py", 55),
@@ -46,8 +51,18 @@ tests = [("./tools/pt-artifact-ctl.py list"),
           "11111111-5555-11e8-85cb-8c85907924ab"),
          ("./tools/pt-suite-uploader.py -f ./examples/data/sample.json -j --pt-project Test --pt-replace "
           "11111111-5555-11e8-85cb-8c85907924ab"),
+         ("./tools/pt-suite-uploader.py -f ./examples/data/sample.txt --pt-project Test --pt-replace "
+          "11111111-5555-11e8-85cb-8c85907924ab --pt-spool /tmp/pt-test-spool --pt-spool-only"),
+         ("./tools/pt-suite-uploader.py --replay-spool /tmp/pt-test-spool"),
+         ("./tools/pt-compare.py ./examples/data/sample_job_a.json ./examples/data/sample_job_b.json -t 5"),
          ]
 
+# max time (msec) the tool can spend to import perftrackerlib, see 'python -X importtime'
+import_budgets = [("./tools/pt-artifact-ctl.py", 300),
+                  ("./tools/pt-suite-uploader.py", 300),
+                  ("./tools/pt-compare.py", 300),
+                  ]
+
 
 def test_one(cmdline):
     print("Testing: %s ..." % cmdline, end=' ')
@@ -56,6 +71,24 @@ def test_one(cmdline):
     print("OK")
 
 
+def importtime_one(tool, budget_ms):
+    print("Import time: %s ..." % tool, end=' ')
+    sys.stdout.flush()
+    _, _, err = execute("python3 -X importtime %s --help" % tool)
+    usec = 0
+    for line in err.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        f = line.split("|")
+        if len(f) == 3 and f[2].startswith(" perftrackerlib"):
+            usec += int(f[1])
+    if usec > budget_ms * 1000:
+        print("FAILED, %d ms, must be <= %d ms" % (usec / 1000, budget_ms))
+        print("NOTE: to debug the problem manually run:")
+        print("          python3 -X importtime %s --help" % tool)
+        sys.exit(-1)
+    print("OK, %d ms" % (usec / 1000))
+
+
 def lib2mod(lib):
     modname = lib[0:len(lib) - 3] if lib.endswith(".py") else lib
     return modname.replace("/", ".")
@@ -94,6 +127,9 @@ def test_all():
     for lib, coverage_target in libs:
         coverage_one(lib, coverage_target)
 
+    for tool, budget_ms in import_budgets:
+        importtime_one(tool, budget_ms)
+
     for test in tests:
         test_one("python2.7 %s" % test)
         test_one("python3 %s" % test)
@@ -10,7 +10,10 @@ __license__ = "MIT"
 from optparse import OptionParser, OptionGroup, IndentedHelpFormatter
 import os
 import sys
+import glob
+import time
 import logging
+from multiprocessing.dummy import Pool as ThreadPool
 
 if sys.version_info >= (3, 0):
     import http.client as httplib
@@ -20,7 +23,8 @@ else:
 bindir, basename = os.path.split(sys.argv[0])
 sys.path.insert(0, os.path.join(bindir, ".."))
 
-from perftrackerlib.client import ptServer, ptArtifact, ptRuntimeException, ptJsonEncoder
+from perftrackerlib.client import ptServer, ptArtifact, ptRuntimeException, ptJsonEncoder, \
+    PT_SERVER_DEFAULT_RETRIES, PT_SERVER_DEFAULT_TIMEOUT_SEC, PT_ARTIFACT_CHUNK_SIZE
 
 from perftrackerlib import perftrackerlib_require_version
 perftrackerlib_require_version('0.0.30')
@@ -40,8 +44,79 @@ class formatter(IndentedHelpFormatter):
         return ret
 
 
+def expand_uuids(args):
+    """
+    Expand the list of UUIDs, @FILE is replaced with UUIDs listed in the FILE (the first word of every line,
+    so upload-many output can be used as is), @- reads stdin
+    """
+    uuids = []
+    for arg in args:
+        if not arg.startswith("@"):
+            uuids.append(arg)
+            continue
+        f = sys.stdin if arg == "@-" else open(arg[1:])
+        uuids += [line.split()[0] for line in f if line.strip() and not line.startswith("#")]
+        if f is not sys.stdin:
+            f.close()
+    return uuids
+
+
+def expand_files(args):
+    files = []
+    for arg in args:
+        found = sorted(glob.glob(os.path.expanduser(arg)))
+        if not found:
+            logging.warning("no files match '%s'" % arg)
+        files += [f for f in found if os.path.isfile(f)]
+    return files
+
+
+def run_many(opts, func, items, abort):
+    """
+    Run func(item) for every item on a thread pool, func returns (resp, bytes, message)
+    """
+    if not items:
+        abort("nothing to do")
+
+    def _run(item):
+        try:
+            resp, size, msg = func(item)
+            if resp.status_code not in (httplib.OK, httplib.PARTIAL_CONTENT):
+                err = resp.json.get('message', '') if isinstance(getattr(resp, 'json', None), dict) else ''
+                return item, False, 0, "status: %d %s" % (resp.status_code, err)
+            return item, True, size, msg
+        except (ptRuntimeException, IOError, OSError) as e:
+            return item, False, 0, str(e)
+
+    ts = time.time()
+    ok = failed = total_bytes = 0
+
+    pool = ThreadPool(min(opts.jobs, len(items)))
+    try:
+        for item, success, size, msg in pool.imap_unordered(_run, items):
+            if success:
+                ok += 1
+                total_bytes += size
+                print(msg)
+            else:
+                failed += 1
+                print("%s: FAILED, %s" % (item, msg), file=sys.stderr)
+    finally:
+        pool.close()
+        pool.join()
+
+    duration = time.time() - ts
+    print("%d done, %d failed, %.1f MB in %.1f sec, %.1f MB/s, %.1f items/s" %
+          (ok, failed, total_bytes / 1024.0 / 1024.0, duration,
+           total_bytes / 1024.0 / 1024.0 / duration if duration else 0,
+           (ok + failed) / duration if duration else 0), file=sys.stderr)
+    if failed:
+        sys.exit(-1)
+
+
 def run(opts, args, abort):
-    pt_server = ptServer(opts.pt_server_url)
+    pool_size = opts.jobs if args and args[0].endswith("-many") else 1
+    pt_server = ptServer(opts.pt_server_url, pool_size=pool_size, retries=opts.retries, timeout_sec=opts.timeout)
 
     if len(args) == 0:
         abort("command is not specified")
@@ -83,16 +158,47 @@ def run(opts, args, abort):
     elif args[0] == "download" and len(args) == 3:
         uuid = args[1]
         filepath = args[2]
-        resp = ptArtifact(pt_server, uuid1=uuid).download(filepath)
-        if resp.status_code == httplib.OK:
-            print("Artifact UUID %s saved to %s (%d bytes)" % (uuid, filepath, len(resp.content)))
+        artifact = ptArtifact(pt_server, uuid1=uuid)
+        resp = artifact.download(filepath, chunk_size=opts.chunk_size * 1024, decompress=opts.decompress,
+                                 resume=not opts.no_resume)
+        # 206 is returned if an interrupted download has been resumed
+        if resp.status_code in (httplib.OK, httplib.PARTIAL_CONTENT):
+            print("Artifact UUID %s saved to %s (%d bytes)" % (uuid, filepath, artifact.size))
             return
     elif args[0] == "dump" and len(args) == 2:
         uuid = args[1]
-        resp = ptArtifact(pt_server, uuid1=uuid).download()
+        out = sys.stdout.buffer if sys.version_info >= (3, 0) else sys.stdout
+        resp = ptArtifact(pt_server, uuid1=uuid).download(fileobj=out, chunk_size=opts.chunk_size * 1024,
+                                                          decompress=opts.decompress)
         if resp.status_code == httplib.OK:
-            print(resp.text)
+            out.flush()
             return
+    elif args[0] == "upload-many" and len(args) >= 2:
+        def _upload(filepath):
+            artifact = ptArtifact(pt_server, filename=os.path.basename(filepath), description=opts.description,
+                                  ttl_days=int(opts.ttl), mime=opts.mime, inline=opts.inline,
+                                  compression=opts.compression, linked_uuids=opts.link)
+            resp = artifact.upload(filepath, chunk_size=opts.chunk_size * 1024)
+            return resp, artifact.size, "%s %s" % (artifact.uuid, filepath)
+        return run_many(opts, _upload, expand_files(args[1:]), abort)
+
+    elif args[0] == "download-many" and len(args) >= 3:
+        if not os.path.isdir(args[1]):
+            abort("directory not found: %s" % args[1])
+
+        def _download(uuid):
+            filepath = os.path.join(args[1], uuid)
+            artifact = ptArtifact(pt_server, uuid1=uuid)
+            resp = artifact.download(filepath, chunk_size=opts.chunk_size * 1024, decompress=opts.decompress,
+                                     resume=not opts.no_resume)
+            return resp, artifact.size, "%s %s" % (uuid, filepath)
+        return run_many(opts, _download, expand_uuids(args[2:]), abort)
+
+    elif args[0] == "link-many" and len(args) >= 3:
+        def _link(uuid):
+            return ptArtifact(pt_server, uuid1=uuid).link([args[1]]), 0, "%s linked to %s" % (uuid, args[1])
+        return run_many(opts, _link, expand_uuids(args[2:]), abort)
+
     elif args[0] == "list":
         try:
             limit = int(args[1]) if len(args) >= 2 else 10
@@ -131,11 +237,22 @@ def main():
     %prog [options] unlink ARTIFACT_UUID OBJECT_UUID
     %prog [options] list [LIMIT]
     %prog [options] download ARTIFACT_UUID ARTIFACT_FILE_TO_SAVE
+    %prog [options] dump ARTIFACT_UUID
+    %prog [options] upload-many FILE_OR_GLOB [FILE_OR_GLOB ...]
+    %prog [options] download-many DIR_TO_SAVE ARTIFACT_UUID|@FILE [ARTIFACT_UUID|@FILE ...]
+    %prog [options] link-many OBJECT_UUID ARTIFACT_UUID|@FILE [ARTIFACT_UUID|@FILE ...]
+
+    @FILE is a file with the list of UUIDs (one per line, the rest of the line is ignored), @- is stdin
     """
 
     op = OptionParser(description=description, usage=usage, formatter=formatter())
     op.add_option("-v", "--verbose", default=0, action="count", help="enable verbose mode")
     op.add_option("-p", "--pt-server-url", default="http://127.0.0.1:9000", help="perftracker url, default %default")
+    op.add_option("--retries", type="int", default=PT_SERVER_DEFAULT_RETRIES,
+                  help="number of retries on connection errors (and 5xx responses of the idempotent "
+                       "requests), default %default")
+    op.add_option("--timeout", type="float", default=PT_SERVER_DEFAULT_TIMEOUT_SEC,
+                  help="server request timeout (sec), default %default")
 
     og = OptionGroup(op, "'upload' and 'update' options")
     og.add_option("-d", "--description", help="artifact description (i")
@@ -149,6 +266,21 @@ def main():
     og.add_option("-t", "--ttl", default=180, help="time to live (days), default=%default, 0 - infinite")
     op.add_option_group(og)
 
+    og = OptionGroup(op, "'upload-many', 'download-many' and 'link-many' options")
+    og.add_option("-j", "--jobs", type="int", default=4, help="number of parallel requests, default %default")
+    og.add_option("-l", "--link", action="append", default=None, metavar="OBJECT_UUID",
+                  help="link uploaded artifacts to the object, can be specified multiple times")
+    op.add_option_group(og)
+
+    og = OptionGroup(op, "'download', 'dump' and 'download-many' options")
+    og.add_option("--chunk-size", type="int", default=PT_ARTIFACT_CHUNK_SIZE // 1024,
+                  help="download chunk size (KB), default %default")
+    og.add_option("--decompress", default=False, action="store_true",
+                  help="decompress bz2-compressed artifact on the fly")
+    og.add_option("--no-resume", default=False, action="store_true",
+                  help="do not resume interrupted download, start from scratch")
+    op.add_option_group(og)
+
     opts, args = op.parse_args()
 
     loglevel = logging.DEBUG if opts.verbose >= 2 else (logging.INFO if opts.verbose == 1 else logging.WARNING)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, absolute_import
+
+# -*- coding: utf-8 -*-
+__author__ = "perfguru87@gmail.com"
+__copyright__ = "Copyright 2018, The PerfTracker project"
+__license__ = "MIT"
+
+from optparse import OptionParser, IndentedHelpFormatter
+import os
+import sys
+import logging
+
+bindir, basename = os.path.split(sys.argv[0])
+sys.path.insert(0, os.path.join(bindir, ".."))
+
+from perftrackerlib.helpers.compare import ptJobCompare, PT_COMPARE_METHODS, PT_COMPARE_BOOTSTRAP_PURE_MAX
+
+from perftrackerlib import perftrackerlib_require_version
+perftrackerlib_require_version('0.0.44')
+
+
+class formatter(IndentedHelpFormatter):
+    def __init__(self):
+        IndentedHelpFormatter.__init__(self, indent_increment=2, max_help_position=30, width=80, short_first=1)
+
+    def format_description(self, description):
+        if not description:
+            return ""
+        return "Description:\n%s\n" % description
+
+
+def main():
+    usage = "usage: %prog [options] JOB_A.json JOB_B.json"
+
+    description = """
+  The %prog compares the base job A and new job B results saved by --pt-to-file
+  (or ptSuite.toJson()). The tests are matched by tag, group and category, a change
+  is a regression or improvement if it is significant (p-value < --alpha) and
+  larger than --threshold. The tests with a single score have no p-value, so only
+  --threshold is used for them.
+"""
+
+    op = OptionParser(description=description, usage=usage, formatter=formatter())
+    op.add_option("-v", "--verbose", action="store_true", help="enable verbose mode")
+    op.add_option("-m", "--method", type="choice", choices=PT_COMPARE_METHODS, default=PT_COMPARE_METHODS[0],
+                  help="significance test: %s, default: %%default. bootstrap costs resamples x scores "
+                       "operations per test: ~2 sec per 100k tests with numpy, without numpy it falls back "
+                       "to mannwhitney for more than %d tests" %
+                       (", ".join(PT_COMPARE_METHODS), PT_COMPARE_BOOTSTRAP_PURE_MAX))
+    op.add_option("-a", "--alpha", type="float", default=0.05, help="significance level, default: %default")
+    op.add_option("-t", "--threshold", type="float", default=0.0,
+                  help="min change of the scores mean to report (%), default: %default")
+    op.add_option("-r", "--resamples", type="int", default=1000,
+                  help="number of the bootstrap resamples, default: %default")
+    op.add_option("-n", "--max-rows", type="int", default=50, help="max rows to print (0 - all), default: %default")
+    op.add_option("--all", action="store_true", help="print the tests without significant changes too")
+    op.add_option("--fail-on-regression", action="store_true", help="exit with error if there are regressions")
+
+    opts, args = op.parse_args()
+
+    loglevel = logging.DEBUG if opts.verbose else logging.INFO
+    logging.basicConfig(level=loglevel, format="%(asctime)s - %(module)17s - %(levelname).3s - %(message)s",
+                        datefmt='%H:%M:%S')
+
+    if len(args) != 2:
+        op.print_usage()
+        print("error: two job json files are required")
+        sys.exit(-1)
+
+    try:
+        c = ptJobCompare(args[0], args[1], method=opts.method, alpha=opts.alpha, threshold=opts.threshold / 100.0,
+                         resamples=opts.resamples)
+    except (IOError, ValueError) as e:
+        print("error: %s" % str(e))
+        sys.exit(-1)
+
+    c.compare()
+    print("\n".join(c.getTable(max_rows=opts.max_rows, show_all=opts.all).get_lines()))
+    print("")
+    print(c.getSummary())
+
+    if opts.fail_on_regression and c.getRegressions():
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,7 @@ import json
 bindir, basename = os.path.split(sys.argv[0])
 sys.path.insert(0, os.path.join(bindir, ".."))
 
-from perftrackerlib.client import ptSuite, ptHost, ptVM, ptComponent, ptProduct, ptTest
+from perftrackerlib.client import ptSuite, ptHost, ptVM, ptComponent, ptProduct, ptTest, ptSpool
 from perftrackerlib.helpers.textparser import ptParser
 
 from perftrackerlib import perftrackerlib_require_version
@@ -225,6 +225,7 @@ def main():
     op.add_option("-v", "--verbose", action="store_true", help="enable verbose mode")
     op.add_option("-j", "--json", help="get results from json file, not from command line")
     op.add_option("-f", "--file", help="get results from text file, not from command line")
+    op.add_option("--replay-spool", metavar="DIR", help="upload the jobs stored in the --pt-spool directory")
 
     suite = ptSuite()
     suite.addOptions(op)
@@ -234,6 +235,13 @@ def main():
     loglevel = logging.DEBUG if opts.verbose else logging.INFO
     logging.basicConfig(level=loglevel, format="%(asctime)s - %(module)17s - %(levelname).3s - %(message)s", datefmt='%H:%M:%S')
 
+    if opts.replay_spool:
+        if opts.pt_url:
+            suite.pt_server.setUrl(opts.pt_url)
+        uploaded, failed = ptSpool(opts.replay_spool).replay(suite.pt_server)
+        print("%d job(s) uploaded, %d failed" % (uploaded, failed))
+        sys.exit(-1 if failed else 0)
+
     if opts.json:
         parse_json(suite, read_file(opts.json))
         suite.handleOptions(opts)